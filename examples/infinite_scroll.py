@@ -4,8 +4,7 @@ square = db.table("square", id="INTEGER PRIMARY KEY", y=int)
 app, rtx = rsql_html_app(pico=True, db=db)
 if square.count().value < 1000:
     square.delete()
-    for x in range(1000):
-        square.insert(id=x, y=x*x)
+    square.insert_many([{"id": x, "y": x*x} for x in range(1000)])
 
 @rtx('/')
 def get():
@@ -15,10 +15,10 @@ def col(c, v):
         lambda x: ("X" if x['step'] % 2 else "O") if x else
                    Button("", hx_post=f"/add?col={c}&row={v}"))
 
-won_table = (past_steps.group_by("col", "o", count="COUNT(*)").where(count=3).union_all(
-    past_steps.group_by("row", "o", count="COUNT(*)").where(count=3))).union_all(
-    past_steps.select(rpc="row+col", o=True).group_by("rpc", "o", count="COUNT(*)").where(count=3)).union_all(
-    past_steps.select(rmc="row-col", o=True).group_by("rmc", "o", count="COUNT(*)").where(count=3))
+won_table = (past_steps.group_by("col", "o", count="COUNT(*)", having="count = 3").union_all(
+    past_steps.group_by("row", "o", count="COUNT(*)", having="count = 3"))).union_all(
+    past_steps.select(rpc="row+col", o=True).group_by("rpc", "o", count="COUNT(*)", having="count = 3")).union_all(
+    past_steps.select(rmc="row-col", o=True).group_by("rmc", "o", count="COUNT(*)", having="count = 3"))
 
 won_count = won_table.count()
 step_count = steps.count()
@@ -75,15 +75,18 @@ def get():
 
 @rtx('/reset')
 def post():
-    steps.delete()
-    nextstep.update({}, nextstep=1)
+    with db.transaction():
+        steps.delete()
+        nextstep.update({}, nextstep=1)
 
 @rtx('/add')
 def post(col:int, row:int):
     if won_count.value == 0:
-        # steps.delete("step >= ?", nextstep_only.value.nextstep)
-        db.execute("delete from steps where step >= ?", (nextstep_only.value.nextstep,))
-        steps.insert(step=nextstep_only.value.nextstep, col=col, row=row, o=(nextstep_only.value.nextstep % 2))
-        nextstep.update({}, nextstep=nextstep_only.value.nextstep + 1)
+        step = nextstep_only.value.nextstep
+        with db.transaction():
+            # steps.delete("step >= ?", step)
+            db.execute("delete from steps where step >= ?", (step,))
+            steps.insert(step=step, col=col, row=row, o=(step % 2))
+            nextstep.update({}, nextstep=step + 1)
 if __name__ == '__main__':
     serve()
\ No newline at end of file
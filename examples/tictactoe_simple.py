@@ -10,10 +10,10 @@ def col(c, v):
         lambda x: ("X" if x['step'] % 2 else "O") if x else
                    Button("", hx_post=f"/add?col={c}&row={v}"))
 
-won_table = (steps.group_by("col", "o", count="COUNT(*)").where(count=3).union_all(
-    steps.group_by("row", "o", count="COUNT(*)").where(count=3))).union_all(
-    steps.select(rpc="row+col", o=True).group_by("rpc", "o", count="COUNT(*)").where(count=3)).union_all(
-    steps.select(rmc="row-col", o=True).group_by("rmc", "o", count="COUNT(*)").where(count=3))
+won_table = (steps.group_by("col", "o", count="COUNT(*)", having="count = 3").union_all(
+    steps.group_by("row", "o", count="COUNT(*)", having="count = 3"))).union_all(
+    steps.select(rpc="row+col", o=True).group_by("rpc", "o", count="COUNT(*)", having="count = 3")).union_all(
+    steps.select(rmc="row-col", o=True).group_by("rmc", "o", count="COUNT(*)", having="count = 3"))
 
 won_count = won_table.count()
 step_count = steps.count()
@@ -5,6 +5,7 @@ from .rsql import *
 from . import html
 from . import helpers
 from . import auth
+from . import aio
 
 # Optionally, you can set metadata for your package
 __version__ = "0.1.0"
@@ -0,0 +1,608 @@
+"""
+Running aggregates for GroupBy views.
+
+Each aggregate of a GroupBy is parsed once into an Aggregate. Every group keeps a flat
+accumulator list: slot 0 holds the number of rows in the group, slot 1 the aggregate values
+queried from SQLite for groups that can't be maintained in Python (None otherwise), and the
+remaining slots the state of each aggregate. Applying a changed row is then a few arithmetic
+operations per aggregate.
+"""
+import itertools, math, re
+from .sqlexpr import apply_numeric_affinity, collation_function, compile_expression, sql_compare, to_numeric, to_text, SQLFallback
+from .sortedrows import SortedRows
+
+ROW_COUNT = 0
+SQL_VALUES = 1
+FIRST_SLOT = 2
+
+_AGGREGATE = re.compile(r"\s*([A-Za-z_]+)\s*\((.*)\)\s*\Z", re.S)
+_DISTINCT = re.compile(r"\s*(DISTINCT|ALL)\b", re.I)
+
+class Aggregate:
+    """
+    An aggregate function of a GroupBy view, for example SUM(price).
+
+    Its state lives in acc[offset:offset + slots] of each group's accumulator.
+
+    Attributes:
+        alias (str): The output column.
+        sql (str): The aggregate as written, used when its value has to be queried.
+        argument: Function computing the aggregated value from a row dict, None for COUNT(*).
+            It raises SQLFallback for values it can't evaluate like SQLite.
+        offset (int): Index of the first state slot in the accumulator.
+    """
+    slots = 0
+    ordered = False  # Whether the result depends on the order of the rows
+
+    def __init__(self, alias, sql, argument=None):
+        self.alias = alias
+        self.sql = sql
+        self.argument = argument
+        self.offset = FIRST_SLOT
+
+    def initial(self):
+        """Return the state slots of an empty group."""
+        return []
+
+    def add(self, acc, values):
+        """Add a row to the group, returning False if the aggregate has to be queried."""
+        return True
+
+    def remove(self, acc, values):
+        """Remove a row from the group, returning False if the aggregate has to be queried."""
+        return True
+
+    def update(self, acc, old, new):
+        """Replace a row of the group, returning False if the aggregate has to be queried."""
+        removed = self.remove(acc, old)
+        return self.add(acc, new) and removed
+
+    def load(self, acc, value):
+        """Set the state from the value of the aggregate queried from SQLite."""
+        raise NotImplementedError
+
+    def result(self, acc):
+        raise NotImplementedError
+
+class CountAll(Aggregate):
+    """COUNT(*), read from the row count of the group."""
+    def result(self, acc):
+        return acc[ROW_COUNT]
+
+class Count(Aggregate):
+    """COUNT(x): the number of non-NULL values."""
+    slots = 1
+
+    def initial(self):
+        return [0]
+
+    def add(self, acc, values):
+        if self.argument(values) is not None:
+            acc[self.offset] += 1
+        return True
+
+    def remove(self, acc, values):
+        if self.argument(values) is not None:
+            acc[self.offset] -= 1
+        return True
+
+    def result(self, acc):
+        return acc[self.offset]
+
+def sum_term(value):
+    """
+    Return the number SUM() adds for a non-NULL value, and whether it's an exact integer.
+
+    Like SQLite, well-formed integer TEXT is added as an integer, and any other TEXT by its
+    numeric prefix as a REAL.
+    """
+    if isinstance(value, int):
+        return value, True
+    if isinstance(value, float):
+        return value, False
+    number = apply_numeric_affinity(value)
+    if isinstance(number, int):
+        return number, True
+    return float(to_numeric(value)), False
+
+def neumaier_add(total, compensation, value):
+    """Add value to a float sum, keeping the lost low-order bits in compensation."""
+    t = total + value
+    if abs(total) >= abs(value):
+        compensation += (total - t) + value
+    else:
+        compensation += (value - t) + total
+    return t, compensation
+
+class Sum(Aggregate):
+    """
+    SUM(x), with the state [integer total, float total, float compensation, number of non-NULL
+    values, number of non-integer values].
+
+    Integers are summed exactly, and other values with Neumaier's compensated summation, so
+    the result doesn't drift however many rows are added and removed. The result is an
+    integer while all values are integers, a REAL otherwise, and NULL without values.
+    """
+    slots = 5
+
+    def initial(self):
+        return [0, 0.0, 0.0, 0, 0]
+
+    def add(self, acc, values):
+        value = self.argument(values)
+        if value is not None:
+            value, exact = sum_term(value)
+            i = self.offset
+            acc[i + 3] += 1
+            if exact:
+                acc[i] += value
+            else:
+                if not math.isfinite(value):
+                    raise SQLFallback(value)
+                acc[i + 1], acc[i + 2] = neumaier_add(acc[i + 1], acc[i + 2], value)
+                acc[i + 4] += 1
+        return True
+
+    def remove(self, acc, values):
+        value = self.argument(values)
+        if value is not None:
+            value, exact = sum_term(value)
+            i = self.offset
+            acc[i + 3] -= 1
+            if exact:
+                acc[i] -= value
+            else:
+                if not math.isfinite(value):
+                    raise SQLFallback(value)
+                acc[i + 4] -= 1
+                if acc[i + 4]:
+                    acc[i + 1], acc[i + 2] = neumaier_add(acc[i + 1], acc[i + 2], -value)
+                else:
+                    # Restart from an exact zero, so rounding errors don't outlive the values
+                    acc[i + 1] = acc[i + 2] = 0.0
+        return True
+
+    def total(self, acc):
+        i = self.offset
+        if acc[i + 4]:
+            return acc[i] + (acc[i + 1] + acc[i + 2])
+        return acc[i]
+
+    def result(self, acc):
+        i = self.offset
+        if not acc[i + 3]:
+            return None
+        return float(self.total(acc)) if acc[i + 4] else acc[i]
+
+class Avg(Sum):
+    """AVG(x), the total of SUM() divided by the number of non-NULL values."""
+    def result(self, acc):
+        count = acc[self.offset + 3]
+        if not count:
+            return None
+        return float(self.total(acc)) / count
+
+class Total(Sum):
+    """TOTAL(x): like SUM(x), but always a REAL, and 0.0 without values."""
+    def result(self, acc):
+        return float(self.total(acc))
+
+class CountDistinct(Aggregate):
+    """
+    COUNT(DISTINCT x), with the state {value: number of rows}.
+
+    TEXT values are folded with the collation of the argument, and equal numbers count once.
+    """
+    slots = 1
+
+    def __init__(self, alias, sql, argument, collation):
+        super().__init__(alias, sql, argument)
+        fold = collation_function(collation)
+        self.key = None if collation == "BINARY" else lambda value: fold(value) if isinstance(value, str) else value
+
+    def initial(self):
+        return [None]
+
+    def add(self, acc, values):
+        value = self.argument(values)
+        if value is not None:
+            if self.key:
+                value = self.key(value)
+            counts = acc[self.offset]
+            if counts is None:
+                counts = acc[self.offset] = {}
+            counts[value] = counts.get(value, 0) + 1
+        return True
+
+    def remove(self, acc, values):
+        value = self.argument(values)
+        if value is not None:
+            if self.key:
+                value = self.key(value)
+            counts = acc[self.offset]
+            count = counts.get(value) if counts else None
+            if count is None:
+                raise SQLFallback(value)
+            if count == 1:
+                del counts[value]
+            else:
+                counts[value] = count - 1
+        return True
+
+    def result(self, acc):
+        counts = acc[self.offset]
+        return len(counts) if counts else 0
+
+def moment_value(value):
+    """Return the REAL a non-NULL value is added as by VARIANCE() and STDDEV()."""
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    return float(sum_term(value)[0])
+
+class Moments:
+    """
+    The state of VARIANCE() and STDDEV(): [count, scale, sum, sum of squares], with the
+    sums kept exactly as integers, in units of 2 ** -scale and 2 ** (-2 * scale).
+
+    The SQLite implementation of VARIANCE() and STDDEV() uses the same state, and the
+    result is rounded once from the exact sums, so it doesn't depend on the order of the
+    values: a group maintained by adding and removing values agrees with the query exactly.
+    """
+    def __init__(self, population=False, root=False):
+        self.population = population
+        self.root = root
+        self.state = [0, 0, 0, 0]
+
+    def step(self, value):
+        if value is not None and self.state is not None:
+            x = moment_value(value)
+            # Infinities make the result NaN, which SQLite returns as NULL
+            if math.isfinite(x):
+                add_moment(self.state, 0, x)
+            else:
+                self.state = None
+
+    def finalize(self):
+        return None if self.state is None else moments_result(self.state, 0, self.population, self.root)
+
+def scaled_moment(state, i, x):
+    """Return the finite float x as an integer in units of the state, rescaling it if needed."""
+    numerator, denominator = x.as_integer_ratio()
+    scale = denominator.bit_length() - 1
+    if scale > state[i + 1]:
+        shift = scale - state[i + 1]
+        state[i + 1] = scale
+        state[i + 2] <<= shift
+        state[i + 3] <<= 2 * shift
+    return numerator << (state[i + 1] - scale)
+
+def add_moment(state, i, x):
+    x = scaled_moment(state, i, x)
+    state[i] += 1
+    state[i + 2] += x
+    state[i + 3] += x * x
+
+def remove_moment(state, i, x):
+    if state[i] <= 1:
+        state[i:i + 4] = [0, 0, 0, 0]
+        return
+    x = scaled_moment(state, i, x)
+    state[i] -= 1
+    state[i + 2] -= x
+    state[i + 3] -= x * x
+
+def moments_result(state, i, population, root):
+    n = state[i]
+    if n < (1 if population else 2):
+        return None
+    # n * m2, the sum of squared deviations, is n * sum of squares - sum ** 2
+    try:
+        variance = (n * state[i + 3] - state[i + 2] ** 2) / ((n * (n if population else n - 1)) << (2 * state[i + 1]))
+    except OverflowError:
+        variance = math.inf
+    return math.sqrt(variance) if root else variance
+
+# name: (population, root)
+MOMENT_FUNCTIONS = {
+    "VARIANCE": (False, False), "VAR_SAMP": (False, False), "VAR_POP": (True, False),
+    "STDDEV": (False, True), "STDDEV_SAMP": (False, True), "STDDEV_POP": (True, True),
+}
+
+def register_functions(conn):
+    """
+    Define the aggregates SQLite doesn't have built in (VARIANCE, STDDEV, ...) on a connection.
+    """
+    for name, (population, root) in MOMENT_FUNCTIONS.items():
+        conn.create_aggregate(name, 1, type(name, (Moments,), {
+            "__init__": lambda self, population=population, root=root: Moments.__init__(self, population, root)}))
+
+class Variance(Aggregate):
+    """VARIANCE(x), STDDEV(x) and their _POP/_SAMP variants, with the state of Moments."""
+    slots = 4
+
+    def __init__(self, alias, sql, argument, population, root):
+        super().__init__(alias, sql, argument)
+        self.population = population
+        self.root = root
+
+    def initial(self):
+        return [0, 0, 0, 0]
+
+    def add(self, acc, values):
+        value = self.argument(values)
+        if value is not None:
+            x = moment_value(value)
+            if not math.isfinite(x):
+                raise SQLFallback(x)
+            add_moment(acc, self.offset, x)
+        return True
+
+    def remove(self, acc, values):
+        value = self.argument(values)
+        if value is not None:
+            remove_moment(acc, self.offset, moment_value(value))
+        return True
+
+    def result(self, acc):
+        return moments_result(acc, self.offset, self.population, self.root)
+
+class GroupConcat(Aggregate):
+    """
+    GROUP_CONCAT(x) or GROUP_CONCAT(x, separator), with the parts of the rows in order.
+
+    SQLite concatenates the values in the order the rows are scanned, which for a table is
+    the order they were inserted. The state is [{sequence number: part}, {row: sequence
+    numbers}]: updated rows keep their place, new rows go to the end, and a row moved in
+    from another group reloads the parts of the group in scan order.
+    """
+    slots = 2
+    ordered = True
+
+    def __init__(self, alias, sql, argument, separator, columns):
+        super().__init__(alias, sql, argument)
+        self.separator = separator
+        self.columns = columns
+        self.sequence = itertools.count()
+
+    def initial(self):
+        return [None, None]
+
+    def part(self, values):
+        # (separator, text), or None for NULL
+        value = self.argument(values)
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            raise SQLFallback(value)
+        if self.separator is None:
+            return (",", to_text(value))
+        separator = self.separator(values)
+        if isinstance(separator, bytes):
+            raise SQLFallback(separator)
+        return ("" if separator is None else to_text(separator), to_text(value))
+
+    def row(self, values):
+        return tuple([values[col] for col in self.columns])
+
+    def add(self, acc, values):
+        i = self.offset
+        if acc[i] is None:
+            acc[i], acc[i + 1] = {}, {}
+        seq = next(self.sequence)
+        acc[i][seq] = self.part(values)
+        acc[i + 1].setdefault(self.row(values), []).append(seq)
+        return True
+
+    def take(self, acc, values):
+        # Remove and return the sequence number of a row
+        rows = acc[self.offset + 1] or {}
+        row = self.row(values)
+        seqs = rows.get(row)
+        if not seqs:
+            raise SQLFallback(row)
+        seq = seqs.pop()
+        if not seqs:
+            del rows[row]
+        return seq
+
+    def remove(self, acc, values):
+        del acc[self.offset][self.take(acc, values)]
+        return True
+
+    def update(self, acc, old, new):
+        seq = self.take(acc, old)
+        acc[self.offset][seq] = self.part(new)
+        acc[self.offset + 1].setdefault(self.row(new), []).append(seq)
+        return True
+
+    def reload(self, acc, rows):
+        """Rebuild the parts from the rows of the group, in scan order."""
+        acc[self.offset] = acc[self.offset + 1] = None
+        for values in rows:
+            self.add(acc, values)
+
+    def result(self, acc):
+        parts = acc[self.offset]
+        text = None
+        for part in parts.values() if parts else ():
+            if part is not None:
+                text = part[1] if text is None else text + part[0] + part[1]
+        return text
+
+def same_value(a, b):
+    """
+    Return True if a and b are the same value, not only equal like 'A' and 'a' with NOCASE.
+    """
+    return type(a) is type(b) and a == b
+
+def value_key(collation):
+    """
+    Return a key function that orders non-NULL values like SQLite does with the collation.
+    """
+    fold = collation_function(collation)
+    def key(value):
+        if isinstance(value, (int, float)):
+            return (1, value)
+        if isinstance(value, str):
+            return (2, fold(value))
+        return (3, bytes(value))
+    return key
+
+class Extreme(Aggregate):
+    """
+    MIN(x) or MAX(x), comparing values with the collation of the argument.
+
+    The state is [current value, sorted values]. With a budget, each group keeps its values in
+    a SortedRows multiset, so removing the current extreme value finds the next one without a
+    query. Groups with more values than the budget drop the multiset (the slot becomes False),
+    and like without a budget, removing their extreme value needs a query for the new one.
+
+    SQLite returns the first of equal values it scans, so when values are equal but not the
+    same, like 'A' and 'a' with NOCASE or 1 and 1.0, the group is queried for the one shown.
+    """
+    slots = 2
+
+    def __init__(self, alias, sql, argument, sign, collation, budget=None):
+        super().__init__(alias, sql, argument)
+        self.sign = sign
+        self.collation = collation
+        self.budget = budget
+        self.key = value_key(collation)
+
+    def initial(self):
+        return [None, None if self.budget else False]
+
+    def add(self, acc, values):
+        value = self.argument(values)
+        if value is not None:
+            i = self.offset
+            multiset = acc[i + 1]
+            if multiset is None:
+                multiset = acc[i + 1] = SortedRows(self.key)
+            if multiset is not False:
+                if len(multiset) < self.budget:
+                    multiset.add(value)
+                else:
+                    acc[i + 1] = False
+            current = acc[i]
+            if current is None:
+                acc[i] = value
+                return True
+            order = sql_compare(value, current, self.collation)
+            if order == self.sign:
+                acc[i] = value
+            elif order == 0 and not same_value(value, current):
+                return False
+        return True
+
+    def remove(self, acc, values):
+        value = self.argument(values)
+        if value is None:
+            return True
+        i = self.offset
+        multiset = acc[i + 1]
+        if isinstance(multiset, SortedRows):
+            if multiset.remove(value) is None:
+                return False
+            if not multiset:
+                acc[i] = None
+                return True
+            if sql_compare(value, acc[i], self.collation) != 0:
+                return True
+            key = self.key(multiset[0] if self.sign < 0 else multiset[-1])
+            start, end = multiset.bisect_left(key), multiset.bisect_right(key)
+            first = multiset[start]
+            if any(not same_value(multiset[j], first) for j in range(start + 1, end)):
+                return False
+            acc[i] = first
+            return True
+        current = acc[i]
+        return current is not None and sql_compare(value, current, self.collation) != 0
+
+    def load(self, acc, value):
+        acc[self.offset] = value
+
+    def result(self, acc):
+        return acc[self.offset]
+
+    def size(self, acc):
+        """Return the number of values kept for the group."""
+        multiset = acc[self.offset + 1]
+        return len(multiset) if isinstance(multiset, SortedRows) else 0
+
+class QueriedAggregate(Aggregate):
+    """An aggregate without a Python implementation, queried for every changed group."""
+    slots = 1
+
+    def initial(self):
+        return [None]
+
+    def add(self, acc, values):
+        return False
+
+    def remove(self, acc, values):
+        return False
+
+    def load(self, acc, value):
+        acc[self.offset] = value
+
+    def result(self, acc):
+        return acc[self.offset]
+
+def parse_aggregate(alias, sql, columns, column_affinity=None, column_collation=None, minmax_budget=None):
+    """
+    Parse the SQL of an aggregate into an Aggregate.
+
+    Args:
+        alias (str): The output column.
+        sql (str): The aggregate, for example "MAX(price * quantity)".
+        columns (list): The columns of the aggregated view.
+        column_affinity (function, optional): Returns the affinity of a column.
+        column_collation (function, optional): Returns the collation of a column.
+        minmax_budget (int, optional): The number of values MIN and MAX keep sorted per group.
+
+    Returns:
+        Aggregate: The aggregate; a QueriedAggregate if it isn't supported in Python.
+    """
+    m = _AGGREGATE.match(sql)
+    if not m:
+        return QueriedAggregate(alias, sql)
+    name, arg = m.group(1).upper(), m.group(2).strip()
+    compile = lambda expr: compile_expression(expr, columns, column_affinity, column_collation)
+    distinct = _DISTINCT.match(arg)
+    if distinct:
+        if name == "COUNT" and distinct.group(1).upper() == "DISTINCT":
+            compiled = compile(arg[distinct.end():])
+            collation = compiled and (compiled.collation or "BINARY")
+            if compiled is not None and collation_function(collation) is not None:
+                return CountDistinct(alias, sql, compiled.evaluate, collation)
+        return QueriedAggregate(alias, sql)
+    if name == "COUNT" and arg == "*":
+        return CountAll(alias, sql)
+    if name == "GROUP_CONCAT":
+        compiled = compile(arg)
+        if compiled is not None:
+            return GroupConcat(alias, sql, compiled.evaluate, None, columns)
+        # The separator is the second argument; try each comma until both sides compile
+        for i, c in enumerate(arg):
+            if c == ",":
+                value, separator = compile(arg[:i]), compile(arg[i + 1:])
+                if value is not None and separator is not None:
+                    return GroupConcat(alias, sql, value.evaluate, separator.evaluate, columns)
+        return QueriedAggregate(alias, sql)
+    if name in ("COUNT", "SUM", "TOTAL", "AVG", "MIN", "MAX") or name in MOMENT_FUNCTIONS:
+        compiled = compile(arg)
+        collation = compiled and (compiled.collation or "BINARY")
+        if compiled is not None and collation_function(collation) is not None:
+            if name == "COUNT":
+                return Count(alias, sql, compiled.evaluate)
+            if name == "SUM":
+                return Sum(alias, sql, compiled.evaluate)
+            if name == "TOTAL":
+                return Total(alias, sql, compiled.evaluate)
+            if name == "AVG":
+                return Avg(alias, sql, compiled.evaluate)
+            if name in MOMENT_FUNCTIONS:
+                return Variance(alias, sql, compiled.evaluate, *MOMENT_FUNCTIONS[name])
+            return Extreme(alias, sql, compiled.evaluate, -1 if name == "MIN" else 1, collation, minmax_budget)
+    return QueriedAggregate(alias, sql)
@@ -0,0 +1,180 @@
+"""
+Asynchronous access to a Database for asyncio applications.
+
+SQLite calls block, so AsyncDatabase runs them on threads and the event loop only awaits
+their results: writes and building views, which load their rows, run on one writer thread,
+and queries on as many threads as the database has read-only connections. Callbacks of views
+are called on the event loop after the write that caused them.
+
+Example:
+    db = AsyncDatabase("example.db")
+    todos = await db.table("todos", title=str, done=bool)
+    await todos.insert(title="Write docs", done=False)
+    open_todos = await todos.where(done=False)
+    open_todos.on_insert(lambda row: print("new todo", row.title))
+    async for todo in open_todos:
+        print(todo.title)
+"""
+import asyncio, contextvars, functools, inspect
+from concurrent.futures import ThreadPoolExecutor
+from .rsql import Database, View
+
+class AsyncDatabase:
+    """
+    A Database whose methods are awaited instead of blocking the event loop.
+
+    Attributes:
+        db: The wrapped Database.
+        writer: The executor with the thread running writes and building views.
+        readers: The executor running queries.
+    """
+    def __init__(self, db, loop=None, **kwargs):
+        """
+        Args:
+            db: A Database, or the name of the database file to open with **kwargs.
+            loop: The event loop to call callbacks on, by default the running loop.
+        """
+        self.db = db if isinstance(db, Database) else Database(db, **kwargs)
+        self.loop = loop
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rsql-writer")
+        self.readers = ThreadPoolExecutor(max_workers=max(1, self.db.max_readers), thread_name_prefix="rsql-reader")
+
+    def get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        return self.loop
+
+    async def run(self, executor, f, *args, **kwargs):
+        """
+        Call f on a thread of executor and return its result, wrapping views in AsyncView.
+
+        Context variables, like the tab id of rsql.html, are passed to the thread, so events of
+        the changes go to the same tab as if f was called on the event loop.
+        """
+        args = [arg.view if isinstance(arg, AsyncView) else arg for arg in args]
+        context = contextvars.copy_context()
+        result = await self.get_loop().run_in_executor(executor, functools.partial(context.run, f, *args, **kwargs))
+        return AsyncView(result, self) if isinstance(result, View) else result
+
+    def handoff(self, cb):
+        """
+        Return a function calling cb on the event loop, from any thread. Coroutines returned by
+        cb are run as tasks.
+        """
+        loop = self.get_loop()
+        def call(*args):
+            result = cb(*args)
+            if inspect.isawaitable(result):
+                loop.create_task(result)
+        return lambda *args: loop.call_soon_threadsafe(call, *args)
+
+    async def table(self, table_name, **kwargs):
+        return await self.run(self.writer, self.db.table, table_name, **kwargs)
+
+    async def execute(self, query, values=None):
+        return await self.run(self.writer, self.db.execute, query, values)
+
+    async def fetchall(self, query, values=None):
+        return await self.run(self.readers, self.db.fetchall, query, values)
+
+    async def fetchone(self, query, values=None):
+        return await self.run(self.readers, self.db.fetchone, query, values)
+
+    async def insert(self, table_name, ignore=False, **values):
+        return await self.run(self.writer, self.db.insert, table_name, ignore=ignore, **values)
+
+    async def update(self, table_name, where, **values):
+        return await self.run(self.writer, self.db.update, table_name, where, **values)
+
+    async def delete(self, table_name, **values):
+        return await self.run(self.writer, self.db.delete, table_name, **values)
+
+    async def insert_many(self, table_name, rows, ignore=False):
+        return await self.run(self.writer, self.db.insert_many, table_name, rows, ignore=ignore)
+
+    async def update_many(self, table_name, updates):
+        return await self.run(self.writer, self.db.update_many, table_name, updates)
+
+    async def delete_many(self, table_name, wheres):
+        return await self.run(self.writer, self.db.delete_many, table_name, wheres)
+
+    async def poll(self):
+        return await self.run(self.writer, self.db.poll)
+
+    async def transaction(self, f, *args, **kwargs):
+        """
+        Call f(*args, **kwargs) in a transaction on the writer thread and return its result.
+
+        A transaction holds the database lock on one thread, so it can't span awaits; its
+        writes are done by the synchronous API inside f.
+        """
+        def run():
+            with self.db.transaction():
+                return f(*args, **kwargs)
+        return await self.run(self.writer, run)
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.get_loop().run_in_executor(None, self.close)
+
+class AsyncView:
+    """
+    A view whose methods are awaited, as returned by AsyncDatabase.
+
+    fetchall and fetchone run on the reader threads, other methods like insert, where, sort
+    or set_offset on the writer thread. The on_* methods register callbacks that are called on
+    the event loop, in the order of the changes. Attributes that aren't methods, like columns,
+    are read from the view directly.
+    """
+    READS = {"fetchall", "fetchone"}
+
+    def __init__(self, view, db):
+        self.view = view
+        self.adb = db
+
+    def __getattr__(self, name):
+        attr = getattr(self.view, name)
+        if not callable(attr):
+            return attr
+        executor = self.adb.readers if name in self.READS else self.adb.writer
+        async def call(*args, **kwargs):
+            return await self.adb.run(executor, attr, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    async def __aiter__(self):
+        for row in await self.adb.run(self.adb.readers, list, self.view):
+            yield row
+
+    def __repr__(self):
+        return f"AsyncView({self.view!r})"
+
+    def on_insert(self, cb):
+        return self.view.on_insert(self.adb.handoff(cb))
+
+    def on_delete(self, cb):
+        return self.view.on_delete(self.adb.handoff(cb))
+
+    def on_update(self, cb):
+        return self.view.on_update(self.adb.handoff(cb))
+
+    def on_reset(self, cb):
+        return self.view.on_reset(self.adb.handoff(cb))
+
+    def on_changes(self, cb):
+        """
+        Call cb(inserts, updates, deletes) on the event loop for each batch of changes of the view.
+        A Sort doesn't pass batches on; its changes are reported by on_insert, on_delete and on_update.
+
+        Returns:
+            function: Removes the callback.
+        """
+        f = self.adb.handoff(cb)
+        self.view.delta_cbs.append(f)
+        return lambda: self.view.delta_cbs.remove(f)
@@ -7,7 +7,7 @@ import threading
 from queue import Queue
 import uvicorn
 from uvicorn.protocols.http.h11_impl import H11Protocol
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import contextvars
 import rsql
 from functools import lru_cache as memoize
@@ -25,16 +25,151 @@ tab_id = contextvars.ContextVar('tab_id', default=0)
 accept_port = contextvars.ContextVar('accept_port', default=None)
 last_tab_id = random_string(10)
 
-# Replace the global queues dict with a thread-safe defaultdict
+# Events queued for a tab are bounded: a tab that falls further behind than this gets a page reload
+# instead of the events it missed.
+MAX_TAB_EVENTS = int(os.getenv("MAX_TAB_EVENTS", "1000"))
+# Seconds a tab without a WebSocket connection is kept after it was last seen
+TAB_TTL = float(os.getenv("TAB_TTL", "300"))
+RELOAD_EVENT = "<template hx-swap-oob='beforeend: body'><script>window.location.reload();</script></template>"
+tab_metrics = {"evicted": 0, "overflows": 0, "dropped_events": 0}
+
+class TabQueue(Queue):
+    """
+    Events for a tab that isn't connected to a WebSocket, at most MAX_TAB_EVENTS of them.
+
+    When more arrive the queued events are replaced by one reloading the page, and later events
+    are dropped, as the reloaded page shows them anyway.
+    """
+    def __init__(self):
+        super().__init__()
+        self.overflowed = False
+
+    def _put(self, event):
+        if self.overflowed:
+            tab_metrics["dropped_events"] += 1
+        elif len(self.queue) >= MAX_TAB_EVENTS:
+            tab_metrics["overflows"] += 1
+            tab_metrics["dropped_events"] += len(self.queue) + 1
+            self.queue.clear()
+            self.queue.append(RELOAD_EVENT)
+            self.overflowed = True
+        else:
+            self.queue.append(event)
+
 from collections import defaultdict
-queues = defaultdict(Queue)
+queues = defaultdict(TabQueue)
 tab_ids_by_port = defaultdict(list)
 objects_per_tab = defaultdict(list)
 routes_per_tab = defaultdict(list)
 destructors_per_tab = defaultdict(list)
 tab_refcounts = defaultdict(int)
 sends = {}
-import asyncio
+outboxes = {}
+last_seen = {}  # tab id -> time of the last request or WebSocket event of the tab
+last_eviction = time.time()
+# Seconds to collect events for a tab before sending them; 0 sends them on the next event loop tick
+OUTBOX_WINDOW = float(os.getenv("OUTBOX_WINDOW", "0"))
+import asyncio, re
+
+_swap_element = re.compile(r'\s*(?:<template>\s*)?<(\w+)([^>]*)>')
+_attribute = re.compile(r'([\w-]+)="([^"]*)"')
+
+def swap_info(html):
+    """
+    Return the hx-swap-oob value and the id of the first element of an event, and the
+    element ids its swap refers to.
+    """
+    match = _swap_element.match(html)
+    if not match:
+        return None, None, ()
+    attributes = dict(_attribute.findall(match.group(2)))
+    swap = attributes.get("hx-swap-oob")
+    return swap, attributes.get("id"), re.findall(r'#([\w-]+)', swap or "")
+
+class Outbox:
+    """
+    Events waiting to be sent to a tab, sent together as one WebSocket frame.
+
+    Events that are superseded before they are sent are dropped: of several elements replacing
+    the element with the same id (hx-swap-oob="true") only the last one is kept, and a row appended
+    to a table and deleted again isn't sent at all.
+    """
+    def __init__(self, send, loop=None, window=None):
+        self.send = send
+        self.loop = loop or asyncio.get_running_loop()
+        self.window = OUTBOX_WINDOW if window is None else window
+        self.lock = threading.Lock()
+        self.events = []
+        self.replaced = {}  # element id -> index of the pending event replacing it
+        self.appended = {}  # element id -> index of the pending event appending it
+        self.scheduled = False
+        self.handle = None
+        self.frames = 0
+        self.overflowed = False
+
+    def put(self, event):
+        html = str(event)
+        swap, element_id, targets = swap_info(html)
+        with self.lock:
+            if self.overflowed:
+                tab_metrics["dropped_events"] += 1
+                return
+            if len(self.events) >= MAX_TAB_EVENTS:
+                # The tab can't keep up, reload it instead of sending what it missed
+                tab_metrics["overflows"] += 1
+                tab_metrics["dropped_events"] += sum(e is not None for e in self.events) + 1
+                self.events, self.replaced, self.appended = [RELOAD_EVENT], {}, {}
+                self.overflowed = True
+                html, swap, targets = None, None, ()
+            for target in targets:
+                # An element that's referred to must be sent
+                self.appended.pop(target, None)
+            if swap == "delete" and element_id in self.appended:
+                self.events[self.appended.pop(element_id)] = None
+                return
+            if swap == "true" and element_id in self.replaced:
+                self.events[self.replaced[element_id]] = None
+            if html is not None:
+                self.events.append(html)
+            if swap == "true":
+                self.replaced[element_id] = len(self.events) - 1
+            elif swap and swap.startswith("beforeend") and element_id is None:
+                appended = re.match(r'\s*(?:<template>\s*)?<tbody[^>]*>\s*<tr id="([^"]*)"', html)
+                if appended:
+                    self.appended[appended.group(1)] = len(self.events) - 1
+            scheduled, self.scheduled = self.scheduled, True
+        if not scheduled:
+            try:
+                running = asyncio.get_running_loop() is self.loop
+            except RuntimeError:
+                running = False
+            if running:
+                self.schedule()
+            else:
+                self.loop.call_soon_threadsafe(self.schedule)
+
+    def schedule(self):
+        if self.window:
+            self.handle = self.loop.call_later(self.window, self.flush)
+        else:
+            self.handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        with self.lock:
+            events = [event for event in self.events if event is not None]
+            self.events, self.replaced, self.appended = [], {}, {}
+            self.scheduled, self.handle = False, None
+        if events:
+            self.frames += 1
+            self.loop.create_task(self.send("".join(events)))
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.cancel()
+            self.events, self.replaced, self.appended = [], {}, {}
+            self.handle = None
+
 def send_event(target_tab_id, event):
     if DEBUG_SEND:
         print(f"send_event target {target_tab_id} from tab {tab_id.get()} event {event}")
@@ -42,14 +177,10 @@ def send_event(target_tab_id, event):
         queues[target_tab_id].put(event)
         if DEBUG_SEND:
             print(f"putting event to queue to current tab {target_tab_id}, now size: {queues[target_tab_id].qsize()}")
-    elif target_tab_id in sends:
+    elif target_tab_id in outboxes:
         if DEBUG_SEND:
             print(f"sending to ws {target_tab_id}")
-        # if event loop is running, run the send in the event loop
-        if asyncio.get_running_loop():
-            asyncio.create_task(sends[target_tab_id](event))
-        else:
-            asyncio.run(sends[target_tab_id](event))
+        outboxes[target_tab_id].put(event)
     else:
         queues[target_tab_id].put(event)
         if DEBUG_SEND:
@@ -85,10 +216,12 @@ def with_sqlx_async(f, app=None):
                 print("******* NOT FOUND TAB ID **********", sqlx_tab_id)
         else:
             print("setting tab id", last_tab_id)
+            evict_idle_tabs(throttle=True)
             tab_id.set(last_tab_id)
             tab_ids_by_port[accept_port.get()].append(last_tab_id)
             tab_refcounts[last_tab_id] += 1
-            queues[last_tab_id] = Queue()
+            queues[last_tab_id] = TabQueue()
+        last_seen[tab_id.get()] = start_time
         # print("args", args, "hx_request", hx_request, "sqlx_tab_id", sqlx_tab_id, "tab_id", tab_id.get(), "app", app, "accept_port", accept_port)
         global global_app
         global_app = app
@@ -110,7 +243,7 @@ def with_sqlx_async(f, app=None):
             q = list(queues[tab_id.get()].queue)
         else:
             q = [Script("htmx.swap('body', '"+html.escape(''.join(list(queues[tab_id.get()].queue)))+"' , {swapStyle: 'none'})")]
-        queues[tab_id.get()] = Queue()
+        queues[tab_id.get()] = TabQueue()
         
         end_time = time.time()
         render_time = (end_time - start_time) * 1000  # Convert to milliseconds
@@ -147,6 +280,48 @@ def with_sqlx_async(f, app=None):
 def with_sqlx(f, app=None):
     return with_sqlx_async(f, app)
 
+# Rows rendered for tables, shared by all tabs showing them. A change is rendered once and only the
+# swap target, which differs between tabs, is patched into the rendered row for each tab.
+ROW_CACHE_SIZE = 1024
+row_cache = OrderedDict()
+row_cache_stats = {"hits": 0, "misses": 0}
+# The number of routes registered by post_method_creator
+registered_routes = 0
+
+def cached_row(key, render):
+    """
+    Return the HTML string of a row, calling render only if it isn't cached under key.
+
+    Rows that register routes when rendered, like rows with onclick callbacks, aren't cached:
+    the routes belong to the rendering tab and are removed with it.
+    """
+    try:
+        tr = row_cache.get(key)
+    except TypeError:
+        # Rows with unhashable values aren't cached
+        return str(render())
+    if tr is not None:
+        row_cache.move_to_end(key)
+        row_cache_stats["hits"] += 1
+        return tr
+    row_cache_stats["misses"] += 1
+    routes = registered_routes
+    tr = str(render())
+    if registered_routes != routes:
+        return tr
+    row_cache[key] = tr
+    if len(row_cache) > ROW_CACHE_SIZE:
+        row_cache.popitem(last=False)
+    return tr
+
+def swap_row(tr, hx_swap_oob):
+    # The rendered <tr> replacing an element
+    return fasttag.HTML(f'<template><tr hx-swap-oob="{hx_swap_oob}"{tr[3:]}</template>')
+
+def insert_row(tr, hx_swap_oob):
+    # The rendered <tr> inserted relative to an element
+    return fasttag.HTML(f'<template><tbody hx-swap-oob="{hx_swap_oob}">{tr}</tbody></template>')
+
 lastid = 0
 def nextid():
     global lastid
@@ -247,6 +422,8 @@ def post_method_creator(app):
         if not rr:
             raise Exception("route not found")
         routes_per_tab[tab_id.get()].append(rr)
+        global registered_routes
+        registered_routes += 1
         return URLM(url, method="POST")
     return decorator
 
@@ -303,8 +480,13 @@ def Form(*args, onsubmit=None, **kwargs):
 
 def table(t, cb=None, header=None, id=None, tab_id0=None, infinite=False, next_button=False, limit=None, order_by=None,
           sortable=False, delete=False, onclick=None):
+    # A table that only shows its rows shares its Sort with the other tabs showing them, one that
+    # changes its own sort or limit gets a Sort of its own
+    mutable = infinite or next_button or sortable
     if ((infinite or next_button) or limit or order_by) and type(t) != rsql.Sort:
-        t = t.sort(limit=(limit or 50), order_by=order_by)
+        t = t.sort(limit=(limit or 50), order_by=order_by, shared=not mutable)
+    elif mutable and type(t) == rsql.Sort and t.shared_key is not None:
+        t = t.parent.sort(t.order_by, t.limit, t.offset, t.overflow_size)
     if not id:
         id = nextid()
 
@@ -338,10 +520,22 @@ def table(t, cb=None, header=None, id=None, tab_id0=None, infinite=False, next_b
             return Tr(r, id=id, hx_swap_oob=hx_swap_oob, onclick=onclick(row) if onclick else None)
         else:
             return Tr(r, id=id, onclick=onclick(row) if onclick else None)
-        
+
+    # Tabs rendering the same view with the same functions share the rendered rows. They are keyed
+    # by their values, as a Row refers to its view, which may be a tab's own, and by the types of
+    # the values, as 1, 1.0 and True are equal but render differently.
+    columns = tuple(t.columns)
+    name = t.name_or_query()
+    def tr(row):
+        return cached_row((cb, columns, name, delete, onclick, tuple((k, type(v), v) for k, v in row.__values__.items())),
+                          lambda: trcbfunc(row, id=f"e{abs(row.__hash__())}"))
+
+    def rows():
+        return [fasttag.HTML(tr(row)) for row in t]
+
     r = fasttag.Table(
         *([Thead(header)] if header else []),
-        Tbody(*[trcbfunc(row, id=f"e{abs(row.__hash__())}") for row in t], id=id))
+        Tbody(*rows(), id=id))
     if tab_id0:
         tid = tab_id0.get()
     else:
@@ -349,21 +543,19 @@ def table(t, cb=None, header=None, id=None, tab_id0=None, infinite=False, next_b
     objects_per_tab[tid].append(t)
     if type(t) == rsql.Sort:
         destructors_per_tab[tid].append(
-            t.on_insert(lambda index, row: send_event(tid, Template(Tbody(trcbfunc(row, id=f"e{abs(row.__hash__())}"),
-                                    hx_swap_oob=(f"afterend: #{id} > :nth-child({index})" if index else f"afterbegin: #{id}"))))))
+            t.on_insert(lambda index, row: send_event(tid, insert_row(tr(row),
+                                    f"afterend: #{id} > :nth-child({index})" if index else f"afterbegin: #{id}"))))
         def sort_on_update(old_index, new_index, _, new):
             if old_index == new_index:
-                send_event(tid, Template(trcbfunc(new, id=f"e{abs(new.__hash__())}", 
-                                              hx_swap_oob=f"outerHTML: #{id} > :nth-child({old_index+1})")))
+                send_event(tid, swap_row(tr(new), f"outerHTML: #{id} > :nth-child({old_index+1})"))
             else:
                 send_event(tid, Template(hx_swap_oob=f"delete: #{id} > :nth-child({old_index+1})"))
-                send_event(tid, Template(Tbody(trcbfunc(new, id=f"e{abs(new.__hash__())}"),
-                                    hx_swap_oob=(f"afterend: #{id} > :nth-child({new_index})" if new_index else f"afterbegin: #{id}"))))
+                send_event(tid, insert_row(tr(new), f"afterend: #{id} > :nth-child({new_index})" if new_index else f"afterbegin: #{id}"))
         destructors_per_tab[tid].append(t.on_update(sort_on_update))
         destructors_per_tab[tid].append(
             t.on_delete(lambda index, row: send_event(tid, Template(hx_swap_oob=f"delete: #{id} > :nth-child({index+1})"))))
         destructors_per_tab[tid].append(
-            t.on_reset(lambda: send_event(tid, Template(Tbody(*[trcbfunc(row, id=f"e{abs(row.__hash__())}") for row in t], hx_swap_oob=f"innerHTML: #{id}")))))
+            t.on_reset(lambda: send_event(tid, Template(Tbody(*rows(), hx_swap_oob=f"innerHTML: #{id}")))))
         if next_button:
             r = r + Button("Next", onclick=lambda: t.set_limit(t.limit+50))
         if infinite:
@@ -371,13 +563,13 @@ def table(t, cb=None, header=None, id=None, tab_id0=None, infinite=False, next_b
             r = r + Script(f"var {id}_height = document.getElementById('{id}').clientHeight/2; var {id}_loading=false; document.addEventListener('scroll', function(evt) {{ if (!{id}_loading) if(window.scrollY+window.innerHeight > document.getElementById('{id}').clientHeight + document.getElementById('{id}').scrollTop - {id}_height) {{ {id}_loading = true; htmx.ajax('POST', '{load_more}', {{target: '#{id}'}}).then(function(data) {{ {id}_loading = false;}});}};}})")
     else:
         destructors_per_tab[tid].append(
-            t.on_insert(lambda row: send_event(tid, Template(Tbody(trcbfunc(row, id=f"e{abs(row.__hash__())}"), hx_swap_oob=f"beforeend:#{id}")))))
+            t.on_insert(lambda row: send_event(tid, insert_row(tr(row), f"beforeend:#{id}"))))
         destructors_per_tab[tid].append(
             t.on_delete(lambda row: send_event(tid, Template(Tr(id=f"e{abs(row.__hash__())}", hx_swap_oob="delete")))))
         destructors_per_tab[tid].append(
-            t.on_update(lambda old, new: send_event(tid, Template(trcbfunc(new, id=f"e{abs(new.__hash__())}", hx_swap_oob=f"outerHTML: #e{abs(old.__hash__())}")))))
+            t.on_update(lambda old, new: send_event(tid, swap_row(tr(new), f"outerHTML: #e{abs(old.__hash__())}"))))
         destructors_per_tab[tid].append(
-            t.on_reset(lambda: send_event(tid, Template(Tbody(*[trcbfunc(row, id=f"e{abs(row.__hash__())}") for row in t], hx_swap_oob=f"innerHTML: #{id}")))))
+            t.on_reset(lambda: send_event(tid, Template(Tbody(*rows(), hx_swap_oob=f"innerHTML: #{id}")))))
     return r
 
 class ServerTimingMiddleware:
@@ -396,6 +588,11 @@ def remove_tab(tid):
     print("removing tab", tid)
     if tid in queues:
         del queues[tid]
+    if tid in outboxes:
+        outboxes.pop(tid).close()
+    sends.pop(tid, None)
+    last_seen.pop(tid, None)
+    tab_refcounts.pop(tid, None)
     if tid in objects_per_tab:
         del objects_per_tab[tid]
     if tid in routes_per_tab:
@@ -407,7 +604,44 @@ def remove_tab(tid):
         for d in destructors_per_tab[tid]:
             d()
         del destructors_per_tab[tid]
-        
+
+def evict_idle_tabs(now=None, throttle=False):
+    """
+    Remove the tabs without a WebSocket connection that weren't seen for TAB_TTL seconds, like
+    tabs whose page was closed before it connected. With throttle the tabs are only checked
+    every tenth of TAB_TTL. Returns the number of evicted tabs.
+    """
+    global last_eviction
+    now = time.time() if now is None else now
+    if throttle and now - last_eviction < TAB_TTL / 10:
+        return 0
+    last_eviction = now
+    idle = [tid for tid, seen in list(last_seen.items()) if tid not in outboxes and now - seen > TAB_TTL]
+    for tid in idle:
+        remove_tab(tid)
+    tab_metrics["evicted"] += len(idle)
+    return len(idle)
+
+def tab_stats():
+    """
+    Return the number of tabs and connected tabs, the events queued for them, their size in
+    bytes and the longest queue, the objects kept for tabs, and the evicted tabs, overflowed
+    queues and dropped events so far.
+    """
+    pending = [list(q.queue) for q in list(queues.values())]
+    for outbox in list(outboxes.values()):
+        with outbox.lock:
+            pending.append([e for e in outbox.events if e is not None])
+    return {
+        "tabs": len(set(queues) | set(outboxes)),
+        "connected": len(outboxes),
+        "queued_events": sum(len(events) for events in pending),
+        "queued_bytes": sum(len(str(e)) for events in pending for e in events),
+        "max_queue_depth": max((len(events) for events in pending), default=0),
+        "objects": sum(len(objects) for objects in list(objects_per_tab.values())),
+        **tab_metrics,
+    }
+
 
 import asyncio
 def rsql_html_app(live=True, debug=True, db=None, hdrs=static_hdrs, default_hdrs=False, before=None, pico=False, **kwargs):
@@ -428,19 +662,26 @@ def rsql_html_app(live=True, debug=True, db=None, hdrs=static_hdrs, default_hdrs
             await send("<template hx-swap-oob='beforeend: body'><script>window.location.reload();</script></template>")
             return
         tab_refcounts[tid] += 1
+        last_seen[tid] = time.time()
         sends[tid] = send
+        outboxes[tid] = Outbox(send)
         print(f"ws connected with tab id {tid}, refcount {tab_refcounts[tid]}, sending {queues[tid].qsize()} events")
         # foreach in queues, send
         while not queues[tid].empty():
             event = queues[tid].get()
             if DEBUG_SEND:
                 print("sending event", event, "on ws connect")
-            await send(event)
+            outboxes[tid].put(event)
 
     async def on_disconn(ws, send):
         tid = (ws.url.path.split('/')[-1])
         if tid in sends:
             del sends[tid]
+        if tid in outboxes:
+            outboxes.pop(tid).close()
+        if tid not in tab_refcounts:
+            return
+        last_seen[tid] = time.time()
         tab_refcounts[tid] -= 1
         print(f"ws disconnected with tab id {tid}, refcount {tab_refcounts[tid]}")
         if tab_refcounts[tid] == 0:
@@ -462,6 +703,9 @@ class LoggingProtocol(H11Protocol):
         super().connection_lost(exc)
         print("Connection closed from", self.client, ", closing ", len(tab_ids_by_port[self.client[1]]), "tabs")
         for tid in tab_ids_by_port[self.client[1]]:
+            if tid not in tab_refcounts:
+                # Already evicted
+                continue
             tab_refcounts[tid] -= 1
             print(f"closing tab {tid} if refcount is 0 because connection closed {self.client}, refcount {tab_refcounts[tid]}")
             if tab_refcounts[tid] == 0:
@@ -64,14 +64,18 @@ Constants:
 # - query editor
 # - schema editor
 # - Python vs Ruby comparision (ruby 2x slower, probably a bit nicer API, but not that much difference. insert/delete much slower for some reason, also need prepare statement)
-import os, threading, traceback
+import math, os, re, threading, traceback, collections, contextlib, functools, itertools
 from urllib.parse import urlencode
 
 DEBUG_SQL = os.environ.get('DEBUG_SQL', 'False').lower() in ['true', '1', 'yes', 'on']
 DEBUG_VIEWS = os.environ.get('DEBUG_VIEWS', 'False').lower() in ['true', '1', 'yes', 'on']
 
-import sqlite3, importlib, sys, time, typing, weakref
+import queue, sqlite3, importlib, sys, time, typing, weakref
 from typing import Optional, Union, Type
+from .sqlexpr import collation_function, compile_order_by, compile_expression, compile_predicate, parse_order_by, sql_compare, type_affinity, SQLFallback
+from .sortedrows import SortedRows
+from .aggregates import (parse_aggregate, register_functions, CountAll, Count, CountDistinct, Extreme, GroupConcat, Sum,
+                         Variance, ROW_COUNT, SQL_VALUES)
 def reload(): importlib.reload(sys.modules[__name__])
 def timed(f):
     start = time.time()
@@ -138,7 +142,77 @@ def execute(cursor, query, params=None):
     except Exception as e:
         raise Exception(f"Error executing query: {query} with params {params}") from e
 
-    
+def executemany(cursor, query, params):
+    """
+    Execute a SQL query on the database once for each parameter tuple.
+
+    Args:
+        cursor: The cursor object.
+        query (str): The SQL query to execute.
+        params (list): A list of parameter tuples.
+
+    Returns:
+        cursor: The cursor object after executing the query.
+    """
+    if DEBUG_SQL:
+        print(query, f"({len(params)} rows)")
+    try:
+        return cursor.executemany(query, params)
+    except Exception as e:
+        raise Exception(f"Error executing query: {query} for {len(params)} rows") from e
+
+def coalesce_changes(changes):
+    """
+    Reduce a list of row changes to their net effect.
+
+    Rows are identified by their values: an insert followed by a delete of the same row
+    cancels out, and a chain of updates of a row becomes a single update.
+
+    Args:
+        changes (list): (action, old, new) tuples, where action is 1 (insert), 2 (update) or 3 (delete),
+            and old and new are tuples of column values, or None.
+
+    Returns:
+        list: The net changes, in the order they were first made.
+    """
+    net = []
+    current = {}  # row values -> positions in net of the changes that produced them
+    deleted = {}  # row values -> positions in net of the deletes
+    for action, old, new in changes:
+        if action == 2 and old == new:
+            continue  # UPDATE triggers also fire when no value changed
+        if action != 1 and current.get(old):
+            i = current[old].pop()
+            prev_action, prev_old, _ = net[i]
+            if action == 3:
+                if prev_action == 1:
+                    net[i] = None
+                else:
+                    net[i] = (3, prev_old, None)
+                    deleted.setdefault(prev_old, []).append(i)
+            elif prev_action == 2 and prev_old == new:
+                net[i] = None
+            else:
+                net[i] = (prev_action, prev_old, new)
+                current.setdefault(new, []).append(i)
+            continue
+        if action == 1 and deleted.get(new):
+            net[deleted[new].pop()] = None
+            continue
+        net.append((action, old, new))
+        if action == 3:
+            deleted.setdefault(old, []).append(len(net) - 1)
+        else:
+            current.setdefault(new, []).append(len(net) - 1)
+    return [change for change in net if change is not None]
+
+def updated_row(columns, row, values):
+    """
+    Return row with the columns in values replaced, matching column names case-insensitively.
+    """
+    values = {k.upper(): v for k, v in values.items()}
+    return tuple(values.get(col.upper(), v) for col, v in zip(columns, row))
+
 def create_where_null_clause(columns, values):
     """
     Create a WHERE clause for NULL values.
@@ -150,17 +224,30 @@ def create_where_null_clause(columns, values):
     Returns:
         tuple: A tuple containing the WHERE clause and the remaining values.
     """
-    where_conditions = []
-    remaining_values = []
-    for col, val in zip(columns, values):
-        if val is None:
-            where_conditions.append(f'{col} IS NULL')
-        else:
-            where_conditions.append(f'{col} = ?')
-            remaining_values.append(val)
-    
-    where_clause = ' AND '.join(where_conditions) if where_conditions else ''
-    return f" WHERE {where_clause}" if where_clause else '', tuple(remaining_values)
+    values = tuple(values)
+    return where_null_clause(tuple(columns), tuple(val is None for val in values)), tuple(val for val in values if val is not None)
+
+# Generated statements are memoized by their shape, so building them is a lookup, and the same
+# string is passed to sqlite3 each time, which finds it in its statement cache
+@functools.lru_cache(maxsize=4096)
+def where_null_clause(columns, nulls):
+    where_clause = ' AND '.join(f'{col} IS NULL' if null else f'{col} = ?' for col, null in zip(columns, nulls))
+    return f" WHERE {where_clause}" if where_clause else ''
+
+@functools.lru_cache(maxsize=4096)
+def insert_statement(table_name, columns, ignore=False):
+    return f"INSERT {'OR IGNORE' if ignore else ''} INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['?' for _ in columns])})"
+
+@functools.lru_cache(maxsize=4096)
+def update_statement(table_name, columns, where_clause):
+    return f"UPDATE {table_name} SET {', '.join([f'{k}=?' for k in columns])} {where_clause};"
+
+# The number of prepared statements each connection keeps; views use a few each
+CACHED_STATEMENTS = 1024
+# The number of drained changes after which they are deleted from the changelog
+CHANGELOG_TRUNCATE = 1024
+# The number of changes a persistent changelog keeps for other connections that didn't read them yet
+CHANGELOG_RETAIN = 65536
 
 
 def sqlrepr(obj):
@@ -362,6 +449,7 @@ class View:
         update_cbs: List of callbacks for update events.
         insert_cbs: List of callbacks for insert events.
         delete_cbs: List of callbacks for delete events.
+        delta_cbs: List of callbacks called with (inserts, updates, deletes) for a batch of changes.
         reset_cbs: List of callbacks for reset events.
         unique_keys: List of unique keys for the table.
         is_bool: Dictionary indicating if a column is a boolean.
@@ -379,19 +467,18 @@ class View:
         self.update_cbs = []
         self.insert_cbs = []
         self.delete_cbs = []
+        self.delta_cbs = []
         self.reset_cbs = []
         self.unique_keys = []
         self.is_bool = None
         self.row_table = row_table
+        # The key of the view in the database's registry of shared views
+        self.shared_key = None
+        # The parameters of query, in the order of their placeholders
+        self.params = ()
         if hasattr(self, 'parent'):
-            self.update_cbs_ref = methodref(self.call_update_cbs)
-            self.parent.update_cbs.append(self.update_cbs_ref)
-            self.insert_cbs_ref = methodref(self.call_insert_cbs)
-            self.parent.insert_cbs.append(self.insert_cbs_ref)
-            self.delete_cbs_ref = methodref(self.call_delete_cbs)
-            self.parent.delete_cbs.append(self.delete_cbs_ref)
-            self.reset_cbs_ref = methodref(self.call_reset_cbs)
-            self.parent.reset_cbs.append(self.reset_cbs_ref)
+            self.delta_cbs_ref = db.listen(self.parent.delta_cbs, methodref(self.on_delta))
+            self.reset_cbs_ref = db.listen(self.parent.reset_cbs, methodref(self.call_reset_cbs))
             self.name = self.parent.name
 
     
@@ -435,6 +522,37 @@ class View:
         self.update_cbs.pop()
         self.delete_cbs.pop()
 
+    def column_collation(self, col):
+        """
+        Return the collation SQLite uses when sorting a column of the view.
+
+        Args:
+            col (str): The column name.
+
+        Returns:
+            str or None: The collation name, or None if it isn't known.
+        """
+        parent = getattr(self, 'parent', None)
+        if parent is not None and col in parent.columns:
+            return parent.column_collation(col)
+        return None
+
+    def column_affinity(self, col):
+        """
+        Return the affinity SQLite applies to a column of the view in comparisons.
+
+        Args:
+            col (str): The column name.
+
+        Returns:
+            str or None: INTEGER, TEXT, BLOB, REAL, NUMERIC or NONE for no affinity,
+                or None if it isn't known.
+        """
+        parent = getattr(self, 'parent', None)
+        if parent is not None and col in parent.columns:
+            return parent.column_affinity(col)
+        return None
+
     def maybe_to_bool(self, values):
         return [bool(v) if self.is_bool and self.is_bool[col] and (v == 1 or v == 0) else v for col, v in enumerate(values)]
 
@@ -459,7 +577,7 @@ class View:
                 {col: val for col, val in zip(self.columns, self.maybe_to_bool(values))},
                 self
             ),
-            self.db.execute(self.query)
+            self.db.fetchall(self.query, self.params)
         )
 
     def fetchall(self):
@@ -469,7 +587,17 @@ class View:
         Returns:
             list: A list of rows from the view.
         """
-        return self.db.execute(self.query)
+        return self.db.fetchall(self.query, self.params)
+
+    def shown_row(self, row):
+        """
+        Fetch the row of the view equal to row, comparing with the collations of the columns.
+
+        Returns:
+            tuple or None: The row as the view shows it, for example 'A' for 'a' with NOCASE.
+        """
+        where_clause, values = create_where_null_clause(self.columns, row)
+        return self.db.fetchone(f"SELECT * FROM ({self.query}){where_clause}", self.params + values)
     
     def fetchone(self, **values):
         """
@@ -481,8 +609,8 @@ class View:
         Returns:
             Row: The row matching the given values, or None if no row is found.
         """
-        query = f"SELECT * FROM ({self.query}) {'WHERE' if values else ''} {', '.join([f'{k}=?' for k in values])}"
-        row = self.db.fetchone(query, tuple(values.values()))
+        query = f"SELECT * FROM ({self.query}) {'WHERE' if values else ''} {' AND '.join([f'{k}=?' for k in values])}"
+        row = self.db.fetchone(query, self.params + tuple(values.values()))
         return Row({col: val for col, val in zip(self.columns, self.maybe_to_bool(row))}, self) if row else None
     
     def __repr__(self):
@@ -491,17 +619,44 @@ class View:
     def __str__(self):
         return f"<{type(self).__name__}({self.columns}) {self.query}>"
     
+    def on_delta(self, inserts, updates, deletes):
+        """
+        Process a batch of changes of the parent view.
+
+        Args:
+            inserts (list): The inserted rows, as dicts.
+            updates (list): (old, new) pairs of the updated rows.
+            deletes (list): The deleted rows, as dicts.
+        """
+        self.emit_delta(inserts, updates, deletes)
+
+    def emit_delta(self, inserts, updates, deletes):
+        """
+        Send a batch of changes of this view to the child views, then to the per-row callbacks.
+        """
+        if not inserts and not updates and not deletes:
+            return
+        for cb in self.delta_cbs:
+            cb(inserts, updates, deletes)
+        for values in deletes:
+            for cb in self.delete_cbs:
+                cb(values)
+        for old, new in updates:
+            for cb in self.update_cbs:
+                cb(old, new)
+        for values in inserts:
+            for cb in self.insert_cbs:
+                cb(values)
+
+    # Single row adapters for on_delta
     def call_insert_cbs(self, values):
-        for cb in self.insert_cbs:
-            cb(values)
+        self.on_delta([values], [], [])
     
     def call_update_cbs(self, old, new):
-        for cb in self.update_cbs:
-            cb(old, new)
+        self.on_delta([], [(old, new)], [])
     
     def call_delete_cbs(self, values):
-        for cb in self.delete_cbs:
-            cb(values)
+        self.on_delta([], [], [values])
 
     def call_reset_cbs(self):
         self.reset()
@@ -510,12 +665,12 @@ class View:
 
     def __del__(self):
         if hasattr(self, 'parent'):
-            self.parent.update_cbs.remove(self.update_cbs_ref)
-            self.parent.insert_cbs.remove(self.insert_cbs_ref)
-            self.parent.delete_cbs.remove(self.delete_cbs_ref)
+            self.parent.delta_cbs.remove(self.delta_cbs_ref)
             self.parent.reset_cbs.remove(self.reset_cbs_ref)
     
-    def select(self, **colexprs):
+    # The builders below take shared=True to reuse an identical live view, see Database.shared_view
+
+    def select(self, shared=False, **colexprs):
         """
         Create a new Select object with the current view as the parent.
 
@@ -525,13 +680,13 @@ class View:
         Returns:
             Select: A new Select object.
         """
-        return Select(self, **colexprs)
+        return self.db.build_view(Select, shared, self, **colexprs)
 
-    def where(self, main=None, **where):
+    def where(self, main=None, shared=False, **where):
         """
         Create a new WHERE clause with main and additional column conditions.
         """
-        return Where(self, main, **where)
+        return self.db.build_view(Where, shared, self, main, **where)
     
     def get(self, id=None, **values):
         if id:
@@ -539,26 +694,30 @@ class View:
         else:
             return self.where(**values).only()
     
-    def union(self, parent2):
+    def union(self, parent2, intern_strings=False, shared=False):
         """
         Create a UNION query with the current view and another view.
+
+        Args:
+            intern_strings (bool): Intern the strings of the counted rows, saving memory when
+                many rows share values.
         """
-        return SQLUnion(self, parent2)
+        return self.db.build_view(SQLUnion, shared, self, parent2, intern_strings)
     
-    def union_all(self, parent2):
+    def union_all(self, parent2, shared=False):
         """
         Create a UNION ALL query with the current view and another view.
         """
-        return UnionAll(self, parent2)
+        return self.db.build_view(UnionAll, shared, self, parent2)
     
-    def join(self, parent2, left_outer=False, right_outer=False, left_name='a', right_name='b', **on):
-        return Join(self, parent2, left_outer, right_outer, left_name, right_name, **on)
+    def join(self, parent2, left_outer=False, right_outer=False, left_name='a', right_name='b', index_budget=None, shared=False, **on):
+        return self.db.build_view(Join, shared, self, parent2, left_outer, right_outer, left_name, right_name, index_budget, **on)
     
-    def distinct(self):
-        return Distinct(self)
+    def distinct(self, intern_strings=False, shared=False):
+        return self.db.build_view(Distinct, shared, self, intern_strings)
     
-    def group_by(self, *columns, **aggregations):
-        return GroupBy(self, *columns, **aggregations)
+    def group_by(self, *columns, minmax_budget=None, having=None, shared=False, **aggregations):
+        return self.db.build_view(GroupBy, shared, self, *columns, minmax_budget=minmax_budget, having=having, **aggregations)
     
     def count(self):
         return ColumnValue(self.group_by(count="COUNT(*)"), "count")
@@ -578,8 +737,10 @@ class View:
     def max(self, column):
         return ColumnValue(self.group_by(max=f"MAX({column})"), "max")
     
-    def sort(self, order_by=None, limit=None, offset=None):
-        return Sort(self, order_by, limit, offset)
+    def sort(self, order_by=None, limit=None, offset=None, overflow=16, shared=False):
+        if isinstance(order_by, list):
+            order_by = tuple(order_by)
+        return self.db.build_view(Sort, shared, self, order_by, limit, offset, overflow)
 
     # Reset is called when a parent query has changed. Columns can't change for now.
     def reset(self):
@@ -618,7 +779,7 @@ class View:
         # columns
         print(self.columns)
         print("--------------------------------")
-        for row in self.db.execute(self.query):
+        for row in self.db.fetchall(self.query, self.params):
             print(row)
         print("--------------------------------")
 
@@ -643,19 +804,101 @@ class View:
 
 EXPERIMENTAL_OUTER_JOIN = True
 
+# Maximum number of rows a Join keeps in memory for each of its inputs
+JOIN_INDEX_BUDGET = 100000
+
+def view_ancestors(view):
+    """
+    Return the views view is computed from, directly or indirectly.
+    """
+    ancestors, stack = [], [view]
+    while stack:
+        current = stack.pop()
+        for parent in (getattr(current, "parent", None), getattr(current, "parent2", None)):
+            if parent is not None and parent not in ancestors:
+                ancestors.append(parent)
+                stack.append(parent)
+    return ancestors
+
+class JoinIndex:
+    """
+    The rows of one input of a Join, grouped by the values of the join columns.
+
+    Rows with a NULL join value are not stored, as they never match.
+
+    Attributes:
+        columns (list): The columns of the input.
+        rows (dict): For each key, a dictionary from row tuple to its number of copies.
+        size (int): The number of stored rows.
+    """
+    def __init__(self, columns, key_columns, rows=()):
+        self.columns = columns
+        self.positions = [columns.index(col) for col in key_columns]
+        self.rows = {}
+        self.size = 0
+        for row in rows:
+            self.add(tuple(row))
+
+    def key(self, row):
+        return tuple(row[i] for i in self.positions)
+
+    def add(self, row):
+        key = self.key(row)
+        if None in key:
+            return
+        counts = self.rows.setdefault(key, {})
+        counts[row] = counts.get(row, 0) + 1
+        self.size += 1
+
+    def remove(self, row):
+        """
+        Remove a row, returning False if it wasn't stored.
+        """
+        key = self.key(row)
+        if None in key:
+            return True
+        counts = self.rows.get(key)
+        if not counts or row not in counts:
+            return False
+        if counts[row] == 1:
+            del counts[row]
+            if not counts:
+                del self.rows[key]
+        else:
+            counts[row] -= 1
+        self.size -= 1
+        return True
+
+    def matches(self, key):
+        counts = self.rows.get(key)
+        if not counts:
+            return []
+        return [row for row, count in counts.items() for _ in range(count)]
+
+    def apply(self, inserts, updates, deletes):
+        """
+        Apply a delta of row dicts, returning False if a removed row wasn't stored.
+        """
+        row = lambda values: tuple(values[col] for col in self.columns)
+        ok = True
+        for values in deletes:
+            ok = self.remove(row(values)) and ok
+        for old, new in updates:
+            ok = self.remove(row(old)) and ok
+            self.add(row(new))
+        for values in inserts:
+            self.add(row(values))
+        return ok
+
 class Join(View):
-    def __init__(self, parent, parent2, left_outer=False, right_outer=False, left_name='a', right_name='b', **on):
+    def __init__(self, parent, parent2, left_outer=False, right_outer=False, left_name='a', right_name='b', index_budget=None, **on):
         if left_outer and right_outer and not EXPERIMENTAL_OUTER_JOIN:
             raise Exception("Full outer join not supported yet. Set EXPERIMENTAL_OUTER_JOIN to True to enable it, but it's still buggy.")
         self.parent = parent
         self.parent2 = parent2
         super().__init__(parent.db, row_table=parent.row_table)
-        self.update_cbs_ref2 = methodref(self.call_update_cbs2)
-        self.insert_cbs_ref2 = methodref(self.call_insert_cbs2)
-        self.delete_cbs_ref2 = methodref(self.call_delete_cbs2)
-        parent2.update_cbs.append(self.update_cbs_ref2)
-        parent2.insert_cbs.append(self.insert_cbs_ref2)
-        parent2.delete_cbs.append(self.delete_cbs_ref2)
+        self.delta_cbs_ref2 = self.db.listen(parent2.delta_cbs, methodref(self.on_delta2))
+        self.db.listen(parent2.reset_cbs, self.reset_cbs_ref)
         on_values = [x.upper() for x in on.values()]
         right_prefix = f"{right_name}." if right_name else ""
         left_prefix = f"{left_name}." if left_name else ""
@@ -676,6 +919,8 @@ class Join(View):
                   i += 1
                 self.columns.append(f"{col}{i if i > 1 else ''}")
         self.columns_with_selectors = [f"{selector} AS {col}" for selector, col in zip(self.column_selectors, self.columns)]
+        right_columns = parent2.columns if left_outer or right_outer else [x for x in parent2.columns if x.upper() not in on_values]
+        self.column_sources = [(parent, col) for col in parent.columns] + [(parent2, col) for col in right_columns]
         self.left_outer = left_outer
         self.right_outer = right_outer
         self.on = on
@@ -683,6 +928,8 @@ class Join(View):
         self.right_prefix = right_prefix
         self.left_name = left_name
         self.right_name = right_name
+        self.index_budget = JOIN_INDEX_BUDGET if index_budget is None else index_budget
+        self.lookup_counts = {"hash": 0, "sql": 0}
         self.reset()
     
     def reset(self):
@@ -692,41 +939,343 @@ class Join(View):
                     "LEFT OUTER JOIN" if self.left_outer else ("RIGHT OUTER JOIN" if self.right_outer else "JOIN"))
         on_clause = ""
         if self.on:
-            on_clause = f"ON {', '.join([f'{self.left_prefix}{k}={self.right_prefix}{v}' for k, v in self.on.items()])}"
+            on_clause = f"ON {' AND '.join([f'{self.left_prefix}{k}={self.right_prefix}{v}' for k, v in self.on.items()])}"
 
         self.query = f"SELECT {', '.join(self.columns_with_selectors)} FROM ({self.parent.query}) {as_left_name} {join_type} ({self.parent2.query}) {as_right_name} {on_clause}"
+        self.params = self.parent.params + self.parent2.params
+        self.build_indexes()
+
+    def build_indexes(self):
+        """
+        Materialize hash indexes of both inputs keyed by the join columns.
+
+        An input is indexed if it has at most index_budget rows and its join values compare
+        like Python values; otherwise matching rows are looked up with SQL. Only inner joins
+        are indexed.
+        """
+        self.left_index = self.right_index = None
+        if self.left_outer or self.right_outer or not self.hashable_keys():
+            return
+        self.left_index = self.build_index(self.parent, list(self.on.keys()))
+        self.right_index = self.build_index(self.parent2, list(self.on.values()))
+
+    def build_index(self, view, columns):
+        rows = self.db.fetchall(f"SELECT * FROM ({view.query}) LIMIT ?", view.params + (self.index_budget + 1,))
+        if len(rows) > self.index_budget:
+            return None
+        return JoinIndex(view.columns, columns, rows)
+
+    def hashable_keys(self):
+        # SQL equality matches Python equality only without collations and affinity conversions
+        numeric = ("INTEGER", "REAL", "NUMERIC")
+        for k, v in self.on.items():
+            if self.parent.column_collation(k) != "BINARY" or self.parent2.column_collation(v) != "BINARY":
+                return False
+            a, b = self.parent.column_affinity(k), self.parent2.column_affinity(v)
+            if a is None or b is None or (a in numeric) != (b in numeric):
+                return False
+            if {a, b} == {"TEXT", "NONE"}:
+                return False
+        return True
+
+    def maintain_index(self, side, inserts, updates, deletes):
+        index = getattr(self, side)
+        if index is None:
+            return
+        if not index.apply(inserts, updates, deletes) or index.size > self.index_budget:
+            # Out of budget, or out of sync with the input: fall back to SQL
+            setattr(self, side, None)
+
+    def find_matches(self, index, view, columns, keys):
+        if index is None:
+            self.lookup_counts["sql"] += len(keys)
+            return self.lookup(view, columns, keys)
+        self.lookup_counts["hash"] += len(keys)
+        return {key: index.matches(key) for key in keys}
+
+    def stats(self):
+        """
+        Return how the join finds matching rows.
+
+        Returns:
+            dict: The strategy of each input ("hash" or "sql"), the number of indexed rows,
+                and how many keys were looked up with each strategy.
+        """
+        return {
+            "left": "sql" if self.left_index is None else "hash",
+            "right": "sql" if self.right_index is None else "hash",
+            "left_rows": 0 if self.left_index is None else self.left_index.size,
+            "right_rows": 0 if self.right_index is None else self.right_index.size,
+            "hash_lookups": self.lookup_counts["hash"],
+            "sql_lookups": self.lookup_counts["sql"],
+        }
     
+    def joined(self, left, right):
+        """
+        Combine a row of parent and a row of parent2, given as value lists, into a row of the join.
+        """
+        if self.left_outer or self.right_outer:
+            values = list(left) + list(right)
+        else:
+            values = list(left) + [right[i] for i, col in enumerate(self.parent2.columns) if col not in self.on.values()]
+        return {col: values[i] for i, col in enumerate(self.columns)}
+
+    def lookup(self, view, columns, keys):
+        """
+        Find the rows of view whose columns are equal to each key, with one query per chunk of keys.
+
+        The keys are joined to the view in SQL, so values are compared like in the join itself.
+
+        Returns:
+            dict: The list of matching rows of view for each key.
+        """
+        matches = {key: [] for key in keys}
+        keys = list(matches)
+        if not keys:
+            return matches
+        if not columns:
+            matches[()] = self.db.fetchall(view.query, view.params)
+            return matches
+        key_columns = [f"__k{i}__" for i in range(len(columns))]
+        on_clause = " AND ".join([f"__view__.{col} = __keys__.{key_col}" for col, key_col in zip(columns, key_columns)])
+        row_placeholders = f"({', '.join(['?'] * (len(columns) + 1))})"
+        keys_per_statement = max(1, MAX_SQL_VARIABLES // (len(columns) + 1))
+        for start in range(0, len(keys), keys_per_statement):
+            chunk = keys[start:start + keys_per_statement]
+            query = (f"WITH __keys__(__i__, {', '.join(key_columns)}) AS (VALUES {', '.join([row_placeholders] * len(chunk))}) "
+                     f"SELECT __keys__.__i__, __view__.* FROM __keys__ JOIN ({view.query}) AS __view__ ON {on_clause}")
+            params = tuple(v for i, key in enumerate(chunk, start) for v in (i, *key)) + view.params
+            for row in self.db.fetchall(query, params):
+                matches[keys[row[0]]].append(row[1:])
+        return matches
+
+    # When both inputs change in one batch, the pairs of rows of the two deltas must be joined
+    # once. Hash indexes are maintained delta by delta, so a delta matched with an index only
+    # sees the deltas of the other input that came before it, but SQL already sees every change
+    # of the batch. So the deltas matched with SQL are kept for the batch, and the deltas of the
+    # other input that arrive later don't match them again. The deltas in between can contain
+    # pairs that are undone later, so with SQL lookups the join sends the net changes when the
+    # batch is done.
+
+    def batch_deltas(self):
+        """
+        Return the rows of both inputs, as (sign, row) lists, that were matched with SQL earlier
+        in the current batch, or None if the join was reloaded in this batch and the remaining
+        deltas are already part of it.
+        """
+        new = lambda: {"left": [], "right": [], "sql": False, "pending": [], "reset": False}
+        if self.db.batch_state is None:
+            return new()
+        batch = self.db.batch_state.setdefault(self, new())
+        return None if batch["reset"] else batch
+
+    def send_delta(self, batch, inserts, updates, deletes):
+        if batch["sql"] and self.db.batch_state is not None:
+            batch["pending"].append((inserts, updates, deletes))
+        else:
+            self.emit_delta(inserts, updates, deletes)
+
+    def flush_batch(self, batch):
+        """
+        Emit the deltas held back in the batch, as one delta of their net changes.
+        """
+        pending, batch["pending"] = batch["pending"], []
+        if len(pending) == 1:
+            self.emit_delta(*pending[0])
+            return
+        counts, rows = collections.Counter(), {}
+        for inserts, updates, deletes in pending:
+            for sign, changed in [(-1, deletes), (-1, [old for old, _ in updates]), (1, [new for _, new in updates]), (1, inserts)]:
+                for values in changed:
+                    row = tuple(values[col] for col in self.columns)
+                    counts[row] += sign
+                    rows[row] = values
+        self.emit_delta([rows[row] for row, count in counts.items() for _ in range(count)], [],
+                        [rows[row] for row, count in counts.items() for _ in range(-count)])
+
+    def signed_rows(self, row, inserts, updates, deletes):
+        return ([(-1, tuple(row(values))) for values in deletes] + [(-1, tuple(row(old))) for old, _ in updates] +
+                [(1, tuple(row(new))) for _, new in updates] + [(1, tuple(row(values))) for values in inserts])
+
+    def key_predicate(self):
+        """
+        Compile whether a row of parent and one of parent2 match, with SQLite's comparison
+        rules, over a dict of their join values as left{i} and right{i}.
+        """
+        if not self.on:
+            return lambda values: True
+        names = [f"left{i}" for i in range(len(self.on))] + [f"right{i}" for i in range(len(self.on))]
+        sources = [(self.parent, k) for k in self.on.keys()] + [(self.parent2, v) for v in self.on.values()]
+        sources = dict(zip(names, sources))
+        return compile_predicate(" AND ".join([f"left{i} = right{i}" for i in range(len(self.on))]), names,
+                                 lambda name: sources[name][0].column_affinity(sources[name][1]),
+                                 lambda name: sources[name][0].column_collation(sources[name][1]))
+
+    def exclude_deltas(self, matches, deltas, left):
+        """
+        Undo deltas of one input, left or right, in the rows of that input matching each key of
+        the other one: rows they added count once less, rows they removed once more.
+
+        Returns:
+            dict: The (count, row) pairs for each key, where the count can be negative, or None
+                if the matches can't be computed like SQLite would; then the join is reloaded.
+        """
+        predicate = self.key_predicate()
+        columns = self.parent.columns if left else self.parent2.columns
+        positions = [columns.index(col) for col in (self.on.keys() if left else self.on.values())]
+        names = [f"left{i}" for i in range(len(self.on))], [f"right{i}" for i in range(len(self.on))]
+        own_names, other_names = (names[1], names[0]) if left else names
+        counted = {}
+        try:
+            if predicate is None:
+                raise SQLFallback()
+            for key, rows in matches.items():
+                counts = collections.Counter(rows)
+                for sign, row in deltas:
+                    if predicate({**dict(zip(own_names, key)), **dict(zip(other_names, [row[i] for i in positions]))}):
+                        counts[row] -= sign
+                counted[key] = [(count, row) for row, count in counts.items() if count]
+        except SQLFallback:
+            batch = self.db.batch_state[self]
+            batch["reset"] = True
+            batch["pending"] = []
+            self.call_reset_cbs()
+            return None
+        return counted
+
+    def counted_delta(self, matches, key, joined, inserts, updates, deletes):
+        """
+        Join a delta with counted matches from exclude_deltas, updates as deletes and inserts.
+        """
+        inserted, deleted = [], []
+        for sign, changed in [(-1, deletes + [old for old, _ in updates]), (1, inserts + [new for _, new in updates])]:
+            for values in changed:
+                for count, match in matches[key(values)]:
+                    (inserted if sign * count > 0 else deleted).extend([joined(values, match)] * abs(count))
+        return inserted, [], deleted
+
+    def on_delta(self, inserts, updates, deletes):
+        if self.left_outer or self.right_outer:
+            for values in deletes:
+                self.call_delete_cbs(values)
+            for old, new in updates:
+                self.call_update_cbs(old, new)
+            for values in inserts:
+                self.call_insert_cbs(values)
+            return
+        key = lambda values: tuple(values[k] for k in self.on.keys())
+        left = lambda values: [values[col] for col in self.parent.columns]
+        batch = self.batch_deltas()
+        if batch is None:
+            return
+        sql_lookup = self.right_index is None
+        matches = self.find_matches(self.right_index, self.parent2, list(self.on.values()),
+                                    [key(values) for values in deletes + inserts] + [key(values) for pair in updates for values in pair])
+        corrected = bool(batch["right"])
+        if corrected:
+            matches = self.exclude_deltas(matches, batch["right"], left=False)
+            if matches is None:
+                return
+        if sql_lookup:
+            batch["left"].extend(self.signed_rows(left, inserts, updates, deletes))
+            batch["sql"] = True
+        self.maintain_index("left_index", inserts, updates, deletes)
+        if corrected:
+            self.send_delta(batch, *self.counted_delta(matches, key, lambda values, match: self.joined(left(values), match), inserts, updates, deletes))
+            return
+        inserted, updated, deleted = [], [], []
+        for values in deletes:
+            deleted.extend(self.joined(left(values), match) for match in matches[key(values)])
+        for old, new in updates:
+            if key(old) == key(new):
+                updated.extend((self.joined(left(old), match), self.joined(left(new), match)) for match in matches[key(old)])
+                continue
+            to_delete = [self.joined(left(old), match) for match in matches[key(old)]]
+            to_insert = [self.joined(left(new), match) for match in matches[key(new)]]
+            if len(to_delete) == 1 and len(to_insert) == 1:
+                updated.append((to_delete[0], to_insert[0]))
+            else:
+                deleted.extend(to_delete)
+                inserted.extend(to_insert)
+        for values in inserts:
+            inserted.extend(self.joined(left(values), match) for match in matches[key(values)])
+        self.send_delta(batch, inserted, updated, deleted)
+
+    def on_delta2(self, inserts, updates, deletes):
+        if self.left_outer or self.right_outer:
+            for values in deletes:
+                self.call_delete_cbs2(values)
+            for old, new in updates:
+                self.call_update_cbs2(old, new)
+            for values in inserts:
+                self.call_insert_cbs2(values)
+            return
+        key = lambda values: tuple(values[k] for k in self.on.values())
+        right = lambda values: [values[col] for col in self.parent2.columns]
+        batch = self.batch_deltas()
+        if batch is None:
+            return
+        sql_lookup = self.left_index is None
+        matches = self.find_matches(self.left_index, self.parent, list(self.on.keys()),
+                                    [key(values) for values in deletes + inserts] + [key(values) for pair in updates for values in pair])
+        corrected = bool(batch["left"])
+        if corrected:
+            matches = self.exclude_deltas(matches, batch["left"], left=True)
+            if matches is None:
+                return
+        if sql_lookup:
+            batch["right"].extend(self.signed_rows(right, inserts, updates, deletes))
+            batch["sql"] = True
+        self.maintain_index("right_index", inserts, updates, deletes)
+        if corrected:
+            self.send_delta(batch, *self.counted_delta(matches, key, lambda values, match: self.joined(match, right(values)), inserts, updates, deletes))
+            return
+        inserted, updated, deleted = [], [], []
+        for values in deletes:
+            deleted.extend(self.joined(match, right(values)) for match in matches[key(values)])
+        for old, new in updates:
+            if key(old) == key(new):
+                updated.extend((self.joined(match, right(old)), self.joined(match, right(new))) for match in matches[key(old)])
+                continue
+            to_delete = [self.joined(match, right(old)) for match in matches[key(old)]]
+            to_insert = [self.joined(match, right(new)) for match in matches[key(new)]]
+            if len(to_delete) == 1 and len(to_insert) == 1:
+                updated.append((to_delete[0], to_insert[0]))
+            else:
+                deleted.extend(to_delete)
+                inserted.extend(to_insert)
+        for values in inserts:
+            inserted.extend(self.joined(match, right(values)) for match in matches[key(values)])
+        self.send_delta(batch, inserted, updated, deleted)
+
     def call_insert_cbs(self, values):
-        where_clause = f"WHERE {', '.join([f'{self.on[k]}=?' for k in self.on.keys()])}" if self.on else ""
-        parent2_matches = self.db.fetchall(f"SELECT * FROM ({self.parent2.query}) {where_clause}", tuple(values[k] for k in self.on.keys()))
+        where_clause = f"WHERE {' AND '.join([f'{self.on[k]}=?' for k in self.on.keys()])}" if self.on else ""
+        parent2_matches = self.db.fetchall(f"SELECT * FROM ({self.parent2.query}) {where_clause}", self.parent2.params + tuple(values[k] for k in self.on.keys()))
         values_array = [values[col] for col in self.parent.columns]
         left_matches_after_insert = None
         if self.right_outer:
-            where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.values()])}" if self.on else ""
-            left_matches_after_insert = len(self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause} LIMIT 2", tuple(values[self.on[k]] for k in self.on.keys())))
+            where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.values()])}" if self.on else ""
+            left_matches_after_insert = len(self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause} LIMIT 2", self.parent.params + tuple(values[self.on[k]] for k in self.on.keys())))
         for match in parent2_matches:
             if self.left_outer or self.right_outer:
                 joined_values_array = values_array + list(match)
             else:
                 joined_values_array = values_array + [match[i] for i, col in enumerate(self.parent2.columns) if col not in self.on.values()]
             joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-            for cb in self.insert_cbs:
-                cb(joined_values)
+            self.emit_delta([joined_values], [], [])
             if self.right_outer and left_matches_after_insert == 1:
                 joined_values_array = [None for _ in self.parent.columns] + list(match)
                 joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-                for cb in self.delete_cbs:
-                    cb(joined_values)
+                self.emit_delta([], [], [joined_values])
         if not parent2_matches and self.left_outer:
             joined_values_array = values_array + [None for _ in self.parent2.columns]
             joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-            for cb in self.insert_cbs:
-                cb(joined_values)
+            self.emit_delta([joined_values], [], [])
 
     def call_delete_cbs(self, values):
         # Query to find the matching rows in parent2
-        where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
-        parent2_matches = self.db.execute(f"SELECT * FROM ({self.parent2.query}) {where_clause}", tuple(values[k] for k in self.on.keys()))
+        where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
+        parent2_matches = self.db.fetchall(f"SELECT * FROM ({self.parent2.query}) {where_clause}", self.parent2.params + tuple(values[k] for k in self.on.keys()))
         values_array = [values[col] for col in self.parent.columns]
         for match in parent2_matches:
             if self.left_outer or self.right_outer:
@@ -734,23 +1283,20 @@ class Join(View):
             else:
                 joined_values_array = values_array + [match[idx] for idx, col in enumerate(self.parent2.columns) if col not in self.on.values()]
             joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-            for cb in self.delete_cbs:
-                cb(joined_values)
+            self.emit_delta([], [], [joined_values])
             if self.right_outer:
                 # If right outer and there's no match for the joined part anymore in the left table,
                 # Nones are inserted [ update should be probably emitted instead ]
-                where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
-                parent1_matches = self.db.fetchone(f"SELECT * FROM ({self.parent.query}) {where_clause}", tuple(values[k] for k in self.on.keys()))
+                where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
+                parent1_matches = self.db.fetchone(f"SELECT * FROM ({self.parent.query}) {where_clause}", self.parent.params + tuple(values[k] for k in self.on.keys()))
                 if not parent1_matches:
                     joined_values_array = [None for _ in self.parent.columns] + list(match)
                     joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-                    for cb in self.insert_cbs:
-                        cb(joined_values)
+                    self.emit_delta([joined_values], [], [])
         if not parent2_matches and self.left_outer:
             joined_values_array = [values[col] for col in self.parent.columns] + [None for _ in self.parent2.columns]
             joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-            for cb in self.delete_cbs:
-                cb(joined_values)
+            self.emit_delta([], [], [joined_values])
 
     def call_update_cbs(self, old, new):
         # Check if key changed:
@@ -758,8 +1304,8 @@ class Join(View):
         new_key = tuple([new[k] for k in self.on.keys()])
         if old_key == new_key:
             # Handle update by checking in the right table
-            where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
-            parent2_matches = self.db.fetchall(f"SELECT * FROM ({self.parent2.query}) {where_clause}", old_key)
+            where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
+            parent2_matches = self.db.fetchall(f"SELECT * FROM ({self.parent2.query}) {where_clause}", self.parent2.params + old_key)
             old_array = [old[col] for col in self.parent.columns] 
             new_array = [new[col] for col in self.parent.columns]
             for match in parent2_matches:
@@ -771,15 +1317,13 @@ class Join(View):
                     new_joined_array = new_array + [match[idx] for idx, col in enumerate(self.parent2.columns) if col not in self.on.values()]
                 old_joined_values = {col: old_joined_array[i] for i, col in enumerate(self.columns)}
                 new_joined_values = {col: new_joined_array[i] for i, col in enumerate(self.columns)}
-                for cb in self.update_cbs:
-                    cb(old_joined_values, new_joined_values)
+                self.emit_delta([], [(old_joined_values, new_joined_values)], [])
             if not parent2_matches and self.right_outer:
                 old_joined_array = old_array + [None for _ in self.parent2.columns]
                 old_joined_values = {col: old_joined_array[i] for i, col in enumerate(self.columns)}
                 new_joined_array = new_array + [None for _ in self.parent2.columns]
                 new_joined_values = {col: new_joined_array[i] for i, col in enumerate(self.columns)}
-                for cb in self.update_cbs:
-                    cb(old_joined_values, new_joined_values)
+                self.emit_delta([], [(old_joined_values, new_joined_values)], [])
             return
         if self.left_outer or self.right_outer:
             # Just call insert and delete for now
@@ -787,8 +1331,8 @@ class Join(View):
             self.call_delete_cbs(old)
             return
         # First, handle the deletion of the old joined row
-        where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
-        parent2_matches = self.db.fetchall(f"SELECT * FROM ({self.parent2.query}) {where_clause}", tuple(old[k] for k in self.on.keys()))
+        where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
+        parent2_matches = self.db.fetchall(f"SELECT * FROM ({self.parent2.query}) {where_clause}", self.parent2.params + tuple(old[k] for k in self.on.keys()))
         to_delete = []
         old_array = [old[col] for col in self.parent.columns]
         new_array = [new[col] for col in self.parent.columns]
@@ -801,8 +1345,8 @@ class Join(View):
             to_delete.append(old_joined_array)
 
         # Now, handle the insertion of the new joined row
-        where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
-        parent2_matches = self.db.fetchall(f"SELECT * FROM ({self.parent2.query}) {where_clause}", tuple(new[k] for k in self.on.keys()))
+        where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
+        parent2_matches = self.db.fetchall(f"SELECT * FROM ({self.parent2.query}) {where_clause}", self.parent2.params + tuple(new[k] for k in self.on.keys()))
         to_insert = []
         for match in parent2_matches:
             if self.left_outer or self.right_outer:
@@ -814,52 +1358,46 @@ class Join(View):
         if len(to_insert) == 1 and len(to_delete) == 1:
             to_delete_dict = {self.columns[i]: to_delete[0][i] for i in range(len(self.columns))}   
             to_insert_dict = {self.columns[i]: to_insert[0][i] for i in range(len(self.columns))}
-            for cb in self.update_cbs:
-                cb(to_delete_dict, to_insert_dict)
+            self.emit_delta([], [(to_delete_dict, to_insert_dict)], [])
         else:
             for values in to_insert:
                 values_dict = {self.columns[i]: values[i] for i in range(len(self.columns))}
-                for cb in self.insert_cbs:
-                    cb(values_dict)
+                self.emit_delta([values_dict], [], [])
             for values in to_delete:
                 values_dict = {self.columns[i]: values[i] for i in range(len(self.columns))}
-                for cb in self.delete_cbs:
-                    cb(values_dict)
+                self.emit_delta([], [], [values_dict])
 
     def call_insert_cbs2(self, values):
         # Query to find the matching rows in parent1
-        where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
-        parent1_matches = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause}", tuple(values[self.on[k]] for k in self.on.keys()))
+        where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
+        parent1_matches = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause}", self.parent.params + tuple(values[self.on[k]] for k in self.on.keys()))
         values_array = [values[col] for col in self.parent2.columns]
         right_matches_after_insert = None
         if self.left_outer:
-            where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.values()])}" if self.on else ""
-            right_matches_after_insert = len(self.db.fetchall(f"SELECT * FROM ({self.parent2.query}) {where_clause} LIMIT 2", tuple(values[self.on[k]] for k in self.on.keys())))
+            where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.values()])}" if self.on else ""
+            right_matches_after_insert = len(self.db.fetchall(f"SELECT * FROM ({self.parent2.query}) {where_clause} LIMIT 2", self.parent2.params + tuple(values[self.on[k]] for k in self.on.keys())))
         for match in parent1_matches:
             if self.left_outer or self.right_outer:
                 joined_values_array = [match[idx] for idx, col in enumerate(self.parent.columns)] + values_array
             else:
                 joined_values_array = [match[idx] for idx, col in enumerate(self.parent.columns)] + [values[col] for col in self.parent2.columns if col not in self.on.values()]
             joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-            for cb in self.insert_cbs:
-                cb(joined_values)
+            self.emit_delta([joined_values], [], [])
             if self.left_outer and right_matches_after_insert == 1:
                 # delete with None on the right side
                 joined_values_array = [match[idx] for idx, col in enumerate(self.parent.columns)] + [None for _ in self.parent2.columns]
                 joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-                for cb in self.delete_cbs:
-                    cb(joined_values)
+                self.emit_delta([], [], [joined_values])
         if not parent1_matches and self.right_outer:
             joined_values_array = [None for _ in self.parent.columns] + values_array
             # None for left outer
             joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-            for cb in self.insert_cbs:
-                cb(joined_values)
+            self.emit_delta([joined_values], [], [])
 
     def call_delete_cbs2(self, values):
         # Query to find the matching rows in parent1
-        where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
-        parent1_matches = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause}", tuple(values[self.on[k]] for k in self.on.keys()))
+        where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
+        parent1_matches = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause}", self.parent.params + tuple(values[self.on[k]] for k in self.on.keys()))
         values_array = [values[col] for col in self.parent2.columns]
         for match in parent1_matches:
             if self.left_outer or self.right_outer:
@@ -867,30 +1405,27 @@ class Join(View):
             else:
                 joined_values_array = [match[idx] for idx, col in enumerate(self.parent.columns)] + [values[col] for col in self.parent2.columns if col not in self.on.values()]
             joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-            for cb in self.delete_cbs:
-                cb(joined_values)
+            self.emit_delta([], [], [joined_values])
             if self.left_outer:
-                where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
-                parent2_matches = self.db.fetchone(f"SELECT * FROM ({self.parent2.query}) {where_clause}", tuple(values[k] for k in self.on.keys()))
+                where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
+                parent2_matches = self.db.fetchone(f"SELECT * FROM ({self.parent2.query}) {where_clause}", self.parent2.params + tuple(values[k] for k in self.on.keys()))
                 if not parent2_matches:
                     joined_values_array = list(match) + [None for _ in self.parent2.columns]
                     joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-                    for cb in self.insert_cbs:
-                        cb(joined_values)
+                    self.emit_delta([joined_values], [], [])
               
         if not parent1_matches and self.right_outer:
             joined_values_array = [None for _ in self.parent.columns] + values_array
             joined_values = {col: joined_values_array[i] for i, col in enumerate(self.columns)}
-            for cb in self.delete_cbs:
-                cb(joined_values)
+            self.emit_delta([], [], [joined_values])
   
     def call_update_cbs2(self, old, new):
         old_key = tuple([old[k] for k in self.on.keys()])
         new_key = tuple([new[k] for k in self.on.keys()])
         if old_key == new_key:
             # Handle update by checking in the right table
-            where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
-            parent_matches = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause}", old_key)
+            where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
+            parent_matches = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause}", self.parent.params + old_key)
             old_array = [old[col] for col in self.parent2.columns] 
             new_array = [new[col] for col in self.parent2.columns]
             for match in parent_matches:
@@ -902,15 +1437,13 @@ class Join(View):
                     new_joined_array = list(match) + [new[col] for col in self.parent2.columns if col not in self.on.values()]
                 old_joined_values = {col: old_joined_array[i] for i, col in enumerate(self.columns)}
                 new_joined_values = {col: new_joined_array[i] for i, col in enumerate(self.columns)}
-                for cb in self.update_cbs:
-                    cb(old_joined_values, new_joined_values)
+                self.emit_delta([], [(old_joined_values, new_joined_values)], [])
             if not parent_matches and self.left_outer:
                 old_joined_array = [None for _ in self.parent.columns] + old_array
                 old_joined_values = {col: old_joined_array[i] for i, col in enumerate(self.columns)}
                 new_joined_array = [None for _ in self.parent.columns] + new_array
                 new_joined_values = {col: new_joined_array[i] for i, col in enumerate(self.columns)}
-                for cb in self.update_cbs:
-                    cb(old_joined_values, new_joined_values)
+                self.emit_delta([], [(old_joined_values, new_joined_values)], [])
             return
         if self.left_outer or self.right_outer:
             # Just call insert and delete for now
@@ -918,8 +1451,8 @@ class Join(View):
             self.call_delete_cbs2(old)
             return
         # First, handle the deletion of the old joined row
-        where_clause = f"WHERE {', '.join([f'{self.on[k]}=?' for k in self.on.keys()])}" if self.on else ""
-        parent1_matches = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause}", tuple(old[self.on[k]] for k in self.on.keys()))
+        where_clause = f"WHERE {' AND '.join([f'{self.on[k]}=?' for k in self.on.keys()])}" if self.on else ""
+        parent1_matches = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause}", self.parent.params + tuple(old[self.on[k]] for k in self.on.keys()))
         to_delete = []
         to_insert = []
         old_array = [old[col] for col in self.parent2.columns]
@@ -932,8 +1465,8 @@ class Join(View):
             to_delete.append(old_joined_array)
 
         # Now, handle the insertion of the new joined row
-        where_clause = f"WHERE {', '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
-        parent1_matches = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause}", tuple(new[self.on[k]] for k in self.on.keys()))
+        where_clause = f"WHERE {' AND '.join([f'{k}=?' for k in self.on.keys()])}" if self.on else ""
+        parent1_matches = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) {where_clause}", self.parent.params + tuple(new[self.on[k]] for k in self.on.keys()))
         for match in parent1_matches:
             if self.left_outer or self.right_outer:
                 new_joined_array = [match[idx] for idx, col in enumerate(self.parent.columns)] + new_array
@@ -943,17 +1476,22 @@ class Join(View):
         if len(to_insert) == 1 and len(to_delete) == 1:
             to_delete_dict = {self.columns[i]: to_delete[0][i] for i in range(len(self.columns))}   
             to_insert_dict = {self.columns[i]: to_insert[0][i] for i in range(len(self.columns))}
-            for cb in self.update_cbs:
-                cb(to_delete_dict, to_insert_dict)
+            self.emit_delta([], [(to_delete_dict, to_insert_dict)], [])
         else:
             for values in to_insert:
                 values_dict = {self.columns[i]: values[i] for i in range(len(self.columns))}
-                for cb in self.insert_cbs:
-                    cb(values_dict)
+                self.emit_delta([values_dict], [], [])
             for values in to_delete:
                 values_dict = {self.columns[i]: values[i] for i in range(len(self.columns))}
-                for cb in self.delete_cbs:
-                    cb(values_dict)
+                self.emit_delta([], [], [values_dict])
+
+    def column_collation(self, col):
+        source, source_col = self.column_sources[self.columns.index(col)]
+        return source.column_collation(source_col)
+
+    def column_affinity(self, col):
+        source, source_col = self.column_sources[self.columns.index(col)]
+        return source.column_affinity(source_col)
 
     def update(self, where, **values):
         # check if all values are present in the parent columns
@@ -968,68 +1506,218 @@ class Join(View):
                 f"Join.update: Can not update column {col} because it does not exist in the parent table {self.parent.name}, values: {values}, parent.columns: {self.parent.columns}. Parent2 not yet implemented.")
 
     def __del__(self):
-        self.parent2.update_cbs.remove(self.update_cbs_ref2)
-        self.parent2.insert_cbs.remove(self.insert_cbs_ref2)
-        self.parent2.delete_cbs.remove(self.delete_cbs_ref2)
+        self.parent2.delta_cbs.remove(self.delta_cbs_ref2)
+        self.parent2.reset_cbs.remove(self.reset_cbs_ref)
         super().__del__()
 
+class RowCounter:
+    """
+    A multiset of rows keyed by their values, used by Distinct and SQLUnion.
+
+    Rows SQLite considers equal share a key: TEXT values of NOCASE and RTRIM columns are
+    folded. Rows of one column are keyed by the value itself, which saves a tuple per row,
+    and repeated strings can be interned. SQLite shows the first row of a key it scans, so
+    when a key's rows differ and the change could show another one, apply asks the view.
+
+    Attributes:
+        columns (list): The columns of the rows.
+        counts (dict): The number of copies of each key.
+        members (dict or None): Only when TEXT values are folded: for each key, the number
+            of copies of each row with that key. The first one is the row shown for the key.
+        rows (int): The total number of copies.
+    """
+    def __init__(self, columns, collations=(), intern_strings=False):
+        self.columns = columns
+        folds = [collation_function(c) if c and c.upper() != "BINARY" else None for c in collations]
+        self.folds = folds if any(folds) else None
+        self.intern_strings = intern_strings
+        self.counts = {}
+        self.members = {} if self.folds else None
+        self.rows = 0
+        # While applying a delta: the row shown before for each changed key, and the keys
+        # whose shown row SQLite is asked for
+        self.changed = None
+        self.unsure = None
+
+    def key(self, row):
+        if self.folds:
+            row = [f(v) if f and isinstance(v, str) else v for f, v in zip(self.folds, row)]
+        if self.intern_strings:
+            row = [sys.intern(v) if type(v) is str else v for v in row]
+        return row[0] if len(row) == 1 else tuple(row)
+
+    def shown(self, key):
+        """
+        Return the row shown for a key, or None if no row has it.
+        """
+        if self.members is not None:
+            members = self.members.get(key)
+            return next(iter(members)) if members else None
+        if key not in self.counts:
+            return None
+        return (key,) if len(self.columns) == 1 else key
+
+    def add(self, values):
+        """
+        Add a row dict and return its key.
+        """
+        row = tuple(values[col] for col in self.columns)
+        key = self.key(row)
+        if self.changed is not None and key not in self.changed:
+            self.changed[key] = self.shown(key)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        self.rows += 1
+        if self.members is not None:
+            members = self.members.setdefault(key, {})
+            if count and self.unsure is not None and row != next(iter(members)):
+                self.unsure.add(key)
+            members[row] = members.get(row, 0) + 1
+        return key
+
+    def remove(self, values):
+        """
+        Remove a row dict and return its key.
+        """
+        row = tuple(values[col] for col in self.columns)
+        key = self.key(row)
+        count = self.counts.get(key, 0)
+        if count == 0:
+            raise Exception(f"Can not delete a non-existing row: {values}")
+        if self.changed is not None and key not in self.changed:
+            self.changed[key] = self.shown(key)
+        self.rows -= 1
+        if count > 1:
+            self.counts[key] = count - 1
+        else:
+            del self.counts[key]
+        if self.members is not None:
+            members = self.members[key]
+            # Any copy of the shown row can be the first one SQLite scans
+            if self.unsure is not None and len(members) > 1 and row == next(iter(members)):
+                self.unsure.add(key)
+            if members[row] > 1:
+                members[row] -= 1
+            else:
+                del members[row]
+                if not members:
+                    del self.members[key]
+        return key
+
+    def apply(self, inserts, updates, deletes, shown_row=None):
+        """
+        Apply a delta of rows and return the resulting delta of distinct rows.
+
+        The rows shown before and after the delta are compared for each changed key, so rows
+        changed several times in a transaction are emitted once. shown_row, given a row,
+        returns the row SQLite shows for its key.
+        """
+        self.changed = {}
+        self.unsure = set() if shown_row and self.members is not None else None
+        for values in deletes:
+            self.remove(values)
+        moved = [(self.remove(old), self.add(new)) for old, new in updates]
+        for values in inserts:
+            self.add(values)
+        changed, unsure = self.changed, self.unsure
+        self.changed = self.unsure = None
+        for key in unsure or ():
+            members = self.members.get(key)
+            if members and len(members) > 1:
+                row = shown_row(next(iter(members)))
+                if row in members:
+                    self.members[key] = {row: members.pop(row), **members}
+        after = {key: self.shown(key) for key in changed}
+        inserted, updated, deleted = [], [], []
+        # A row updated from a key that is gone to a new key stays an update
+        for old_key, new_key in moved:
+            old, new = changed[old_key], after[new_key]
+            if old_key != new_key and old is not None and after[old_key] is None and changed[new_key] is None and new is not None:
+                updated.append((dict(zip(self.columns, old)), dict(zip(self.columns, new))))
+                changed[old_key], changed[new_key] = None, new
+        for key, old in changed.items():
+            new = after[key]
+            if old == new:
+                continue
+            if old is None:
+                inserted.append(dict(zip(self.columns, new)))
+            elif new is None:
+                deleted.append(dict(zip(self.columns, old)))
+            else:
+                updated.append((dict(zip(self.columns, old)), dict(zip(self.columns, new))))
+        return inserted, updated, deleted
+
+    def stats(self):
+        """
+        Return the number of rows, distinct rows and an estimate of the memory used in bytes.
+        """
+        seen = set()
+        def size(value):
+            if id(value) in seen:
+                return 0
+            seen.add(id(value))
+            if isinstance(value, tuple):
+                return sys.getsizeof(value) + sum(size(v) for v in value)
+            return sys.getsizeof(value)
+        memory = sys.getsizeof(self.counts) + sum(size(key) for key in self.counts)
+        if self.members is not None:
+            memory += sys.getsizeof(self.members) + sum(
+                sys.getsizeof(members) + sum(size(row) for row in members) for members in self.members.values())
+        return {"rows": self.rows, "distinct_rows": len(self.counts), "memory_bytes": memory}
+
 class Distinct(View):
-    def __init__(self, parent):
+    def __init__(self, parent, intern_strings=False):
         self.parent = parent
         super().__init__(parent.db, row_table=parent.row_table)
         self.columns = parent.columns
         self.query = f"SELECT DISTINCT * FROM ({self.parent.query})"
-        self.value_hashes_counts = {}
-        for row in self.db.fetchall(self.query):
-            self.value_hashes_counts[tuple(row).__hash__()] = self.value_hashes_counts.get(tuple(row).__hash__(), 0) + 1
+        self.params = self.parent.params
+        self.counter = RowCounter(self.columns, [parent.column_collation(col) for col in self.columns], intern_strings)
+        # Every copy of a row is counted, so that deleting one copy keeps the row
+        for row in self.db.fetchall(self.parent.query, self.parent.params):
+            self.counter.add(dict(zip(self.columns, row)))
 
-    def call_insert_cbs(self, values):
-        transformed_values_values = [values[col] for col in self.columns]
-        value_hash = tuple(transformed_values_values).__hash__()
-        count = self.value_hashes_counts.get(value_hash, 0)
-        self.value_hashes_counts[value_hash] = count + 1
-        if count == 0:
-            for cb in self.insert_cbs:
-                cb(values)
+    def on_delta(self, inserts, updates, deletes):
+        self.emit_delta(*self.counter.apply(inserts, updates, deletes, self.shown_row))
 
-    def call_update_cbs(self, old, new):
-        transformed_old_values_values = [old[col] for col in self.columns]
-        transformed_new_values_values = [new[col] for col in self.columns]
-        old_value_hash = tuple(transformed_old_values_values).__hash__()
-        new_value_hash = tuple(transformed_new_values_values).__hash__()
-        old_count = self.value_hashes_counts.get(old_value_hash, 0)
-        new_count = self.value_hashes_counts.get(new_value_hash, 0)
-        self.value_hashes_counts[old_value_hash] = old_count - 1
-        self.value_hashes_counts[new_value_hash] = new_count + 1
-        if old_count == 1:
-            if new_count == 0:
-                for cb in self.update_cbs:
-                    cb(new)
-            else:
-                for cb in self.delete_cbs:
-                    cb(old)
-        elif new_count == 0:
-            for cb in self.insert_cbs:
-                cb(new)
+    def stats(self):
+        """
+        Return the number of counted rows, distinct rows and the memory used by the counter.
+        """
+        return self.counter.stats()
 
-    def call_delete_cbs(self, values):
-        transformed_values_values = [values[col] for col in self.columns]
-        value_hash = tuple(transformed_values_values).__hash__()
-        count = self.value_hashes_counts.get(value_hash, 0)
-        if count == 0:
-            raise Exception(f"Can not delete a non-existing row: {values}")
-        self.value_hashes_counts[value_hash] = count - 1
-        if count == 1:
-            for cb in self.delete_cbs:
-                cb(values)
+# SQLite versions before 3.32 allow at most 999 parameters in a statement
+MAX_SQL_VARIABLES = 999
 
-def value_to_sql(value):
-    if value is None:
-        return "NULL"
-    elif isinstance(value, str):
-        return f"'{value}'"
-    else:
-        return str(value)
+def query_rows(db, columns, rows, query, params=()):
+    """
+    Run a query over a batch of rows, using as few statements as the parameter limit allows.
+
+    The query selects from __delta__, which has the given columns and __i__, the position
+    of the row in rows.
+
+    Args:
+        db (Database): The database.
+        columns (list): The column names of the rows.
+        rows (list): The rows, as dicts.
+        query (str): The query, for example "SELECT __i__ FROM __delta__ WHERE a > 1".
+        params (tuple): The parameters of query.
+
+    Returns:
+        list: The result rows of all statements.
+    """
+    results = []
+    row_placeholders = f"({', '.join(['?'] * (len(columns) + 1))})"
+    rows_per_statement = max(1, MAX_SQL_VARIABLES // (len(columns) + 1))
+    for start in range(0, len(rows), rows_per_statement):
+        chunk = rows[start:start + rows_per_statement]
+        values = []
+        for i, row in enumerate(chunk, start):
+            values.append(i)
+            values.extend(row[col] for col in columns)
+        cte = f"WITH __delta__(__i__, {', '.join(columns)}) AS (VALUES {', '.join([row_placeholders] * len(chunk))})"
+        results.extend(db.fetchall(f"{cte} {query}", tuple(values) + params))
+    return results
     
 class Select(View):
     def __init__(self, parent, **colexprs: Union[str, Type]) -> Optional[str]:
@@ -1041,30 +1729,86 @@ class Select(View):
             self.mirrors_id = True
         super().__init__(parent.db, row_table=rowtable)
         self.columns = [col for col in colexprs]
+        self.colexprs = colexprs
         column_parts = [col if expr == True else f"{expr} AS {col}" for col, expr in colexprs.items()]
         self.select_query = f"SELECT {', '.join(column_parts)}"
         self.query = f"SELECT {', '.join(column_parts)} FROM ({self.parent.query})"
-    
-    def call_insert_cbs(self, values):
-        transformed_values_values = self.db.fetchone(self.select_query + f" FROM (SELECT " + ", ".join([f"{value_to_sql(value)} AS {col}" for col, value in values.items()]) + ")")
-        transformed_values = {k: v for k, v in zip(self.columns, transformed_values_values)}
-        for cb in self.insert_cbs:
-            cb(transformed_values)
+        self.params = self.parent.params
+        self.evaluators = self.compile_evaluators()
+        self.uses_sql_evaluate = self.evaluators is None
 
-    def call_update_cbs(self, old, new):
-        transformed_old_values_values = self.db.fetchone(self.select_query + f" FROM (SELECT " + ", ".join([f"{value_to_sql(value)} AS {col}" for col, value in old.items()]) + ")")
-        transformed_old_values = {k: v for k, v in zip(self.columns, transformed_old_values_values)}
-        transformed_new_values_values = self.db.fetchone(self.select_query + f" FROM (SELECT " + ", ".join([f"{value_to_sql(value)} AS {col}" for col, value in new.items()]) + ")")
-        transformed_new_values = {k: v for k, v in zip(self.columns, transformed_new_values_values)}
-        for cb in self.update_cbs:
-            cb(transformed_old_values, transformed_new_values)
+    def compile_evaluators(self):
+        """
+        Compile the column expressions into Python functions over parent row dicts.
 
-    def call_delete_cbs(self, values):
-        transformed_values_values = self.db.fetchone(self.select_query + f" FROM (SELECT " + ", ".join([f"{value_to_sql(value)} AS {col}" for col, value in values.items()]) + ")")
-        transformed_values = {k: v for k, v in zip(self.columns, transformed_values_values)}
-        for cb in self.delete_cbs:
-            cb(transformed_values)
+        Returns:
+            list or None: One function per column, or None if an expression can't be compiled.
+        """
+        evaluators = []
+        for col, expr in self.colexprs.items():
+            if expr == True:
+                evaluators.append(lambda values, col=col: values[col])
+                continue
+            compiled = self.compile_column(col)
+            if compiled is None:
+                return None
+            evaluators.append(compiled.evaluate)
+        return evaluators
+
+    def evaluate(self, rows):
+        """
+        Compute the selected columns for a batch of parent rows.
+
+        Compiled expressions are evaluated in Python. Otherwise, and for the rows the compiled
+        expressions can't evaluate exactly, one parameterized query runs for the whole batch.
+        """
+        if not rows:
+            return []
+        if self.evaluators is None:
+            return self.evaluate_sql(rows)
+        results, fallback = [], []
+        for i, values in enumerate(rows):
+            try:
+                results.append({col: f(values) for col, f in zip(self.columns, self.evaluators)})
+            except SQLFallback:
+                results.append(None)
+                fallback.append(i)
+        if fallback:
+            for i, result in zip(fallback, self.evaluate_sql([rows[i] for i in fallback])):
+                results[i] = result
+        return results
+
+    def evaluate_sql(self, rows):
+        results = query_rows(self.db, self.parent.columns, rows, f"{self.select_query}, __i__ FROM __delta__ ORDER BY __i__")
+        return [{k: v for k, v in zip(self.columns, row)} for row in results]
+
+    def on_delta(self, inserts, updates, deletes):
+        results = iter(self.evaluate(deletes + [old for old, _ in updates] + [new for _, new in updates] + inserts))
+        transformed_deletes = [next(results) for _ in deletes]
+        transformed_olds = [next(results) for _ in updates]
+        transformed_updates = [(old, next(results)) for old in transformed_olds]
+        transformed_inserts = list(results)
+        self.emit_delta(transformed_inserts, [(old, new) for old, new in transformed_updates if old != new], transformed_deletes)
     
+    def column_collation(self, col):
+        expr = self.colexprs.get(col)
+        source = col if expr == True else expr
+        if isinstance(source, str) and source in self.parent.columns:
+            return self.parent.column_collation(source)
+        compiled = self.compile_column(col)
+        return None if compiled is None else compiled.collation or "BINARY"
+
+    def column_affinity(self, col):
+        compiled = self.compile_column(col)
+        return None if compiled is None else compiled.affinity
+
+    def compile_column(self, col):
+        expr = self.colexprs.get(col)
+        source = col if expr == True else expr
+        if not isinstance(source, str):
+            return None
+        return compile_expression(source, self.parent.columns, self.parent.column_affinity, self.parent.column_collation)
+
     def delete(self, id):
         if self.mirrors_id:
             self.parent.delete(id=id)
@@ -1085,52 +1829,71 @@ class Where(View):
         self.columns = parent.columns
         self.set_filter(main=main, **where)
     
-    def is_where_true(self, values):
-        if not self.main:
-            # just check vlaues in where
-            for col, value in self._where.items():
-                if values[col] != value:
-                    return False
-            return True
+    def matching(self, rows):
+        """
+        Return for each row whether it passes the filter.
 
-        placeholders = ', '.join([f"? as '{col}'" for col in values.keys()])
-        result = self.db.fetchone(f"SELECT * FROM (SELECT {placeholders}) {self.where_query}", tuple(values.values()))
+        Compiled filters are evaluated in Python; the rest, and the rows the compiled filter
+        can't evaluate exactly, are checked with one query for the whole batch.
+        """
+        if not self.main:
+            return [all(values[col] == value for col, value in self._where.items()) for values in rows]
+        if not rows:
+            return []
+        if self.predicate is None:
+            return self.matching_sql(rows)
+        result, fallback = [], []
+        for i, values in enumerate(rows):
+            try:
+                result.append(self.predicate(values) and all(values[col] == value for col, value in self._where.items()))
+            except SQLFallback:
+                result.append(False)
+                fallback.append(i)
+        if fallback:
+            for i, match in zip(fallback, self.matching_sql([rows[i] for i in fallback])):
+                result[i] = match
         return result
-    
-    def call_insert_cbs(self, values):
-        if self.is_where_true(values):
-            for cb in self.insert_cbs:
-                cb(values)
-    
-    def call_delete_cbs(self, values):
-        if self.is_where_true(values):
-            for cb in self.delete_cbs:
-                cb(values)
-    
-    def call_update_cbs(self, old, new):
-        old_exists = self.is_where_true(old)
-        new_exists = self.is_where_true(new)
-        if old_exists and new_exists:
-            if old != new:
-                for cb in self.update_cbs:
-                    cb(old, new)
-        elif old_exists:
-            for cb in self.delete_cbs:
-                cb(old)
-        elif new_exists:
-            for cb in self.insert_cbs:
-                cb(new)
+
+    def matching_sql(self, rows):
+        indices = set(row[0] for row in query_rows(self.db, self.columns, rows, f"SELECT __i__ FROM __delta__ {self.where_query}", self.where_params))
+        return [i in indices for i in range(len(rows))]
+
+    def is_where_true(self, values):
+        return self.matching([values])[0]
+
+    def on_delta(self, inserts, updates, deletes):
+        matches = iter(self.matching(deletes + [old for old, _ in updates] + [new for _, new in updates] + inserts))
+        filtered_deletes = [values for values in deletes if next(matches)]
+        old_matches = [next(matches) for _ in updates]
+        filtered_inserts, filtered_updates = [], []
+        for (old, new), old_exists in zip(updates, old_matches):
+            new_exists = next(matches)
+            if old_exists and new_exists:
+                if old != new:
+                    filtered_updates.append((old, new))
+            elif old_exists:
+                filtered_deletes.append(old)
+            elif new_exists:
+                filtered_inserts.append(new)
+        filtered_inserts.extend(values for values in inserts if next(matches))
+        self.emit_delta(filtered_inserts, filtered_updates, filtered_deletes)
 
     def set_filter(self, main=None, **where):
+        self.db.check_private(self)
         self.main = main
         self._where = where
-        self.where_query = f"{'WHERE' if main or where else ''} {('(' + main + ')' if main else '') + (' AND ' if main and where else '')} {' AND '.join([f'{col}={value.__repr__()}' for col, value in where.items()])}"
+        # The filter is evaluated in Python when SQLite's semantics for it can be reproduced
+        self.predicate = compile_predicate(main, self.columns, self.parent.column_affinity, self.parent.column_collation) if main else None
+        self.uses_sql_filter = bool(main) and self.predicate is None
+        self.where_query = f"{'WHERE' if main or where else ''} {('(' + main + ')' if main else '') + (' AND ' if main and where else '')} {' AND '.join([f'{col}=?' for col in where])}"
+        self.where_params = tuple(where.values())
         self.reset()
         for cb in self.reset_cbs:
             cb()
 
     def reset(self):
         self.query = f"SELECT * FROM ({self.parent.query}) {self.where_query}"
+        self.params = self.parent.params + self.where_params
 
     def update(self, where, **values):
         print(f"Where: Updating {self.parent.name} with {where} and {values}")
@@ -1146,131 +1909,74 @@ class UnionAll(View):
         super().__init__(parent.db, row_table=parent.row_table)
         self.columns = parent.columns
         self.query = f"{self.parent.query} UNION ALL {self.parent2.query}"
-        # These method refs are creaated by View constructor for self.parent, here they are reused
-        parent2.update_cbs.append(self.update_cbs_ref)
-        parent2.insert_cbs.append(self.insert_cbs_ref)
-        parent2.delete_cbs.append(self.delete_cbs_ref)
+        self.params = self.parent.params + self.parent2.params
+        # The method ref is created by View constructor for self.parent, here it is reused
+        self.db.listen(parent2.delta_cbs, self.delta_cbs_ref)
 
-    def call_insert_cbs(self, values):
-        for cb in self.insert_cbs:
-            cb(values)
+    def column_collation(self, col):
+        collation = self.parent.column_collation(col)
+        return collation if collation == self.parent2.column_collation(col) else None
 
-    def call_delete_cbs(self, values):
-        for cb in self.delete_cbs:
-            cb(values)
-    
-    def call_update_cbs(self, old, new):
-        for cb in self.update_cbs:
-            cb(old, new)
+    def column_affinity(self, col):
+        affinity = self.parent.column_affinity(col)
+        return affinity if affinity == self.parent2.column_affinity(col) else None
 
     def __del__(self):
-        self.parent2.update_cbs.remove(self.update_cbs_ref)
-        self.parent2.insert_cbs.remove(self.insert_cbs_ref)
-        self.parent2.delete_cbs.remove(self.delete_cbs_ref)
+        self.parent2.delta_cbs.remove(self.delta_cbs_ref)
 
 class SQLUnion(View):  # typing.Union is used too widely for this class to be named Union
-    def __init__(self, parent, parent2) -> Optional[str]:
+    def __init__(self, parent, parent2, intern_strings=False) -> Optional[str]:
         self.parent = parent
         self.parent2 = parent2
         super().__init__(parent.db, row_table=parent.row_table)
-        self.update_cbs_ref2 = methodref(self.call_update_cbs2)
-        self.insert_cbs_ref2 = methodref(self.call_insert_cbs2)
-        self.delete_cbs_ref2 = methodref(self.call_delete_cbs2)
-        parent2.update_cbs.append(self.update_cbs_ref2)
-        parent2.insert_cbs.append(self.insert_cbs_ref2)
-        parent2.delete_cbs.append(self.delete_cbs_ref2)
+        self.delta_cbs_ref2 = self.db.listen(parent2.delta_cbs, methodref(self.on_delta2))
         if sorted(map(lambda c: c.upper(), parent.columns)) != sorted(map(lambda c: c.upper(), parent2.columns)):
             raise ValueError("Union views must have the same columns.")
         self.columns = parent.columns
-        self.query = f"{self.parent.query} UNION {self.parent2.query}"
-        self.value_hashes_counts = {}
-        for row in self.db.fetchall(self.parent.query):
-            self.value_hashes_counts[tuple(row).__hash__()] = self.value_hashes_counts.get(tuple(row).__hash__(), 0) + 1
-        for row in self.db.fetchall(self.parent2.query):
-            self.value_hashes_counts[tuple(row).__hash__()] = self.value_hashes_counts.get(tuple(row).__hash__(), 0) + 1
+        # The columns of parent2 in the order of parent, as UNION matches columns by position
+        columns2 = {c.upper(): c for c in parent2.columns}
+        self.columns2 = [columns2[c.upper()] for c in self.columns]
+        self.query = f"{self.parent.query} UNION SELECT {', '.join(self.columns2)} FROM ({self.parent2.query})"
+        self.params = self.parent.params + self.parent2.params
+        # Rows of both parents are counted together, a row is in the union while its count is positive
+        self.counter = RowCounter(self.columns, [self.column_collation(col) for col in self.columns], intern_strings)
+        for row in self.db.fetchall(self.parent.query, self.parent.params):
+            self.counter.add(dict(zip(self.columns, row)))
+        for row in self.db.fetchall(f"SELECT {', '.join(self.columns2)} FROM ({self.parent2.query})", self.parent2.params):
+            self.counter.add(dict(zip(self.columns, row)))
     
-    def call_insert_cbs(self, values):
-        transformed_values_values = [values[col] for col in self.columns]
-        value_hash = tuple(transformed_values_values).__hash__()
-        count = self.value_hashes_counts.get(value_hash, 0)
-        self.value_hashes_counts[value_hash] = count + 1
-        if count == 0:
-            for cb in self.insert_cbs:
-                cb(values)
-        
-    def call_delete_cbs(self, values):
-        transformed_values_values = [values[col] for col in self.columns]
-        value_hash = tuple(transformed_values_values).__hash__()
-        count = self.value_hashes_counts.get(value_hash, 0)
-        if count == 0:
-            raise Exception(f"Can not delete a non-existing row: {values}")
-        self.value_hashes_counts[value_hash] = count - 1
-        if count == 1:
-            for cb in self.delete_cbs:
-                cb(values)
+    def on_delta(self, inserts, updates, deletes):
+        self.emit_delta(*self.counter.apply(inserts, updates, deletes, self.shown_row))
 
-    def call_update_cbs(self, old, new):
-        transformed_old_values_values = [old[col] for col in self.columns]
-        transformed_new_values_values = [new[col] for col in self.columns]
-        old_value_hash = tuple(transformed_old_values_values).__hash__()
-        new_value_hash = tuple(transformed_new_values_values).__hash__()
-        old_count = self.value_hashes_counts.get(old_value_hash, 0)
-        new_count = self.value_hashes_counts.get(new_value_hash, 0)
-        self.value_hashes_counts[old_value_hash] = old_count - 1
-        self.value_hashes_counts[new_value_hash] = new_count + 1
-        if old_count == 1:
-            if new_count == 0:
-                for cb in self.update_cbs:
-                    cb(new)
-            else:
-                for cb in self.delete_cbs:
-                    cb(old)
-        elif new_count == 0:
-            for cb in self.insert_cbs:
-                cb(new)
-    
-    def call_insert_cbs2(self, values):
-        # check parent
-        if not self.db.fetchone(f"SELECT * FROM ({self.parent.query} WHERE {', '.join([f'{k}=?' for k in values])};", tuple(values.values())):
-            for cb in self.insert_cbs:
-                cb(values)
-    
-    def call_delete_cbs2(self, values):
-        # check parent
-        if not self.db.fetchone(f"SELECT * FROM ({self.parent.query} WHERE {', '.join([f'{k}=?' for k in values])};", tuple(values.values())):
-            for cb in self.delete_cbs:
-                cb(values)
+    def on_delta2(self, inserts, updates, deletes):
+        renamed = lambda values: {col: values[col2] for col, col2 in zip(self.columns, self.columns2)}
+        self.emit_delta(*self.counter.apply([renamed(values) for values in inserts],
+                                            [(renamed(old), renamed(new)) for old, new in updates],
+                                            [renamed(values) for values in deletes], self.shown_row))
 
-    def call_update_cbs2(self, old, new):
-        # check parent
-        old_exists = self.db.fetchone(f"SELECT * FROM ({self.parent.query} WHERE {', '.join([f'{k}=?' for k in old])};", tuple(old.values()))
-        new_exists = self.db.fetchone(f"SELECT * FROM ({self.parent.query} WHERE {', '.join([f'{k}=?' for k in new])};", tuple(new.values()))
-        if (not old_exists) and (not new_exists):
-            for cb in self.update_cbs:
-                cb(old, new)
-        elif not old_exists:
-            for cb in self.delete_cbs:
-                cb(old)
-        elif not new_exists:
-            for cb in self.insert_cbs:
-                cb(new)
+    def stats(self):
+        """
+        Return the number of counted rows of both parents, distinct rows and the memory used by the counter.
+        """
+        return self.counter.stats()
     
+    def column_collation(self, col):
+        collation = self.parent.column_collation(col)
+        return collation if collation == self.parent2.column_collation(col) else None
+
+    def column_affinity(self, col):
+        affinity = self.parent.column_affinity(col)
+        return affinity if affinity == self.parent2.column_affinity(col) else None
+
     def __del__(self):
-        self.parent2.update_cbs.remove(self.update_cbs_ref2)
-        self.parent2.insert_cbs.remove(self.insert_cbs_ref2)
-        self.parent2.delete_cbs.remove(self.delete_cbs_ref2)
+        self.parent2.delta_cbs.remove(self.delta_cbs_ref2)
 
 class Table(View):
     def __init__(self, db, _name: str, temp=False, **columns: Union[str, Type]):
         super().__init__(db, row_table=_name)
         # self.db = db
         self.temp = temp
-        self.update_cbs_ref = methodref(self.call_update_cbs)
-        self.insert_cbs_ref = methodref(self.call_insert_cbs)
-        self.delete_cbs_ref = methodref(self.call_delete_cbs)
-        self.db.update_cbs.append(self.update_cbs_ref)
-        self.db.insert_cbs.append(self.insert_cbs_ref)
-        self.db.delete_cbs.append(self.delete_cbs_ref)
+        self.unsubscribe = self.db.subscribe(_name, delta=methodref(self.on_table_delta))
         table_exists = self.db.fetchone(f"SELECT sql FROM sqlite_master WHERE type='table' AND name= ?;", (_name,))
         self.name = _name
 
@@ -1313,6 +2019,7 @@ class Table(View):
             self.db.execute(f"CREATE {'TEMP' if self.temp else ''} TABLE {self.name} ({', '.join([f'{col} {dtype}' for col, dtype in column_definitions])})")
         self.column_definitions = column_definitions
         self.columns = [col for col, _ in column_definitions]
+        self.sql = table_exists[0] if table_exists else None
         self.query = f"SELECT {', '.join(self.columns)} FROM {self.name}"
         self.is_bool = []
         for col, dtype in self.column_definitions:
@@ -1327,54 +2034,89 @@ class Table(View):
     def insert(self, ignore=False, **values):
         self.db.insert(self.name, ignore=ignore, **self.back_from_bool(values))
 
+    def insert_many(self, rows, ignore=False):
+        """
+        Insert many rows in one transaction.
+
+        Args:
+            rows (list): A list of dicts of column values.
+            ignore (bool): Whether to ignore conflicts.
+        """
+        self.db.insert_many(self.name, [self.back_from_bool(values) for values in rows], ignore=ignore)
+
     def delete(self, id=None, **values):
         if id is not None:
             values['id'] = id
         self.db.delete(self.name, **self.back_from_bool(values))
 
-    def update(self, where: dict, **values):
-        # print(f"Table: Updating {self.name} with {where} and {values}")
-        if DEBUG_SQL:
-            print(f"Table: Updating {self.name} with {where} and {values}, column definitions: {self.column_definitions}")
+    def delete_many(self, wheres):
+        """
+        Delete the rows matching any of the conditions in one transaction.
+
+        Args:
+            wheres (list): A list of dicts of column values.
+        """
+        self.db.delete_many(self.name, [self.back_from_bool(where) for where in wheres])
+
+    def convert_where(self, where: dict):
         for key, value in where.items():
             if type(value) == str:
                 keypos = self.columns.index(key)
                 t = self.column_definitions[keypos][1]
                 if istartswith(t, "INTEGER"):
                     where[key] = int(value)
-        self.db.update(self.name, self.back_from_bool(where), **self.back_from_bool(values))
+        return self.back_from_bool(where)
+
+    def update(self, where: dict, **values):
+        # print(f"Table: Updating {self.name} with {where} and {values}")
+        if DEBUG_SQL:
+            print(f"Table: Updating {self.name} with {where} and {values}, column definitions: {self.column_definitions}")
+        self.db.update(self.name, self.convert_where(where), **self.back_from_bool(values))
+
+    def update_many(self, updates):
+        """
+        Run many updates in one transaction.
+
+        Args:
+            updates (list): A list of (where, values) pairs of dicts.
+        """
+        self.db.update_many(self.name, [(self.convert_where(where), self.back_from_bool(values)) for where, values in updates])
     
+    def on_table_delta(self, table, inserts, updates, deletes):
+        if DEBUG_SQL:
+            print("Table delta", inserts, updates, deletes)
+        def convert(values):
+            return {k: v for k, v in zip(self.columns, self.maybe_to_bool([values[col] for col in self.columns]))}
+        self.emit_delta([convert(values) for values in inserts],
+                        [(convert(old), convert(new)) for old, new in updates],
+                        [Row({k: v for k, v in zip(self.columns, self.maybe_to_bool(row))}, self.name) for row in deletes])
+
     def call_update_cbs(self, table, old, new):
-        if table != self.name:
-            return
-        old_values = [old[col] for col in self.columns]
-        new_values = [new[col] for col in self.columns]
-        old2 = {k: v for k, v in zip(self.columns, self.maybe_to_bool(old_values))}
-        new2 = {k: v for k, v in zip(self.columns, self.maybe_to_bool(new_values))}
-        for cb in self.update_cbs:
-            cb(old2, new2)
+        self.on_table_delta(table, [], [(old, new)], [])
     
     def call_insert_cbs(self, table, values):
-        if table != self.name:
-            return
-        if DEBUG_SQL:   
-            print("Table insert", values)
-        values_array = [values[col] for col in self.columns]
-        values2 = {k: v for k, v in zip(self.columns, self.maybe_to_bool(values_array))}
-        for cb in self.insert_cbs:
-            cb(values2)
+        self.on_table_delta(table, [values], [], [])
     
     def call_delete_cbs(self, table, row):
-        if table != self.name:
-            return
-        values = Row({k: v for k, v in zip(self.columns, self.maybe_to_bool(row))}, self.name)
-        for cb in self.delete_cbs:
-            cb(values)
+        self.on_table_delta(table, [], [], [row])
     
     def __del__(self):
-        self.db.update_cbs.remove(self.update_cbs_ref)
-        self.db.insert_cbs.remove(self.insert_cbs_ref)
-        self.db.delete_cbs.remove(self.delete_cbs_ref)
+        self.unsubscribe()
+
+    def column_collation(self, col):
+        dtype = self.column_definitions[self.columns.index(col)][1]
+        m = re.search(r"\bCOLLATE\s+(\w+)", dtype if isinstance(dtype, str) else "", re.IGNORECASE)
+        if not m and self.sql:
+            # Existing tables only report the type in PRAGMA table_info, so look at the schema
+            m = re.search(r"(?:^|[(,])\s*[\"`\[]?" + re.escape(col) + r"[\"`\]]?\s[^,]*?\bCOLLATE\s+(\w+)", self.sql, re.IGNORECASE)
+        return m.group(1).upper() if m else "BINARY"
+
+    def column_affinity(self, col):
+        dtype = self.column_definitions[self.columns.index(col)][1]
+        # Only the type name counts, not the constraints after it
+        type_name = re.split(r"\b(?:CONSTRAINT|PRIMARY|NOT|NULL|UNIQUE|CHECK|DEFAULT|COLLATE|REFERENCES|GENERATED|AS)\b",
+                             dtype if isinstance(dtype, str) else "", maxsplit=1, flags=re.IGNORECASE)[0]
+        return type_affinity(type_name)
 
     def update_urlm(self, where: dict, **values):
         if where:
@@ -1542,7 +2284,10 @@ class RowValue(Value):
         self.parent.delete_cbs.remove(self.delete_cbs_ref)
 
 class GroupBy(View):
-    def __init__(self, parent, *group_by_columns, **aggregates):
+    def __init__(self, parent, *group_by_columns, minmax_budget=None, having=None, **aggregates):
+        # With minmax_budget, MIN and MAX keep up to that many values of each group sorted, so
+        # deleting the current extreme value doesn't query the group; larger groups still do.
+        # having is a condition on the output columns that groups have to pass to be shown.
         self.parent = parent
         super().__init__(parent.db)
         self.group_by_columns = group_by_columns
@@ -1562,188 +2307,272 @@ class GroupBy(View):
         # Construct the new query
         group_by_clause = ", ".join(group_by_columns) if group_by_columns else ""
         aggregate_clause = ", ".join([f"{func} AS {alias}" for alias, func in aggregates.items()])
-        self.query = f"SELECT {group_by_clause}{', ' if group_by_clause else ''}{aggregate_clause} FROM ({parent.query})"
+        self.group_query = f"SELECT {group_by_clause}{', ' if group_by_clause else ''}{aggregate_clause} FROM ({parent.query})"
         if group_by_columns:
-            self.query += f" GROUP BY {group_by_clause}"
-
-        result_set = self.db.execute(self.query)
-
-        # Create a dictionary to map group_by values to their corresponding row in the result set
-        self.group_map = {}
-        for row in result_set:
-            group_key = tuple(row[i] for i, col in enumerate(self.columns) if col in self.group_by_columns)
-            self.group_map[group_key] = row
-
-        self.count_col_name = next((alias for alias, func in aggregates.items() if istartswith(func, 'COUNT')), None)
-        self.count_col_index = self.columns.index(self.count_col_name)
-
-    def call_update_cbs(self, old, new):
+            self.group_query += f" GROUP BY {group_by_clause}"
+        self.query = f"SELECT * FROM ({self.group_query}) WHERE {having}" if having else self.group_query
+        self.params = parent.params
+
+        # Parse the aggregates once, and give each one its slots in the group accumulators
+        self.aggregators = [parse_aggregate(alias, func, parent.columns, parent.column_affinity, parent.column_collation,
+                                            minmax_budget) for alias, func in aggregates.items()]
+        self.initial = [0, None]
+        for aggregator in self.aggregators:
+            aggregator.offset = len(self.initial)
+            self.initial.extend(aggregator.initial())
+        self.results = [aggregator.result for aggregator in self.aggregators]
+        self.ordered = [aggregator for aggregator in self.aggregators if aggregator.ordered]
+        self.having = having
+        self.having_predicate = compile_predicate(having, self.columns, self.column_affinity, self.column_collation) if having else None
+
+        # Map the group_by values of each group to its accumulator
+        self.groups = {}
+        self.rescan_count = 0
+        if not group_by_columns:
+            self.groups[()] = list(self.initial)
+        rescans = {}
+        for row in self.db.fetchall(parent.query, parent.params):
+            self.add_row(dict(zip(parent.columns, row)), None, rescans)
+        if rescans:
+            # One query loads the aggregates that are only known to SQLite
+            n = len(group_by_columns)
+            for row in self.db.fetchall(self.group_query, self.params):
+                key = tuple(row[:n])
+                if key in rescans and key in self.groups:
+                    self.load(self.groups[key], rescans[key], row[n:])
+
+    def output(self, key, acc):
+        # The row of a group, or None if the group doesn't exist
+        if acc is None:
+            return None
+        if acc[SQL_VALUES] is not None:
+            return key + acc[SQL_VALUES]
+        return key + tuple([result(acc) for result in self.results])
+
+    def add_row(self, values, before, rescans, moved=False):
+        key = tuple([values[col] for col in self.group_by_columns])
+        acc = self.groups.get(key)
+        if before is not None and key not in before:
+            before[key] = self.output(key, acc)
+        if acc is None:
+            acc = self.groups[key] = list(self.initial)
+        acc[ROW_COUNT] += 1
+        self.accumulate(key, acc, None, values, rescans)
+        if moved and self.ordered and acc[ROW_COUNT] > 1 and rescans.get(key, ()) is not None:
+            # The row keeps its place in the scan order, so the ordered aggregates are reloaded
+            rescans.setdefault(key, set()).update(self.ordered)
+
+    def remove_row(self, values, before, rescans):
+        key = tuple([values[col] for col in self.group_by_columns])
+        acc = self.groups.get(key)
+        if acc is None:
+            # The group doesn't exist, nothing to delete
+            return
+        if key not in before:
+            before[key] = self.output(key, acc)
+        acc[ROW_COUNT] -= 1
+        if acc[ROW_COUNT] == 0:
+            # Without GROUP BY columns there is always one row, even for no input rows
+            if key:
+                del self.groups[key]
+            else:
+                self.groups[key] = list(self.initial)
+            rescans.pop(key, None)
+            return
+        self.accumulate(key, acc, values, None, rescans)
 
-        # Check if the group has changed
-        old_group_values = tuple(old[col] for col in self.group_by_columns)
-        new_group_values = tuple(new[col] for col in self.group_by_columns)
+    def update_row(self, old, new, before, rescans):
+        key = tuple([new[col] for col in self.group_by_columns])
+        if key != tuple([old[col] for col in self.group_by_columns]) or key not in self.groups:
+            self.remove_row(old, before, rescans)
+            self.add_row(new, before, rescans, moved=True)
+            return
+        if key not in before:
+            before[key] = self.output(key, self.groups[key])
+        self.accumulate(key, self.groups[key], old, new, rescans)
 
-        if old_group_values != new_group_values:
-            # If the group has changed, treat it as a delete from old group and insert into new group
-            self.call_delete_cbs(old)
-            self.call_insert_cbs(new)
-        else:
-            # If the group hasn't changed, update the aggregates
-            old_group = self.group_map.get(old_group_values)
-            new_group = list(old_group_values)
-
-            for alias, func in self.aggregates.items():
-                old_value = old_group[self.columns.index(alias)]
-                if istartswith(func, 'COUNT'):
-                    new_group.append(old_value)  # Count doesn't change for updates
-                elif istartswith(func, 'SUM'):
-                    new_group.append(old_value - old[func.split('(')[1][:-1]] + new[func.split('(')[1][:-1]])
-                elif istartswith(func, 'AVG'):
-                    count = old_group[self.count_col_index]
-                    new_sum = old_value * count - old[func.split('(')[1][:-1]] + new[func.split('(')[1][:-1]]
-                    new_group.append(new_sum / count)
-                elif istartswith(func, 'MAX'):
-                    new_value = new[func.split('(')[1][:-1]]
-                    if new_value > old_value:
-                        new_group.append(new_value)
-                    elif new_value < old_value and old_value == old[func.split('(')[1][:-1]]:
-                        # Need to query for the new max
-                        column = func.split('(')[1][:-1]
-                        where_clause, remaining_values = create_where_null_clause(self.group_by_columns, group_by_values)
-                        query = f"SELECT MAX({column}) FROM ({self.parent.query}){where_clause}"
-                        new_max = self.db.fetchone(query, remaining_values)[0]
-                        new_group.append(new_max)
-                    else:
-                        new_group.append(old_value)
-                elif istartswith(func, 'MIN'):
-                    new_value = new[func.split('(')[1][:-1]]
-                    if new_value < old_value:
-                        new_group.append(new_value)
-                    elif new_value > old_value and old_value == old[func.split('(')[1][:-1]]:
-                        # Need to query for the new min
-                        column = func.split('(')[1][:-1]
-                        where_clause, remaining_values = create_where_null_clause(self.group_by_columns, group_by_values)
-                        query = f"SELECT MIN({column}) FROM ({self.parent.query}){where_clause}"
-                        new_min = self.db.fetchone(query, remaining_values)[0]
-                        new_group.append(new_min)
+    def accumulate(self, key, acc, old, new, rescans):
+        # old is None for an inserted row, new is None for a deleted one
+        if acc[SQL_VALUES] is None:
+            try:
+                for aggregator in self.aggregators:
+                    if old is None:
+                        ok = aggregator.add(acc, new)
+                    elif new is None:
+                        ok = aggregator.remove(acc, old)
                     else:
-                        new_group.append(old_value)
-
-            new_group = tuple(new_group)
-            self.group_map[new_group_values] = new_group
+                        ok = aggregator.update(acc, old, new)
+                    if not ok:
+                        rescans.setdefault(key, set()).add(aggregator)
+                return
+            except SQLFallback:
+                # The state of the group is lost, from now on all its aggregates are queried
+                acc[SQL_VALUES] = ()
+        rescans[key] = None
+
+    def load(self, acc, aggregators, values):
+        # values holds every aggregate, aggregators the ones to load (None when all are queried)
+        if acc[SQL_VALUES] is not None:
+            acc[SQL_VALUES] = tuple(values)
+            return
+        for aggregator, value in zip(self.aggregators, values):
+            if aggregator in aggregators and not aggregator.ordered:
+                aggregator.load(acc, value)
+
+    def rescan(self, rescans):
+        # The group's rows are scanned once anyway, so all its aggregates are queried together
+        funcs = ", ".join(aggregator.sql for aggregator in self.aggregators)
+        for key, aggregators in rescans.items():
+            acc = self.groups.get(key)
+            if acc is None:
+                continue
+            where_clause, remaining_values = create_where_null_clause(self.group_by_columns, key)
+            if acc[SQL_VALUES] is None and any(aggregator.ordered for aggregator in aggregators):
+                rows = self.db.fetchall(f"SELECT * FROM ({self.parent.query}){where_clause}", self.parent.params + remaining_values)
+                rows = [dict(zip(self.parent.columns, row)) for row in rows]
+                try:
+                    for aggregator in self.ordered:
+                        if aggregator in aggregators:
+                            aggregator.reload(acc, rows)
+                except SQLFallback:
+                    acc[SQL_VALUES] = ()
+            if acc[SQL_VALUES] is not None or any(not aggregator.ordered for aggregator in aggregators):
+                query = f"SELECT {funcs} FROM ({self.parent.query}){where_clause}"
+                self.load(acc, aggregators, self.db.fetchone(query, self.parent.params + remaining_values))
+            self.rescan_count += 1
+
+    def passing(self, rows):
+        """
+        Return for each output row whether it passes the HAVING condition.
 
-            for cb in self.update_cbs:
-                cb(dict(zip(self.columns, old_group)), dict(zip(self.columns, new_group)))
+        The compiled condition is evaluated in Python; the rest, and the rows it can't evaluate
+        exactly, are checked with one query for the whole batch.
+        """
+        if not self.having:
+            return [True] * len(rows)
+        rows = [dict(zip(self.columns, row)) for row in rows]
+        if self.having_predicate is None:
+            result, fallback = [False] * len(rows), list(range(len(rows)))
+        else:
+            result, fallback = [], []
+            for i, values in enumerate(rows):
+                try:
+                    result.append(self.having_predicate(values))
+                except SQLFallback:
+                    result.append(False)
+                    fallback.append(i)
+        if fallback:
+            query = f"SELECT __i__ FROM __delta__ WHERE {self.having}"
+            indices = set(row[0] for row in query_rows(self.db, self.columns, [rows[i] for i in fallback], query))
+            for j, i in enumerate(fallback):
+                result[i] = j in indices
+        return result
 
-    def call_insert_cbs(self, values):
-        # Store previous group map result
-        group_by_values = tuple(values[col] for col in self.group_by_columns)
-        prev_group = self.group_map.get(group_by_values)
-
-        # Update the group map for aggregate functions
-        old_group = self.group_map.get(group_by_values, None)
-        new_group = list(group_by_values)
-        for alias, func in self.aggregates.items():
-            if old_group is None:
-                # This is a new group
-                if istartswith(func, 'COUNT'):
-                    new_group.append(1)
-                elif istartswith(func, 'SUM') or istartswith(func, 'AVG'):
-                    new_group.append(values[func.split('(')[1][:-1]])
-                elif istartswith(func, 'MAX') or istartswith(func, 'MIN'):
-                    new_group.append(values[func.split('(')[1][:-1]])
+    def on_delta(self, inserts, updates, deletes):
+        # Fold the whole batch into the accumulators first, then emit one change for each touched group
+        before = {}
+        rescans = {}
+        for values in deletes:
+            self.remove_row(values, before, rescans)
+        for old, new in updates:
+            self.update_row(old, new, before, rescans)
+        for values in inserts:
+            self.add_row(values, before, rescans)
+        self.rescan(rescans)
+        self.emit_groups(before)
+
+    def emit_groups(self, before):
+        # before maps the touched groups to their rows before the changes
+        changes = []
+        for group_by_values, prev_group in before.items():
+            new_group = self.output(group_by_values, self.groups.get(group_by_values))
+            if prev_group != new_group:
+                changes.append((prev_group, new_group))
+        if self.having:
+            # Groups that cross the HAVING condition are inserted or deleted
+            passes = iter(self.passing([row for change in changes for row in change if row is not None]))
+            changes = [tuple(row if row is not None and next(passes) else None for row in change) for change in changes]
+        inserted, updated, deleted = [], [], []
+        for prev_group, new_group in changes:
+            if prev_group == new_group:
+                continue
+            if prev_group is None:
+                inserted.append(dict(zip(self.columns, new_group)))
+            elif new_group is None:
+                deleted.append(dict(zip(self.columns, prev_group)))
             else:
-                old_value = old_group[self.columns.index(alias)]
-                if istartswith(func, 'COUNT'):
-                    new_group.append(old_value + 1)
-                elif istartswith(func, 'SUM'):
-                    new_group.append(old_value + values[func.split('(')[1][:-1]])
-                elif istartswith(func, 'AVG'):
-                    count = old_group[self.count_col_index] + 1
-                    new_sum = old_value * (count - 1) + values[func.split('(')[1][:-1]]
-                    new_group.append(new_sum / count)
-                elif istartswith(func, 'MAX'):
-                    new_group.append(max(old_value, values[func.split('(')[1][:-1]]))
-                elif istartswith(func, 'MIN'):
-                    new_group.append(min(old_value, values[func.split('(')[1][:-1]]))
-        new_group = tuple(new_group)
-
-        if new_group:
-            self.group_map[group_by_values] = new_group
-        
-        if not prev_group and not group_by_values:
-            prev_group = tuple([0 if istartswith(func, 'COUNT') else None for func in self.aggregates.values()])
+                updated.append((dict(zip(self.columns, prev_group)), dict(zip(self.columns, new_group))))
+        self.emit_delta(inserted, updated, deleted)
 
-        # Determine if this is an insert or update
-        if prev_group:
-            for cb in self.update_cbs:
-                cb(dict(zip(self.columns, prev_group)), dict(zip(self.columns, new_group)))
-        else:
-            for cb in self.insert_cbs:
-                cb(dict(zip(self.columns, new_group)))
+    def verify(self, repair=True, rel_tol=1e-9):
+        """
+        Compare the incrementally maintained groups with a fresh query.
 
-    def call_delete_cbs(self, values):
-        # Store previous group map result
-        group_by_values = tuple(values[col] for col in self.group_by_columns)
-        prev_group = self.group_map.get(group_by_values)
-        if prev_group is None:
-            # The group doesn't exist, nothing to delete
-            return
-        
-        # if count is 1 and group_by_values is empty, need to update to 0, None, None, 0...
-        count = prev_group[self.count_col_index]
-        if count == 1 and not group_by_values:
-            new_group = tuple([0 if istartswith(func, 'COUNT') else None for func in self.aggregates.values()])
-            del self.group_map[group_by_values]  # Still delete the only group
-            for cb in self.update_cbs:
-                cb(dict(zip(self.columns, prev_group)), dict(zip(self.columns, new_group)))
-            return
-        
-        # Update the group map for aggregate functions
-        new_group = list(group_by_values)
-        for alias, func in self.aggregates.items():
-            old_value = prev_group[self.columns.index(alias)]
-            if istartswith(func, 'COUNT'):
-                new_value = old_value - 1
-                if new_value == 0:
-                    # If count reaches 0 and group_by_values is not empty remove the group
-                    del self.group_map[group_by_values] 
-                    for cb in self.delete_cbs:
-                        cb(dict(zip(self.columns, prev_group)))
-                    return
-                new_group.append(new_value)
-            elif istartswith(func, 'SUM'):
-                new_group.append(old_value - values[func.split('(')[1][:-1]])
-            elif istartswith(func, 'AVG'):
-                count = prev_group[self.count_col_index] - 1
-                if count == 0:
-                    # If count reaches 0, remove the group
-                    del self.group_map[group_by_values]
-                    for cb in self.delete_cbs:
-                        cb(dict(zip(self.columns, prev_group)))
-                    return
-                new_sum = old_value * (count + 1) - values[func.split('(')[1][:-1]]
-                new_group.append(new_sum / count)
-            elif istartswith(func, 'MAX') or istartswith(func, 'MIN'):
-                # For MAX and MIN, we need to recalculate only if the deleted value matches the current aggregate
-                if (istartswith(func, 'MAX') and values[func.split('(')[1][:-1]] == old_value) or \
-                   (istartswith(func, 'MIN') and values[func.split('(')[1][:-1]] == old_value):
-                    where_clause, remaining_values = create_where_null_clause(self.group_by_columns, group_by_values)
-                    query = f"SELECT {func} FROM ({self.parent.query}){where_clause}"
-                    new_value = self.db.fetchone(query, remaining_values)[0]
-                    new_group.append(new_value)
-                else:
-                    new_group.append(old_value)
+        REAL values only have to agree within rel_tol, as SQLite sums them in scan order.
 
-        new_group = tuple(new_group)
-        self.group_map[group_by_values] = new_group
+        Args:
+            repair (bool): Recompute the groups that differ from their rows, and emit the changes.
+            rel_tol (float): The relative tolerance for REAL values.
+
+        Returns:
+            list: (group values, computed row, queried row) for each group that differs, with None
+                for a group that is missing on one side.
+        """
+        n = len(self.group_by_columns)
+        actual = {tuple(row[:n]): tuple(row) for row in self.db.fetchall(self.group_query, self.params)}
+        same = lambda x, y: x == y or (isinstance(x, float) and isinstance(y, (int, float)) and
+                                       math.isclose(x, y, rel_tol=rel_tol))
+        mismatches = []
+        for key in set(self.groups) | set(actual):
+            computed = self.output(key, self.groups.get(key))
+            queried = actual.get(key)
+            if key == () and queried is None:
+                continue  # A query without GROUP BY always returns its row
+            if computed is None or queried is None or not all(map(same, computed, queried)):
+                mismatches.append((key, computed, queried))
+        if repair and mismatches:
+            before, rescans = {}, {}
+            for key, computed, _ in mismatches:
+                before[key] = computed
+                self.groups.pop(key, None)
+                if not key:
+                    self.groups[key] = list(self.initial)
+                where_clause, remaining_values = create_where_null_clause(self.group_by_columns, key)
+                for row in self.db.fetchall(f"SELECT * FROM ({self.parent.query}){where_clause}", self.parent.params + remaining_values):
+                    self.add_row(dict(zip(self.parent.columns, row)), before, rescans)
+            self.rescan(rescans)
+            self.emit_groups(before)
+        return mismatches
+
+    def column_collation(self, col):
+        if col in self.group_by_columns:
+            return self.parent.column_collation(col)
+        aggregator = self.aggregators[self.columns.index(col) - len(self.group_by_columns)]
+        if isinstance(aggregator, (CountAll, Count, CountDistinct, Sum, Variance, GroupConcat)):
+            return "BINARY"  # Numbers, or function results without a collation
+        return None
+
+    def column_affinity(self, col):
+        if col in self.group_by_columns:
+            return self.parent.column_affinity(col)
+        return "NONE"  # Aggregates have no affinity
+
+    def stats(self):
+        """
+        Return the number of groups, how many groups were queried, and the number of values
+        kept sorted for MIN and MAX.
+        """
+        extremes = [aggregator for aggregator in self.aggregators if isinstance(aggregator, Extreme)]
+        return {
+            "groups": len(self.groups),
+            "rescans": self.rescan_count,
+            "minmax_values": sum(aggregator.size(acc) for acc in self.groups.values() for aggregator in extremes),
+        }
 
-        for cb in self.update_cbs:
-            cb(dict(zip(self.columns, prev_group)), dict(zip(self.columns, new_group)))
-    
     def fetchone(self, **values):
-        if not values and tuple([]) in self.group_map:
-            return Row(dict(zip(self.columns, self.group_map[tuple([])])), self)
+        if not values and tuple([]) in self.groups:
+            row = self.output((), self.groups[()])
+            return Row(dict(zip(self.columns, row)), self) if self.passing([row])[0] else None
         return super().fetchone(**values)
 
 CHECK_SAME_THREAD = False
@@ -1826,6 +2655,63 @@ def track_views():
                 raise Exception(f"Views don't match for {type(view)} defined by {view.query}: {query}:\ncomputed: {rows}\nactual: {rows2}\nbefore: {before}")
     return end_track
 
+class ViewBuild:
+    """
+    The changes the parents of a view send while the view is built from a snapshot.
+
+    Taps on the parents' callbacks record the deltas and resets from the start of the snapshot,
+    and the view's own callbacks do nothing until finish sends it what was recorded.
+    """
+    def __init__(self, parents):
+        self.done = False
+        self.events = []
+        self.taps = []
+        self.listeners = []
+        self.wrappers = set()
+        for parent in parents:
+            for cbs in (parent.delta_cbs, parent.reset_cbs):
+                if not any(cbs is tapped for tapped, _ in self.taps):
+                    tap = lambda *args, cbs=cbs: self.events.append((cbs, args))
+                    cbs.append(tap)
+                    self.taps.append((cbs, tap))
+
+    def listener(self, cbs, cb):
+        """
+        Return the callback to subscribe instead of cb, which waits for the view to be built.
+        """
+        if cb in self.wrappers:
+            # A callback reused for another parent
+            self.listeners.append((cbs, cb))
+            return cb
+        wrapper = lambda *args: cb(*args) if self.done else None
+        self.wrappers.add(wrapper)
+        self.listeners.append((cbs, wrapper))
+        return wrapper
+
+    def finish(self, db, built):
+        """
+        Send the recorded deltas to the built view, under the writer lock.
+
+        Returns:
+            bool: False if a parent was reset, so the view has to be built again.
+        """
+        for cbs, tap in self.taps:
+            cbs.remove(tap)
+        events, listeners = self.events, self.listeners
+        self.events, self.taps, self.listeners, self.wrappers = [], [], [], set()
+        resets = any(not args for _, args in events)
+        if not built or resets:
+            return not resets
+        self.done = True
+        # The rows loaded already contain the changes up to the snapshot, and queries now see
+        # all the recorded ones, like the deltas of one transaction
+        with db.batch():
+            for cbs, args in events:
+                for listened, cb in listeners:
+                    if listened is cbs:
+                        cb(*args)
+        return True
+
 class Database:
     """
     Represents a SQLite database with reactive capabilities.
@@ -1835,9 +2721,10 @@ class Database:
 
     Attributes:
         conn (sqlite3.Connection): The database connection.
-        update_cbs (list): Callbacks for update operations.
-        insert_cbs (list): Callbacks for insert operations.
-        delete_cbs (list): Callbacks for delete operations.
+        update_cbs (dict): Callbacks for update operations, by table name.
+        insert_cbs (dict): Callbacks for insert operations, by table name.
+        delete_cbs (dict): Callbacks for delete operations, by table name.
+        delta_cbs (dict): Callbacks for batches of changes, by table name.
 
     Methods:
         execute(query, params=None): Execute a SQL query.
@@ -1848,17 +2735,25 @@ class Database:
         ...
     """
 
-    def __init__(self, db_name: str, use_triggers=True):
+    def __init__(self, db_name: str, use_triggers=True, readers=None, cached_statements=CACHED_STATEMENTS, external_writes=False):
         """
         Initialize a new Database instance.
 
         Args:
             db_name (str): The name of the SQLite database file.
             use_triggers (bool): Whether to use triggers for change tracking.
+            readers (int): The maximum number of read-only connections for queries, by default
+                up to 4 depending on the number of cores. In-memory databases only use one connection.
+            cached_statements (int): The number of prepared statements each connection keeps.
+            external_writes (bool): Whether other processes write the database file. The changelog
+                and its triggers are then stored in the file, so their writes are recorded too, and
+                poll() or watch() propagate them to the views. Requires use_triggers.
         """
         self.use_triggers = use_triggers
         self.db_name = db_name
-        self.conn = sqlite3.connect(db_name, check_same_thread=CHECK_SAME_THREAD)
+        self.cached_statements = cached_statements
+        self.conn = sqlite3.connect(db_name, check_same_thread=CHECK_SAME_THREAD, cached_statements=cached_statements)
+        register_functions(self.conn)
         self.conn.execute("PRAGMA journal_mode=WAL;")
         self.conn.execute("PRAGMA synchronous=NORMAL;")
         self.conn.execute("PRAGMA temp_store=MEMORY;")
@@ -1867,12 +2762,57 @@ class Database:
         self.local = threading.local()
         self.cursor = self.conn.cursor()
         self.lock = threading.RLock()
+        # Writes in progress, and the number of finished ones, to detect reads that overlapped a write
+        self.writers = 0
+        self.generation = 0
+        if readers is None:
+            readers = min(4, os.cpu_count() or 1)
+        self.max_readers = readers if db_name not in (":memory:", "") else 0
+        self.readers = queue.LifoQueue()
+        self.reader_count = 0
+        self.readers_lock = threading.Lock()
+        self.temp_tables = None
+        self.read_stats = {"pool": 0, "writer": 0, "retried": 0, "snapshot": 0}
+        # The most recently run statements, like the statement cache of a connection, for statement_stats
+        self.statements = collections.OrderedDict()
+        self.statements_lock = threading.Lock()
+        self.statement_counts = {"hits": 0, "misses": 0}
         self.tohtml = None
 
         self.tables = {}
-        self.insert_cbs = []
-        self.update_cbs = []
-        self.delete_cbs = []
+        # Derived views by class, parent views and arguments, while they are in use
+        self.views = weakref.WeakValueDictionary()
+        self.insert_cbs = {}
+        self.update_cbs = {}
+        self.delete_cbs = {}
+        self.delta_cbs = {}
+        self.deferred = []
+        # State views keep while the changes of one batch are dispatched, see dispatch_batch
+        self.batch_state = None
+        self.transaction_depth = 0
+        self.pending_changes = {}
+        # The changes of all tables are recorded by triggers in one changelog, in the order of
+        # seq, with the old and new value of column i of the table in o{i} and n{i}
+        self.table_ids = {}
+        self.table_names = {}
+        self.table_widths = {}
+        self.changelog_width = 0
+        self.last_seq = 0
+        self.truncated_seq = 0
+        self.change_cbs = []
+        # With external writes, the changelog is shared by all connections to the file, and the
+        # ids of the tables are kept in _rsql_tables so the triggers of all connections agree
+        self.external_writes = external_writes and use_triggers
+        self.data_version = None
+        if self.external_writes:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS _rsql_changes (seq INTEGER PRIMARY KEY, table_id INTEGER, action INTEGER)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS _rsql_tables (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+            self.conn.commit()
+            self.reset_changelog()
+            self.truncated_seq = self.last_seq
+            self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        elif use_triggers:
+            self.conn.execute("CREATE TEMP TABLE _rsql_changes (seq INTEGER PRIMARY KEY, table_id INTEGER, action INTEGER)")
         self.get_cursor()
 
     def get_cursor(self):
@@ -1884,6 +2824,139 @@ class Database:
         """
         return self.cursor
 
+    @contextlib.contextmanager
+    def write_lock(self):
+        """
+        Hold the lock of the writer connection for a write and the propagation of its changes.
+
+        Queries of the same thread inside the block use the writer connection, so they see the
+        changes that are not committed yet.
+        """
+        with self.lock:
+            self.writers += 1
+            self.local.writing = getattr(self.local, "writing", 0) + 1
+            try:
+                yield
+            finally:
+                self.local.writing -= 1
+                self.writers -= 1
+                self.generation += 1
+
+    def note_statement(self, query):
+        """
+        Count whether query was among the last cached_statements statements, that is whether
+        sqlite3 could reuse its prepared statement.
+        """
+        with self.statements_lock:
+            if query in self.statements:
+                self.statements.move_to_end(query)
+                self.statement_counts["hits"] += 1
+            else:
+                self.statements[query] = None
+                self.statement_counts["misses"] += 1
+                if len(self.statements) > self.cached_statements:
+                    self.statements.popitem(last=False)
+
+    def statement_stats(self):
+        """
+        Return how often statements were reused.
+
+        Returns:
+            dict: The hits and misses of the statement cache, the hit rate, and the number of
+                statements in the cache.
+        """
+        hits, misses = self.statement_counts["hits"], self.statement_counts["misses"]
+        return {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "statements": len(self.statements)}
+
+    def run_statement(self, cursor, query, params=None, many=False):
+        """
+        Run a statement of a write on cursor, counting it in statement_stats.
+        """
+        self.note_statement(query)
+        if many:
+            return executemany(cursor, query, params)
+        return execute(cursor, query, params)
+
+    def reader(self):
+        """
+        Take a read-only connection from the pool, opening one if there are less than max_readers.
+        """
+        try:
+            return self.readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self.readers_lock:
+            opened = self.reader_count < self.max_readers
+            if opened:
+                self.reader_count += 1
+        if not opened:
+            return self.readers.get()
+        conn = sqlite3.connect(self.db_name, check_same_thread=False, isolation_level=None, cached_statements=self.cached_statements)
+        register_functions(conn)
+        conn.execute("PRAGMA query_only=ON;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA mmap_size=134217728;")
+        return conn
+
+    def read(self, fetch, query, values=None):
+        """
+        Run a query with fetch(cursor) on a read-only connection, or on the writer connection if
+        the query could see other data there.
+
+        The writer connection is used inside writes and transactions, while the writer connection
+        has uncommitted changes, and for queries of TEMP tables, which only exist there. A query
+        that overlapped a write is run again on the writer connection after the write, so a
+        view loading its rows doesn't see a write without getting its changes, or the other way
+        around.
+        """
+        self.note_statement(query)
+        snapshot = getattr(self.local, "snapshot", None)
+        if snapshot is not None:
+            # A view being built reads everything from the same snapshot, see build_view
+            cursor = snapshot.cursor()
+            try:
+                if values:
+                    cursor.execute(query, values)
+                else:
+                    cursor.execute(query)
+                result = fetch(cursor)
+            except Exception as e:
+                raise Exception(f"Error executing query: {query}" + (f" with values: {values}" if values else "")) from e
+            self.read_stats["snapshot"] += 1
+            return result
+        generation = self.generation
+        if (self.max_readers and not self.writers and not getattr(self.local, "writing", 0) and not self.conn.in_transaction
+                and not (self.temp_tables and self.temp_tables.search(query))):
+            conn = self.reader()
+            try:
+                cursor = conn.cursor()
+                if values:
+                    cursor.execute(query, values)
+                else:
+                    cursor.execute(query)
+                result = fetch(cursor)
+            except Exception as e:
+                raise Exception(f"Error executing query: {query}" + (f" with values: {values}" if values else "")) from e
+            finally:
+                self.readers.put(conn)
+            if generation == self.generation and not self.writers:
+                self.read_stats["pool"] += 1
+                return result
+            self.read_stats["retried"] += 1
+        with self.lock:
+            self.read_stats["writer"] += 1
+            cursor = self.get_cursor()
+            try:
+                if values:
+                    cursor.execute(query, values)
+                else:
+                    cursor.execute(query)
+                return fetch(cursor)
+            except Exception as e:
+                self.rollback()
+                raise Exception(f"Error executing query: {query}" + (f" with values: {values}" if values else "")) from e
+
     def tables(self):
         """
         Get a list of all tables in the database.
@@ -1909,43 +2982,440 @@ class Database:
         if table_name not in self.tables:
             table = Table(self, table_name, id=id, temp=temp, **columns)
             self.tables[table_name] = table
+            if temp:
+                temp_tables = [name for name, t in self.tables.items() if t.temp]
+                self.temp_tables = re.compile(r"\b(" + "|".join(map(re.escape, temp_tables)) + r")\b", re.IGNORECASE)
             if self.use_triggers:
-                col_defs = [(col, "INTEGER" if "PRIMARY KEY" in dtype else dtype) for col, dtype in table.column_definitions]
-                self.execute(
-                    f"CREATE TEMP TABLE {table_name}_rows (action INTEGER, {', '.join([f'old_{col} {dtype}, new_{col} {dtype}' for col, dtype in col_defs])})")
-                self.execute(
-                    f"CREATE TEMP TRIGGER {table_name}_insert AFTER INSERT ON {table_name} BEGIN INSERT INTO {table_name}_rows (action, {', '.join([f'new_{col}' for col in table.columns])}) VALUES (1, {', '.join([f'NEW.{col}' for col in table.columns])}); END;")
-                self.execute(
-                    f"CREATE TEMP TRIGGER {table_name}_update AFTER UPDATE ON {table_name} BEGIN INSERT INTO {table_name}_rows (action, {', '.join([f'old_{col}, new_{col}' for col in table.columns])}) VALUES (2, {', '.join([f'OLD.{col}, NEW.{col}' for col in table.columns])}); END;")
-                self.execute(
-                    f"CREATE TEMP TRIGGER {table_name}_delete AFTER DELETE ON {table_name} BEGIN INSERT INTO {table_name}_rows (action, {', '.join([f'old_{col}' for col in table.columns])}) VALUES (3, {', '.join([f'OLD.{col}' for col in table.columns])}); END;")
+                if self.external_writes:
+                    self.execute("INSERT OR IGNORE INTO _rsql_tables (name) VALUES (?)", (table_name,))
+                    table_id = self.execute("SELECT id FROM _rsql_tables WHERE name = ?", (table_name,))[0][0]
+                    # Other connections may have widened the changelog already
+                    self.changelog_width = (len(self.execute("PRAGMA table_info(_rsql_changes)")) - 3) // 2
+                else:
+                    table_id = len(self.table_names)
+                self.table_ids[table_name] = table_id
+                self.table_names[table_id] = table_name
+                self.table_widths[table_id] = len(table.columns)
+                # The changelog has no column types, so the values are recorded as they are stored
+                for i in range(self.changelog_width, len(table.columns)):
+                    self.execute(f"ALTER TABLE _rsql_changes ADD COLUMN o{i}")
+                    self.execute(f"ALTER TABLE _rsql_changes ADD COLUMN n{i}")
+                self.changelog_width = max(self.changelog_width, len(table.columns))
+                indices = range(len(table.columns))
+                triggers = {
+                    "insert": f"AFTER INSERT ON {table_name} BEGIN INSERT INTO _rsql_changes (table_id, action, {', '.join([f'n{i}' for i in indices])}) VALUES ({table_id}, 1, {', '.join([f'NEW.{col}' for col in table.columns])}); END;",
+                    "update": f"AFTER UPDATE ON {table_name} BEGIN INSERT INTO _rsql_changes (table_id, action, {', '.join([f'o{i}, n{i}' for i in indices])}) VALUES ({table_id}, 2, {', '.join([f'OLD.{col}, NEW.{col}' for col in table.columns])}); END;",
+                    "delete": f"AFTER DELETE ON {table_name} BEGIN INSERT INTO _rsql_changes (table_id, action, {', '.join([f'o{i}' for i in indices])}) VALUES ({table_id}, 3, {', '.join([f'OLD.{col}' for col in table.columns])}); END;",
+                }
+                for action, body in triggers.items():
+                    if self.external_writes and not temp:
+                        # Persistent triggers also record the writes of other processes. They are
+                        # only replaced when the columns changed, so connections don't race to
+                        # recreate them.
+                        sql = f"CREATE TRIGGER _rsql_{table_name}_{action} {body}"
+                        existing = self.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name = ?", (f"_rsql_{table_name}_{action}",))
+                        if existing and existing[0][0] == sql:
+                            continue
+                        if existing:
+                            self.execute(f"DROP TRIGGER _rsql_{table_name}_{action}")
+                        self.execute(sql)
+                    else:
+                        self.execute(f"CREATE TEMP TRIGGER {table_name}_{action} {body}")
         return self.tables[table_name]
 
-    def respond_to_changes(self, table_name):
+    def subscribe(self, table_name, insert=None, update=None, delete=None, delta=None):
+        """
+        Register callbacks for the changes of one table.
+
+        Only the callbacks of the changed table are called, so the cost of a change
+        doesn't grow with the number of tables.
+
+        Args:
+            table_name (str): The name of the table.
+            insert: Called with (table_name, values) for inserted rows.
+            update: Called with (table_name, old, new) for updated rows.
+            delete: Called with (table_name, row) for deleted rows.
+            delta: Called with (table_name, inserts, updates, deletes) once for each batch of changes.
+
+        Returns:
+            function: Removes the callbacks.
+        """
+        registrations = [(cbs, cb) for cbs, cb in ((self.insert_cbs, insert), (self.update_cbs, update), (self.delete_cbs, delete),
+                                                   (self.delta_cbs, delta)) if cb is not None]
+        for cbs, cb in registrations:
+            cbs.setdefault(table_name, []).append(cb)
+        def unsubscribe():
+            for cbs, cb in registrations:
+                table_cbs = cbs.get(table_name)
+                if table_cbs and cb in table_cbs:
+                    table_cbs.remove(cb)
+                    if not table_cbs:
+                        del cbs[table_name]
+        return unsubscribe
+
+    def shared_view(self, cls, /, *args, **kwargs):
+        """
+        Return the view cls(*args, **kwargs), sharing it with everyone who asked for the same one.
+
+        Views are identified by their class, the identity of their parent views and their
+        arguments, so a pipeline built again for every page or tab is materialized and kept up
+        to date once. A view leaves the registry when it's garbage collected. Shared views can't
+        be changed in place, for example with Sort.set_limit, as that would change them for
+        everyone holding them.
+
+        Args:
+            cls: The view class.
+            *args, **kwargs: The arguments of the view, the parent views first.
+
+        Returns:
+            View: The new or the shared view.
+        """
+        key = (cls, args, tuple(kwargs.items()))
+        try:
+            with self.lock:
+                view = self.views.get(key)
+        except TypeError:
+            # Arguments that can't be hashed can't be compared either
+            return self.build_view(cls, False, *args, **kwargs)
+        if view is not None:
+            return view
+        view = self.build_view(cls, False, *args, **kwargs)
+        with self.lock:
+            # Another thread may have built the same view meanwhile
+            shared = self.views.get(key)
+            if shared is not None:
+                return shared
+            view.shared_key = key
+            self.views[key] = view
+        return view
+
+    def build_view(self, cls, shared, /, *args, **kwargs):
+        """
+        Return the view cls(*args, **kwargs), the shared one if shared is true.
+
+        Views subscribe to their parents before they load their rows, and the rows and the
+        deltas must agree. The view is loaded from a snapshot, a read transaction on a
+        read-only connection, so writes go on while it loads. The deltas its parents send
+        after the snapshot are held back and sent to it, as one batch, once it's built. If a
+        parent was reset meanwhile, the view is built again under the writer lock.
+
+        In-memory databases, views of TEMP tables and views built inside a write are built
+        under the writer lock, as their queries run on the writer connection.
         """
-        Respond to changes in the specified table or all tables.
+        if shared:
+            return self.shared_view(cls, *args, **kwargs)
+        if getattr(self.local, "build", None) is not None:
+            # Built as part of the view being built, from the same snapshot
+            return cls(*args, **kwargs)
+        parents = [arg for arg in args if isinstance(arg, View)]
+        if (not self.max_readers or getattr(self.local, "writing", 0)
+                or (self.temp_tables and any(self.temp_tables.search(parent.query) for parent in parents))):
+            with self.lock:
+                return cls(*args, **kwargs)
+        with self.lock:
+            if self.conn.in_transaction:
+                return cls(*args, **kwargs)
+            conn = self.reader()
+            try:
+                # The snapshot starts with the first read of the transaction
+                conn.execute("BEGIN")
+                conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            except BaseException:
+                self.readers.put(conn)
+                raise
+            build = ViewBuild(parents)
+        self.local.build, self.local.snapshot = build, conn
+        view = None
+        try:
+            view = cls(*args, **kwargs)
+        finally:
+            self.local.build = self.local.snapshot = None
+            conn.execute("COMMIT")
+            self.readers.put(conn)
+            with self.lock:
+                built = build.finish(self, view is not None)
+        if built:
+            return view
+        with self.lock:
+            return cls(*args, **kwargs)
+
+    def listen(self, cbs, cb):
+        """
+        Append cb to the callbacks cbs of a parent view, and return what was appended.
+
+        While a view is built from a snapshot on this thread, cb is held back until it's built,
+        see build_view.
+        """
+        build = getattr(self.local, "build", None)
+        if build is not None:
+            cb = build.listener(cbs, cb)
+        cbs.append(cb)
+        return cb
+
+    def check_private(self, view):
+        """
+        Raise before a shared view is changed in place, which would change it for everyone holding it.
+        """
+        if view.shared_key is not None:
+            raise Exception(f"Shared {type(view).__name__} can't be changed in place, create it with shared=False")
+
+    def defer(self, cb):
+        """
+        Call cb after the current changes have been propagated to all views.
+
+        Views that query the database to repair their state use this, so that after a
+        bulk write they query the database once, after all rows have been seen.
 
         Args:
-            table_name (str or None): The name of the table to respond to changes, or None for all tables.
+            cb (function): The function to call; it is only queued once.
         """
-        if table_name == None:
-            for table_name in self.tables.keys():
-                self.respond_to_changes(table_name)
+        if cb not in self.deferred:
+            self.deferred.append(cb)
+
+    def run_deferred(self):
+        while self.deferred:
+            self.deferred.pop(0)()
+
+    def respond_to_changes(self, table_name=None):
+        """
+        Respond to the changes recorded in the changelog since the last call.
+
+        The new changes of all tables are read with one query by their sequence number, and
+        only the tables that changed are dispatched, in the order of their first change.
+        Drained changes are deleted from the changelog once CHANGELOG_TRUNCATE of them
+        accumulated. Inside a transaction nothing happens; the changes are propagated when it ends.
+
+        Args:
+            table_name (str or None): The table that was written; changes of other tables, for
+                example by foreign key actions, are propagated too.
+        """
+        if self.transaction_depth:
+            return
+        actions = self.conn.execute("SELECT * FROM _rsql_changes WHERE seq > ?", (self.last_seq,)).fetchall()
+        if not actions:
+            return
+        self.last_seq = actions[-1][0]
+        if self.last_seq - self.truncated_seq >= CHANGELOG_TRUNCATE:
+            # The last change stays, so the next sequence number is still after it. A persistent
+            # changelog keeps CHANGELOG_RETAIN changes for the other connections.
+            retain = CHANGELOG_RETAIN if self.external_writes else 0
+            self.conn.execute("DELETE FROM _rsql_changes WHERE seq < ?", (self.last_seq - retain,))
+            self.truncated_seq = self.last_seq
+            if not self.external_writes:
+                # The persistent triggers of connections with external_writes record the writes
+                # of this one too, in the changelog of the file, which the TEMP one hides here
+                if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='_rsql_changes'").fetchone():
+                    self.conn.execute("DELETE FROM main._rsql_changes WHERE seq < (SELECT MAX(seq) FROM main._rsql_changes) - ?", (CHANGELOG_RETAIN,))
+        changes, stream = {}, []
+        for seq, table_id, action, *values in actions:
+            if table_id not in self.table_widths:
+                # A table of another connection that isn't used here
+                continue
+            n = 2 * self.table_widths[table_id]
+            change = (action, tuple(values[0:n:2]) if action != 1 else None, tuple(values[1:n:2]) if action != 3 else None)
+            changes.setdefault(table_id, []).append(change)
+            if self.change_cbs:
+                stream.append((seq, self.table_names[table_id], *change))
+        for cb in list(self.change_cbs):
+            cb(stream)
+        self.dispatch_batch([(self.table_names[table_id], coalesce_changes(table_changes))
+                             for table_id, table_changes in changes.items() if self.table_names[table_id] in self.tables])
+
+    def subscribe_changes(self, cb):
+        """
+        Call cb with the changes of all tables in the order they were made, once for each batch
+        of changes that is propagated, before the views are updated.
+
+        Args:
+            cb: Called with a list of (seq, table_name, action, old, new) tuples, where action is 1
+                for inserts, 2 for updates and 3 for deletes, seq increases across batches, and old
+                and new are tuples of the column values, or None.
+
+        Returns:
+            function: Removes the callback.
+        """
+        self.change_cbs.append(cb)
+        return lambda: self.change_cbs.remove(cb)
+
+    def reset_changelog(self):
+        # Changes that were rolled back are gone from the changelog, and their sequence numbers
+        # are given to the next changes
+        if self.use_triggers:
+            self.last_seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM _rsql_changes").fetchone()[0]
+
+    def poll(self):
+        """
+        Propagate the changes that other connections committed to the database file since the
+        last poll, if the database was opened with external_writes.
+
+        PRAGMA data_version tells whether anything was committed by others, so a poll without
+        changes is one cheap query. If the changelog was truncated past changes this connection
+        didn't read yet, the views of all tables are reset instead.
+
+        Returns:
+            bool: Whether other connections committed changes.
+        """
+        if not self.external_writes:
+            return False
+        with self.lock:
+            if self.transaction_depth:
+                return False
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self.data_version:
+                return False
+            self.data_version = data_version
+            with self.write_lock():
+                first = self.conn.execute("SELECT MIN(seq) FROM _rsql_changes").fetchone()[0]
+                if first is not None and first > self.last_seq + 1:
+                    self.reset_changelog()
+                    self.truncated_seq = self.last_seq
+                    for table in list(self.tables.values()):
+                        table.call_reset_cbs()
+                else:
+                    self.respond_to_changes(None)
+                self.commit()
+            return True
+
+    def watch(self, interval=0.1):
+        """
+        Poll for the changes of other connections every interval seconds on a background thread.
+
+        Returns:
+            function: Stops polling.
+        """
+        stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.poll()
+                except Exception:
+                    traceback.print_exc()
+        threading.Thread(target=run, name="rsql-poll", daemon=True).start()
+        return stop.set
+
+    def propagate_changes(self, table_name, changes):
+        """
+        Propagate changes that were not recorded by triggers, or queue them inside a transaction.
+
+        Args:
+            table_name (str): The name of the table.
+            changes (list): (action, old, new) tuples, as in coalesce_changes.
+        """
+        if self.transaction_depth:
+            self.pending_changes.setdefault(table_name, []).extend(changes)
         else:
-            actions = self.conn.execute(f"SELECT * FROM {table_name}_rows;").fetchall()
-            for action in actions:
-                if action[0] == 1:
-                    for cb in self.insert_cbs:
-                        cb(table_name, Row({k: v for k, v in zip(self.tables[table_name].columns, action[2::2])}, table_name))
-                elif action[0] == 2:
-                    for cb in self.update_cbs:
-                        cb(table_name, Row({k: v for k, v in zip(self.tables[table_name].columns, action[1::2])}, table_name),
-                           Row({k: v for k, v in zip(self.tables[table_name].columns, action[2::2])}, table_name))
-                elif action[0] == 3:
-                    for cb in self.delete_cbs:
-                        cb(table_name, action[1::2])
-            self.conn.execute(f"DELETE FROM {table_name}_rows;")
-    
+            self.dispatch_batch([(table_name, coalesce_changes(changes))])
+
+    def dispatch_batch(self, batch):
+        """
+        Dispatch the changes of several tables, given as (table_name, changes) pairs.
+
+        The tables are dispatched one after the other, but queries already see the changes of all
+        of them. Views that query their inputs while handling a delta, like Join, keep what they
+        need to correct for that in batch_state, which lasts until the batch is dispatched. Views
+        whose state has "pending" deltas get flush_batch(state) called once all tables are dispatched.
+        Then the deferred callbacks run.
+        """
+        with self.batch():
+            for table_name, changes in batch:
+                self.dispatch_changes(table_name, changes)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Treat the deltas sent to the views in the block as one batch, see dispatch_batch.
+        """
+        outer, self.batch_state = self.batch_state, {}
+        try:
+            yield
+            # Views are flushed after the views they depend on, whose flushed deltas they may
+            # hold back too
+            while pending := [view for view, state in self.batch_state.items() if state.get("pending")]:
+                view = next(view for view in pending if not any(ancestor in pending for ancestor in view_ancestors(view)))
+                view.flush_batch(self.batch_state[view])
+        finally:
+            self.batch_state = outer
+        self.run_deferred()
+
+    def dispatch_changes(self, table_name, changes):
+        columns = self.tables[table_name].columns
+        inserts = [Row({k: v for k, v in zip(columns, new)}, table_name) for action, _, new in changes if action == 1]
+        updates = [(Row({k: v for k, v in zip(columns, old)}, table_name), Row({k: v for k, v in zip(columns, new)}, table_name))
+                   for action, old, new in changes if action == 2]
+        deletes = [old for action, old, _ in changes if action == 3]
+        for cb in self.delta_cbs.get(table_name, ()):
+            cb(table_name, inserts, updates, deletes)
+        inserts, updates, deletes = iter(inserts), iter(updates), iter(deletes)
+        for action, _, _ in changes:
+            if action == 1:
+                values = next(inserts)
+                for cb in self.insert_cbs.get(table_name, ()):
+                    cb(table_name, values)
+            elif action == 2:
+                old, new = next(updates)
+                for cb in self.update_cbs.get(table_name, ()):
+                    cb(table_name, old, new)
+            else:
+                row = next(deletes)
+                for cb in self.delete_cbs.get(table_name, ()):
+                    cb(table_name, row)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run several writes in one transaction.
+
+        The writes inside the block don't commit or update the views. When the outermost
+        block exits, the net changes of all tables are propagated and committed once: an insert
+        followed by a delete of the same row cancels out, and chained updates collapse.
+        If the block raises, everything is rolled back and no callbacks are called.
+
+        The database lock is held for the whole block. Nested blocks are part of the outermost one.
+
+        Example:
+            with db.transaction():
+                db.execute("DELETE FROM steps WHERE step >= ?", (step,))
+                steps.insert(step=step, col=col, row=row)
+        """
+        with self.write_lock():
+            self.transaction_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.transaction_depth -= 1
+                if not self.transaction_depth:
+                    self.pending_changes = {}
+                    self.conn.rollback()
+                    self.reset_changelog()
+                raise
+            self.transaction_depth -= 1
+            if self.transaction_depth:
+                return
+            try:
+                if DEBUG_VIEWS:
+                    views = track_views()
+                if self.use_triggers:
+                    self.respond_to_changes(None)
+                else:
+                    pending_changes, self.pending_changes = self.pending_changes, {}
+                    self.dispatch_batch([(table_name, coalesce_changes(changes)) for table_name, changes in pending_changes.items()])
+                self.conn.commit()
+                if DEBUG_VIEWS:
+                    views("transaction")
+            except Exception as e:
+                self.conn.rollback()
+                self.reset_changelog()
+                raise e
+
+    def commit(self):
+        if not self.transaction_depth:
+            self.conn.commit()
+
+    def rollback(self):
+        if not self.transaction_depth:
+            self.conn.rollback()
+            self.reset_changelog()
+
     def insert(self, table_name: str, ignore=False, **values):
         """
         Insert a new row into the specified table.
@@ -1955,28 +3425,25 @@ class Database:
             ignore (bool): Whether to ignore conflicts.
             **values: The values to insert.
         """
-        with self.lock:
+        with self.write_lock():
             cursor = self.get_cursor()
             try:
                 if DEBUG_VIEWS:
                     views = track_views()
-                query = f"INSERT {'OR IGNORE' if ignore else ''} INTO {table_name} ({', '.join(values.keys())}) VALUES ({', '.join(['?' for _ in values])})"
-                execute(cursor, query, tuple(values.values()))
+                query = insert_statement(table_name, tuple(values), ignore)
+                self.run_statement(cursor, query, tuple(values.values()))
                 if ignore and cursor.rowcount == 0:
                     return
                 if self.use_triggers:
                     self.respond_to_changes(table_name)
                 else:
                     cursor.execute(f"SELECT * FROM {table_name} WHERE rowid = ?", (cursor.lastrowid,))
-                    inserted_row = cursor.fetchone()
-                    data = {k[0]: v for k, v in zip(cursor.description, inserted_row)}
-                    for cb in self.insert_cbs:
-                        cb(table_name, data)
-                self.conn.commit()
+                    self.propagate_changes(table_name, [(1, None, cursor.fetchone())])
+                self.commit()
                 if DEBUG_VIEWS:
                     views(query)
             except Exception as e:
-                self.conn.rollback()
+                self.rollback()
                 raise e
 
     def delete(self, table_name: str, **values):
@@ -1987,25 +3454,23 @@ class Database:
             table_name (str): The name of the table.
             **values: The conditions for deletion.
         """
-        with self.lock:
+        with self.write_lock():
             if DEBUG_VIEWS:
                 views = track_views()
             cursor = self.get_cursor()
             # get deleted rows
             where_clause, remaining_values = create_where_null_clause(values.keys(), values.values())
-            execute(cursor, f"SELECT * FROM {table_name} {where_clause}", remaining_values)
+            self.run_statement(cursor, f"SELECT * FROM {table_name} {where_clause}", remaining_values)
             deleted_rows = cursor.fetchall()
             description = [x[0] for x in cursor.description]
             for row in deleted_rows:
                 where_clause, remaining_values = create_where_null_clause(description, row)
-                execute(cursor, f"DELETE FROM {table_name} {where_clause}", remaining_values)
+                self.run_statement(cursor, f"DELETE FROM {table_name} {where_clause}", remaining_values)
                 if self.use_triggers:
                     self.respond_to_changes(table_name)
-                else:
-                    for row in deleted_rows:
-                        for cb in self.delete_cbs:
-                            cb(table_name, row)
-            self.conn.commit()
+            if not self.use_triggers:
+                self.propagate_changes(table_name, [(3, row, None) for row in deleted_rows])
+            self.commit()
             if DEBUG_VIEWS:
                 views(f"DELETE FROM {table_name} {where_clause}")
 
@@ -2018,42 +3483,152 @@ class Database:
             where (dict): The conditions for updating.
             **values: The new values to set.
         """
-        with self.lock:
+        with self.write_lock():
             if DEBUG_VIEWS:
                 views = track_views()
             cursor = self.get_cursor()
             try:
                 where_clause, remaining_values = create_where_null_clause(where.keys(), where.values())
-                execute(cursor, f"SELECT * FROM {table_name} {where_clause};", remaining_values)
+                self.run_statement(cursor, f"SELECT * FROM {table_name} {where_clause};", remaining_values)
                 old_rows = cursor.fetchall()
                 description = [x[0] for x in cursor.description]
-                set_clause = f"SET {', '.join([f'{k}=?' for k in values])}"
-                execute(cursor, f"UPDATE {table_name} {set_clause} {where_clause};", tuple(values.values()) + remaining_values)
+                query = update_statement(table_name, tuple(values), where_clause)
+                self.run_statement(cursor, query, tuple(values.values()) + remaining_values)
                 if len(old_rows) != cursor.rowcount:
                     raise Exception("Update failed: where clause does not match any rows.")
-                desc_from_upper = {k.upper(): k for k in description}
-                updated_values = {desc_from_upper[k.upper()]: v for k, v in values.items()}
-                for row in old_rows:
-                    old = {k: v for k, v in zip(description, row)}
-                    new = {**old, **updated_values}
-                    if old == new:
-                        continue
+                if self.use_triggers:
+                    self.respond_to_changes(table_name)
+                else:
+                    self.propagate_changes(table_name, [(2, row, updated_row(description, row, values)) for row in old_rows])
+                self.commit()
+                if DEBUG_VIEWS:
+                    views(query)
+            except Exception as e:
+                self.rollback()
+                raise e
+    
+    def insert_many(self, table_name: str, rows, ignore=False):
+        """
+        Insert many rows into the specified table in one transaction.
+
+        Consecutive rows with the same columns are inserted with a single executemany,
+        and the changes are propagated to the views in one pass after all rows are written.
+
+        Args:
+            table_name (str): The name of the table.
+            rows (list): A list of dicts of column values.
+            ignore (bool): Whether to ignore conflicts.
+        """
+        with self.write_lock():
+            if DEBUG_VIEWS:
+                views = track_views()
+            cursor = self.get_cursor()
+            try:
+                inserted_rows = []
+                for columns, group in itertools.groupby(rows, key=lambda values: tuple(values.keys())):
+                    query = insert_statement(table_name, columns, ignore)
+                    params = [tuple(values.values()) for values in group]
                     if self.use_triggers:
-                        self.respond_to_changes(table_name)
+                        self.run_statement(cursor, query, params, many=True)
                     else:
-                        for cb in self.update_cbs:
-                            cb(table_name, old, new)
-                self.conn.commit()
+                        for values in params:
+                            self.run_statement(cursor, query, values)
+                            if ignore and cursor.rowcount == 0:
+                                continue
+                            cursor.execute(f"SELECT * FROM {table_name} WHERE rowid = ?", (cursor.lastrowid,))
+                            inserted_rows.append(cursor.fetchone())
+                if self.use_triggers:
+                    self.respond_to_changes(table_name)
+                else:
+                    self.propagate_changes(table_name, [(1, None, row) for row in inserted_rows])
+                self.commit()
                 if DEBUG_VIEWS:
-                    views(f"UPDATE {table_name} {set_clause} {where_clause}")
+                    views(f"INSERT INTO {table_name} ({len(rows)} rows)")
             except Exception as e:
-                self.conn.rollback()
+                self.rollback()
                 raise e
-    
+
+    def delete_many(self, table_name: str, wheres):
+        """
+        Delete the rows matching any of the conditions in one transaction.
+
+        Args:
+            table_name (str): The name of the table.
+            wheres (list): A list of dicts of column values.
+        """
+        with self.write_lock():
+            if DEBUG_VIEWS:
+                views = track_views()
+            cursor = self.get_cursor()
+            try:
+                deleted_rows = []
+                clauses = [create_where_null_clause(where.keys(), where.values()) for where in wheres]
+                for where_clause, group in itertools.groupby(clauses, key=lambda clause: clause[0]):
+                    params = [remaining_values for _, remaining_values in group]
+                    if not self.use_triggers:
+                        for remaining_values in params:
+                            self.run_statement(cursor, f"SELECT * FROM {table_name} {where_clause}", remaining_values)
+                            deleted_rows.extend(cursor.fetchall())
+                    self.run_statement(cursor, f"DELETE FROM {table_name} {where_clause}", params, many=True)
+                if self.use_triggers:
+                    self.respond_to_changes(table_name)
+                else:
+                    self.propagate_changes(table_name, [(3, row, None) for row in deleted_rows])
+                self.commit()
+                if DEBUG_VIEWS:
+                    views(f"DELETE FROM {table_name} ({len(wheres)} conditions)")
+            except Exception as e:
+                self.rollback()
+                raise e
+
+    def update_many(self, table_name: str, updates):
+        """
+        Run many updates on the specified table in one transaction.
+
+        Args:
+            table_name (str): The name of the table.
+            updates (list): A list of (where, values) pairs of dicts.
+        """
+        with self.write_lock():
+            if DEBUG_VIEWS:
+                views = track_views()
+            cursor = self.get_cursor()
+            try:
+                changes = []
+                statements = []
+                for where, values in updates:
+                    where_clause, remaining_values = create_where_null_clause(where.keys(), where.values())
+                    statements.append((update_statement(table_name, tuple(values), where_clause), tuple(values.values()) + remaining_values, where_clause, remaining_values, values))
+                for query, group in itertools.groupby(statements, key=lambda statement: statement[0]):
+                    group = list(group)
+                    if self.use_triggers:
+                        self.run_statement(cursor, query, [params for _, params, _, _, _ in group], many=True)
+                        continue
+                    for _, params, where_clause, remaining_values, values in group:
+                        self.run_statement(cursor, f"SELECT * FROM {table_name} {where_clause};", remaining_values)
+                        old_rows = cursor.fetchall()
+                        description = [x[0] for x in cursor.description]
+                        self.run_statement(cursor, query, params)
+                        changes.extend((2, row, updated_row(description, row, values)) for row in old_rows)
+                if self.use_triggers:
+                    self.respond_to_changes(table_name)
+                else:
+                    self.propagate_changes(table_name, changes)
+                self.commit()
+                if DEBUG_VIEWS:
+                    views(f"UPDATE {table_name} ({len(updates)} updates)")
+            except Exception as e:
+                self.rollback()
+                raise e
+
     def execute(self, query, values=None):
         """
         Execute a SQL query on the database.
 
+        With triggers, the changes of a write statement are propagated to the views like those of
+        insert, update and delete, and committed unless inside a transaction. Without triggers
+        the changes can't be seen, so the views of the written tables have to be reset.
+
         Args:
             query (str): The SQL query to execute.
             values (tuple, optional): Parameters for the query.
@@ -2061,10 +3636,12 @@ class Database:
         Returns:
             list: The result of the query execution.
         """
-        with self.lock:
+        self.note_statement(query)
+        with self.write_lock():
             t = time.time()
             cursor = self.get_cursor()
             try:
+                total_changes = self.conn.total_changes
                 if values:
                     cursor.execute(query, values)
                 else:
@@ -2072,9 +3649,12 @@ class Database:
                 r = cursor.fetchall()
                 if DEBUG_SQL:
                     print(f"db.execute {query} ({((time.time() - t) * 1000):.1f}ms)")
+                if self.use_triggers and self.conn.total_changes != total_changes:
+                    self.respond_to_changes(None)
+                    self.commit()
                 return r
             except Exception as e:
-                self.conn.rollback()
+                self.rollback()
                 raise Exception(f"Error executing query: {query}" + (f" with values: {values}" if values else "")) from e
 
     def fetchone(self, query, values=None):
@@ -2088,23 +3668,13 @@ class Database:
         Returns:
             tuple: The first row of the query result.
         """
-        with self.lock:
-            if DEBUG_SQL:
-                if values:
-                    print(f"db.fetchone {query}, values: {values}")
-                else:
-                    print(f"db.fetchone {query}")
-            cursor = self.get_cursor()
-            try:
-                if values:
-                    cursor.execute(query, values)
-                else:
-                    cursor.execute(query)
-                return cursor.fetchone()
-            except Exception as e:
-                self.conn.rollback()
-                raise Exception(f"Error executing query: {query}" + (f" with values: {values}" if values else "")) from e
-    
+        if DEBUG_SQL:
+            if values:
+                print(f"db.fetchone {query}, values: {values}")
+            else:
+                print(f"db.fetchone {query}")
+        return self.read(sqlite3.Cursor.fetchone, query, values)
+
     def fetchall(self, query, values=None):
         """
         Execute a SQL query and fetch all results.
@@ -2116,77 +3686,127 @@ class Database:
         Returns:
             list: All rows of the query result.
         """
-        with self.lock:
-            if DEBUG_SQL:
-                print("db.fetchall", query)
-            cursor = self.get_cursor()
-            try:
-                if values:
-                    cursor.execute(query, values)
-                else:
-                    cursor.execute(query)
-                return cursor.fetchall()
-            except Exception as e:
-                self.conn.rollback()
-                raise Exception(f"Error executing query: {query}" + (f" with values: {values}" if values else "")) from e
+        if DEBUG_SQL:
+            print("db.fetchall", query)
+        return self.read(sqlite3.Cursor.fetchall, query, values)
 
     def __del__(self):
         """
-        Close the database connection when the object is deleted.
+        Close the database connections when the object is deleted.
         """
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
         self.conn.close()
 
-def sql_cmp(a, b):
-    if a == b:
-        return 0
-    elif a is None:
-        return -1
-    elif b is None:
-        return 1
-    else:
-        return (a > b) - (a < b)
+def sql_cmp(a, b, collation="BINARY"):
+    return sql_compare(a, b, collation)
 
 class Sort(View):
-    def __init__(self, parent, order_by=None, limit=None, offset=None):
+    def __init__(self, parent, order_by=None, limit=None, offset=None, overflow=16):
         self.parent = parent
         super().__init__(parent.db)
         if isinstance(order_by, str):
             order_by = [order_by]
-        self.order_by = order_by if order_by else []
+        self.order_by = list(order_by) if order_by else []
         self.limit = limit
         self.offset = offset
         self.columns = parent.columns
+        # With a limit, up to overflow rows after the window are kept to replace deleted rows
+        self.overflow_size = overflow
+        self.refill_count = 0
+        self.complete_order_by()
+        self.reset()
 
-        all_columns = parent.columns
+    def complete_order_by(self):
+        # Remaining columns break ties, so that the order of the rows is fully determined
         ordered_columns = set(col.split()[0] for col in self.order_by)  # order_by may contain DESC
-        remaining_columns = [col for col in all_columns if col not in ordered_columns]
+        remaining_columns = [col for col in self.parent.columns if col not in ordered_columns]
         self.order_by.extend(remaining_columns)
-        self.reset()
+
+    def reset_sort_key(self):
+        """
+        Compile order_by into a key function that sorts rows like SQLite does.
+
+        If a term can't be evaluated in Python, rows are compared with a SQL query instead.
+        """
+        self.sort_key = compile_order_by(self.order_by, self.parent.columns, self.parent.column_collation)
+        self.uses_sql_compare = self.sort_key is None
+        if self.uses_sql_compare:
+            self.sort_key = functools.cmp_to_key(self.compare_rows_sql)
+        # The terms are also used to seek from a row instead of skipping rows with OFFSET
+        self.seek_terms = None if self.uses_sql_compare else parse_order_by(self.order_by, self.parent.columns, self.parent.column_collation)
 
     def reset_query(self):
         order_clause = f"ORDER BY {', '.join(self.order_by)}"
-        limit_clause = f"LIMIT {self.limit}" if self.limit is not None else ""
-        offset_clause = f"OFFSET {self.offset}" if self.offset is not None else ""
+        limit_clause = "LIMIT ?" if self.limit is not None or self.offset is not None else ""
+        offset_clause = "OFFSET ?" if self.offset is not None else ""
         self.query = f"SELECT * FROM ({self.parent.query}) {order_clause} {limit_clause} {offset_clause}"
+        # SQLite only accepts OFFSET after LIMIT
+        self.params = self.parent.params + ((() if self.limit is None and self.offset is None else (-1 if self.limit is None else self.limit,))
+                                            + (() if self.offset is None else (self.offset,)))
 
     def reset(self):
         self.reset_query()
-        self.sorted_results = self.fetchall()
+        self.reset_sort_key()
+        if self.limit is None:
+            rows = self.fetchall()
+        else:
+            size = self.limit + self.overflow_size
+            rows = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) ORDER BY {', '.join(self.order_by)} LIMIT ? OFFSET ?",
+                                    self.parent.params + (size, self.offset or 0))
+        self.sorted_results = SortedRows(self.sort_key, rows[:self.limit], presorted=True)
+        self.set_overflow(rows[self.limit:] if self.limit is not None else [], self.limit is not None and len(rows) < size)
+        # Set when the window has to be repaired from the database after the current changes
+        self.refill_pending = False
+        self.resync_pending = False
+        # While a resync is pending: the first row of the window when it was scheduled, and the
+        # number of rows added before that row since then (negative for removed rows)
+        self.resync_marker = None
+        self.shift = 0
 
     def set_offset(self, offset):
         if self.offset == offset:
             return
+        self.db.check_private(self)
+        rows = None
+        if self.limit is not None and self.sorted_results and not self.refill_pending and not self.resync_pending:
+            # The next and the previous page start right after and before the current one
+            if offset == (self.offset or 0) + self.limit and len(self.sorted_results) == self.limit:
+                size = self.limit + self.overflow_size
+                rows = self.fetch_after(self.sorted_results[-1], size)
+                if rows is not None:
+                    after, complete = rows[self.limit:], len(rows) < size
+                    rows = rows[:self.limit]
+            elif offset == (self.offset or 0) - self.limit:
+                rows = self.fetch_before(self.sorted_results[0], self.limit)
+                if rows is not None and len(rows) < self.limit:
+                    rows = None
+                elif rows is not None:
+                    # The current page comes right after the previous one
+                    after = list(self.sorted_results) + list(self.overflow)
+                    complete = self.overflow_complete and len(after) <= self.overflow_size
+                    after = after[:self.overflow_size]
         self.offset = offset
-        self.reset()
+        if rows is None:
+            self.reset()
+        else:
+            self.reset_query()
+            self.sorted_results = SortedRows(self.sort_key, rows, presorted=True)
+            self.set_overflow(after, complete)
         for cb in self.reset_cbs:
             cb()    
 
     def set_order_by(self, order_by, limit=None):
         if isinstance(order_by, str):
             order_by = [order_by]
-        if self.order_by == order_by:
+        order_by = list(order_by)
+        if self.order_by[:len(order_by)] == order_by:
+            if limit:
+                self.set_limit(limit)
             return
+        self.db.check_private(self)
         self.order_by = order_by
+        self.complete_order_by()
         if limit:
             self.limit = limit
         self.reset()
@@ -2196,98 +3816,353 @@ class Sort(View):
     def set_limit(self, limit, reset=False):
         if self.limit == limit:
             return
+        self.db.check_private(self)
         if reset:
             self.limit = limit
             self.reset()
             for cb in self.reset_cbs:
                 cb()
         else:
-            if self.limit is not None and self.limit > limit:
+            if limit is not None and (self.limit is None or self.limit > limit):
+                if self.limit is None:
+                    self.set_overflow([], True)
                 self.limit = limit
                 self.reset_query()
                 for i in range(len(self.sorted_results) - 1, limit - 1, -1):
                     row = self.sorted_results.pop(i)
+                    self.overflow.add(row)
                     for cb in self.delete_cbs:
                         cb(i, Row({k: v for k, v in zip(self.parent.columns, row)}, self))
+                self.trim_overflow()
             else:
-                old_limit = self.limit
-                # Fetch new results
-                order_clause = f"ORDER BY {', '.join(self.order_by)}"
-                limit_clause = f"LIMIT {limit - self.limit}" if self.limit is not None else ""
-                offset = self.offset if self.offset is not None else 0
-                offset_clause = f"OFFSET {offset + self.limit}"
-                query = f"SELECT * FROM ({self.parent.query}) {order_clause} {limit_clause} {offset_clause}"
-                new_results = self.db.execute(query)
-                self.sorted_results.extend(new_results)
+                # The new rows come right after the current last row
                 self.limit = limit
-                limit_clause = f"LIMIT {self.limit}" if self.limit is not None else ""
-                offset_clause = f"OFFSET {self.offset}" if self.offset is not None else ""
-                self.query = f"SELECT * FROM ({self.parent.query}) {order_clause} {limit_clause} {offset_clause}"
-                for i in range(old_limit, len(self.sorted_results)):
-                    for cb in self.insert_cbs:
-                        cb(i, dict(zip(self.parent.columns, self.sorted_results[i])))
+                self.reset_query()
+                self.refill_window()
+
+    def on_delta(self, inserts, updates, deletes):
+        # Sort callbacks carry row indices, so the batch is applied one row at a time
+        for values in deletes:
+            self.call_delete_cbs(values)
+        for old, new in updates:
+            self.call_update_cbs(old, new)
+        for values in inserts:
+            self.call_insert_cbs(values)
 
     def call_insert_cbs(self, values):
         new_row = tuple(values[col] for col in self.parent.columns)
         insert_index = self.find_insert_index(new_row)
         if self.limit is not None and insert_index >= self.limit:
+            self.add_overflow(new_row)
             return
         if self.offset is not None and self.offset > 0 and insert_index == 0:
-            new_row = self.db.fetchone(self.query)
-        self.sorted_results.insert(insert_index, new_row)
-        
-        if self.limit is not None and len(self.sorted_results) > self.limit:
-            if insert_index < self.limit:
-                removed_row = self.sorted_results.pop()
-                for cb in self.delete_cbs:
-                    cb(self.limit, dict(zip(self.parent.columns, removed_row)))
+            # The row may be before the window, shifting the window by one row
+            self.schedule_resync(new_row, 1)
+            return
+        if self.refill_pending and insert_index == len(self.sorted_results):
+            # Rows that weren't fetched yet may come before this one, so the refill decides
+            return
+        self.sorted_results.add(new_row)
 
         for cb in self.insert_cbs:
             cb(insert_index, values)
 
+        if self.limit is not None and len(self.sorted_results) > self.limit:
+            removed_row = self.sorted_results.pop()
+            self.overflow.add(removed_row)
+            self.trim_overflow()
+            for cb in self.delete_cbs:
+                cb(self.limit, dict(zip(self.parent.columns, removed_row)))
+
     def call_update_cbs(self, old, new):
         old_row = tuple(old[col] for col in self.parent.columns)
         new_row = tuple(new[col] for col in self.parent.columns)
-        if old_row not in self.sorted_results:
+        old_index = self.find_row_index(old_row)
+        if old_index is None:
             self.call_delete_cbs(old)
             self.call_insert_cbs(new)
             return
 
-        old_index = self.sorted_results.index(old_row)
         self.sorted_results.pop(old_index)
-        new_index = self.find_insert_index(new_row)
-        self.sorted_results.insert(new_index, new_row)
+        if self.offset is not None and self.offset > 0 and self.find_insert_index(new_row) == 0:
+            # The row may move before the window
+            for cb in self.delete_cbs:
+                cb(old_index, old)
+            self.schedule_resync(new_row, 1)
+            return
+        if self.limit is not None and (len(self.sorted_results) == self.limit - 1 or self.refill_pending) \
+                and self.find_insert_index(new_row) == len(self.sorted_results):
+            # The row moves to the end of the window, where rows after the window may take its place
+            if self.overflow and self.less(self.overflow[0], new_row):
+                for cb in self.delete_cbs:
+                    cb(old_index, old)
+                self.add_overflow(new_row)
+                self.take_overflow()
+                return
+            if not self.overflow and not self.overflow_complete:
+                for cb in self.delete_cbs:
+                    cb(old_index, old)
+                self.schedule_refill()
+                return
+        new_index = self.sorted_results.add(new_row)
 
         for cb in self.update_cbs:
             cb(old_index, new_index, old, new)
 
     def less(self, row1, row2):
-        return self.compare_rows(row1, row2) < 0
+        return self.sort_key(row1) < self.sort_key(row2)
 
     def call_delete_cbs(self, values):
         row = tuple(values[col] for col in self.parent.columns)
-        if row not in self.sorted_results:
-            # Either too small or too big, need a select to find it out
-            if self.less(self.sorted_results[-1], row):
+        index = self.find_row_index(row)
+        if index is None:
+            # The row is either before or after the window
+            if self.overflow.remove(row) is not None:
                 return
-            index = 0
-        else:
-            index = self.sorted_results.index(row)
-        if index == None:
-            # If too big
+            if self.resync_pending:
+                # The window may have changed since the resync was scheduled, so compare with its marker
+                self.schedule_resync(row, -1)
+                return
+            if not self.sorted_results or self.less(self.sorted_results[-1], row):
+                return
+            if self.offset is not None and self.offset > 0:
+                self.schedule_resync(row, -1)
             return
         self.sorted_results.pop(index)
 
         for cb in self.delete_cbs:
             cb(index, values)
 
-        if self.limit is not None and len(self.sorted_results) == self.limit - 1:
-            sorted_results = self.fetchall()
-            if len(sorted_results) == self.limit:
-                new_last_row = sorted_results[-1]
-                self.sorted_results.append(new_last_row)
+        if self.limit is not None:
+            if self.overflow:
+                self.take_overflow()
+            elif not self.overflow_complete:
+                self.schedule_refill()
+
+    def schedule_refill(self):
+        self.refill_pending = True
+        self.db.defer(self.repair_window)
+
+    def schedule_resync(self, row, shift):
+        # row was added before the window (shift=1) or removed from before it (shift=-1)
+        if not self.resync_pending and self.seek_terms is not None and self.sorted_results:
+            self.resync_marker = self.sorted_results[0]
+        if self.resync_marker is not None:
+            key, marker_key = self.sort_key(row), self.sort_key(self.resync_marker)
+            if key < marker_key:
+                self.shift += shift
+            elif key == marker_key:
+                # Rows before the window may tie with the marker, so the window can't be found from it
+                self.resync_marker = None
+        self.resync_pending = True
+        self.db.defer(self.repair_window)
+
+    def repair_window(self):
+        """
+        Bring the window up to date with the database after a round of changes.
+
+        Runs once all changes of a write have been seen, so the queries see the final
+        state of the database, and rows changed in the same write aren't counted twice.
+        """
+        if self.resync_pending:
+            self.resync_window()
+        elif self.refill_pending:
+            self.refill_window()
+        self.refill_pending = False
+        self.resync_pending = False
+        self.resync_marker = None
+        self.shift = 0
+
+    def refill_window(self):
+        # The rows kept in the window are its first rows, so the overflow rows come next, then
+        # the ones fetched after them
+        missing = None if self.limit is None else self.limit - len(self.sorted_results)
+        while self.overflow and (missing is None or missing > 0):
+            self.take_overflow()
+            missing = None if missing is None else missing - 1
+        if self.overflow_complete or (missing is not None and missing <= 0):
+            return
+        # Fetch the overflow together with the missing rows
+        size = None if missing is None else missing + self.overflow_size
+        limit = -1 if size is None else size
+        rows = None
+        if self.sorted_results:
+            rows = self.fetch_after(self.sorted_results[-1], size)
+        elif not self.offset:
+            rows = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) ORDER BY {', '.join(self.order_by)} LIMIT ?", self.parent.params + (limit,))
+        if rows is None:
+            offset = (self.offset or 0) + len(self.sorted_results)
+            rows = self.db.fetchall(f"SELECT * FROM ({self.parent.query}) ORDER BY {', '.join(self.order_by)} LIMIT ? OFFSET ?", self.parent.params + (limit, offset))
+        self.refill_count += 1
+        if size is not None:
+            self.set_overflow(rows[missing:], len(rows) < size)
+            rows = rows[:missing]
+        for row in rows:
+            index = self.sorted_results.add(row)
+            for cb in self.insert_cbs:
+                cb(index, dict(zip(self.parent.columns, row)))
+
+    def set_overflow(self, rows, complete):
+        """
+        Replace the overflow with rows, the sorted rows right after the window.
+
+        Args:
+            rows (list): The rows, at most overflow_size of them.
+            complete (bool): Whether there are no more rows after them.
+        """
+        self.overflow = SortedRows(self.sort_key, rows, presorted=True)
+        self.overflow_complete = complete
+
+    def add_overflow(self, row):
+        # Only rows among the first ones after the window can be kept; the others aren't known
+        if not self.overflow_complete and (not self.overflow or not self.less(row, self.overflow[-1])):
+            return
+        self.overflow.add(row)
+        self.trim_overflow()
+
+    def trim_overflow(self):
+        while len(self.overflow) > self.overflow_size:
+            self.overflow.pop()
+            self.overflow_complete = False
+
+    def take_overflow(self):
+        # Move the first overflow row to the end of the window
+        row = self.overflow.pop(0)
+        index = self.sorted_results.add(row)
+        for cb in self.insert_cbs:
+            cb(index, dict(zip(self.parent.columns, row)))
+
+    def stats(self):
+        """
+        Return the number of rows in the window and in the overflow, and how many times the
+        rows after the window were queried.
+        """
+        return {"rows": len(self.sorted_results), "overflow": len(self.overflow), "refills": self.refill_count}
+
+    def resync_window(self):
+        # Rows before the window changed, so compare the window with the database
+        rows = self.seek_window()
+        if rows is None:
+            rows = self.fetchall()
+        removed = collections.Counter(self.sorted_results)
+        removed.subtract(rows)
+        for index in range(len(self.sorted_results) - 1, -1, -1):
+            row = self.sorted_results[index]
+            if removed[row] > 0:
+                removed[row] -= 1
+                self.sorted_results.pop(index)
+                for cb in self.delete_cbs:
+                    cb(index, dict(zip(self.parent.columns, row)))
+        added = collections.Counter(rows)
+        added.subtract(self.sorted_results)
+        for row in rows:
+            if added[row] > 0:
+                added[row] -= 1
+                index = self.sorted_results.add(row)
                 for cb in self.insert_cbs:
-                    cb(self.limit - 1, dict(zip(self.parent.columns, new_last_row)))
+                    cb(index, dict(zip(self.parent.columns, row)))
+        # The rows after the window changed too; a window that isn't full has none
+        self.set_overflow([], self.limit is not None and len(self.sorted_results) < self.limit)
+
+    def seek_window(self):
+        """
+        Return the rows of the window after rows were added or removed before it, or None.
+
+        The window now starts shift rows before the row it started with when the resync was
+        scheduled (after it if shift is negative), so it's fetched by seeking from that row.
+        """
+        marker, shift = self.resync_marker, self.shift
+        if marker is None or not self.seekable(marker):
+            return None
+        if shift > 0:
+            rows = self.fetch_before(marker, shift, check=False)
+            if len(rows) < shift:
+                return None
+            if self.limit is not None and self.limit <= shift:
+                return rows[:self.limit]
+            return rows + self.fetch_after(marker, None if self.limit is None else self.limit - shift, equal=True, check=False)
+        return self.fetch_after(marker, self.limit, equal=True, skip=-shift, check=False)
+
+    def seek_condition(self, row, forward=True, equal=False):
+        """
+        Return a condition and its parameters selecting the rows after row in the sort order.
+
+        Args:
+            row (tuple): The row to seek from.
+            forward (bool): Select the rows before row instead if False.
+            equal (bool): Also select the rows with the same sort key as row.
+        """
+        condition, params = ("1" if equal else "0"), []
+        for term in reversed(self.seek_terms):
+            value = row[term.index]
+            column = f"{term.column} COLLATE {term.collation}"
+            nulls_early = term.nulls_first == forward
+            if value is None:
+                beyond, beyond_params = (f"{column} IS NOT NULL" if nulls_early else "0"), []
+                same, same_params = f"{column} IS NULL", []
+            else:
+                op = ">" if term.desc != forward else "<"
+                beyond = f"{column} {op} ?" if nulls_early else f"({column} {op} ? OR {column} IS NULL)"
+                beyond_params = [value]
+                same, same_params = f"{column} = ?", [value]
+            if condition == "0":
+                condition, params = beyond, beyond_params
+            elif beyond == "0":
+                condition, params = f"({same} AND {condition})", same_params + params
+            elif condition == "1":
+                condition, params = f"({beyond} OR {same})", beyond_params + same_params
+            else:
+                condition, params = f"({beyond} OR ({same} AND {condition}))", beyond_params + same_params + params
+        if value is not None and nulls_early and len(self.seek_terms) > 1:
+            # A range on the first term lets SQLite walk an index instead of sorting all later rows
+            condition, params = f"{column} {op}= ? AND {condition}", [value] + params
+        return condition, params
+
+    def seekable(self, row):
+        # Seeking from row skips exactly the window's rows with the same sort key as row, so it
+        # works if the database has no others
+        if self.seek_terms is None:
+            return False
+        key = self.sort_key(row)
+        in_window = self.sorted_results.bisect_right(key) - self.sorted_results.bisect_left(key)
+        conditions, params = [], []
+        for term in self.seek_terms:
+            value = row[term.index]
+            column = f"{term.column} COLLATE {term.collation}"
+            if value is None:
+                conditions.append(f"{column} IS NULL")
+            else:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        query = f"SELECT COUNT(*) FROM ({self.parent.query}) WHERE {' AND '.join(conditions)}"
+        return self.db.fetchone(query, self.parent.params + tuple(params))[0] == in_window
+
+    def fetch_after(self, row, limit, equal=False, skip=0, check=True):
+        """
+        Fetch up to limit rows after row in the sort order, or None if seeking from row doesn't work.
+        """
+        if check and not self.seekable(row):
+            return None
+        condition, params = self.seek_condition(row, equal=equal)
+        query = f"SELECT * FROM ({self.parent.query}) WHERE {condition} ORDER BY {', '.join(self.order_by)} LIMIT ?"
+        params = self.parent.params + tuple(params) + (-1 if limit is None else limit,)
+        if skip:
+            query += " OFFSET ?"
+            params += (skip,)
+        return self.db.fetchall(query, params)
+
+    def fetch_before(self, row, limit, check=True):
+        """
+        Fetch up to limit rows right before row in the sort order, in sorted order, or None if
+        seeking from row doesn't work.
+        """
+        if check and not self.seekable(row):
+            return None
+        condition, params = self.seek_condition(row, forward=False)
+        reverse_order = ", ".join(
+            f"{term.column} COLLATE {term.collation} {'ASC' if term.desc else 'DESC'} NULLS {'LAST' if term.nulls_first else 'FIRST'}" for term in self.seek_terms)
+        query = f"SELECT * FROM ({self.parent.query}) WHERE {condition} ORDER BY {reverse_order} LIMIT ?"
+        return self.db.fetchall(query, self.parent.params + tuple(params) + (limit,))[::-1]
 
     def on_delete(self, cb):
         f = lambda index, row: print("calling zip for row", row, type(row), ", parent type: ", type(self.parent)) or cb(index, Row(row, self))
@@ -2310,29 +4185,25 @@ class Sort(View):
         return lambda: self.reset_cbs.remove(f)
 
     def find_insert_index(self, row):
-        return next((i for i, r in enumerate(self.sorted_results) if self.compare_rows(row, r) < 0), len(self.sorted_results))
-
-    def compare_rows_old(self, row1, row2):
-        # It's better to use the sql database engine for this
-        for col in self.order_by:
-            col_name = col.split()[0]
-            col_index = self.parent.columns.index(col_name)
-            if 'DESC' in col.upper():
-                if sql_cmp(row1[col_index], row2[col_index]) > 0:
-                    return -1
-                elif sql_cmp(row1[col_index], row2[col_index]) < 0:
-                    return 1
-            else:
-                if sql_cmp(row1[col_index], row2[col_index]) < 0:
-                    return -1
-                elif sql_cmp(row1[col_index], row2[col_index]) > 0:
-                    return 1
-        return 0
-    
+        """
+        Return the index where row would be inserted, after any equal rows.
+        """
+        return self.sorted_results.bisect_right(self.sort_key(row))
+
+    def find_row_index(self, row):
+        """
+        Return the index of row in sorted_results, or None if it's not there.
+        """
+        return self.sorted_results.index(row)
+
     def compare_rows(self, row1, row2):
+        k1, k2 = self.sort_key(row1), self.sort_key(row2)
+        return (k2 < k1) - (k1 < k2)
+
+    def compare_rows_sql(self, row1, row2):
         placeholders = ', '.join([f"? as '{col}'" for col in self.parent.columns])
         query = f"select dense_rank() over (order by {', '.join(self.order_by)}) as rank, __id__  from (SELECT 1 as __id__, {placeholders} union all SELECT 2 as __id__, {placeholders}) ORDER BY __id__"
-        result = self.db.execute(query, tuple(row1) + tuple(row2))
+        result = self.db.fetchall(query, tuple(row1) + tuple(row2))
         r = result[0][0] - result[1][0]
         return r
 
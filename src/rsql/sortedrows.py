@@ -0,0 +1,259 @@
+"""
+Sorted container for the rows of a Sort view.
+
+Rows are kept in a list of blocks with a Fenwick tree over the block sizes, so
+finding a row, inserting at its sorted position and reading the row at rank k
+take O(log n) time. A hash index of the rows answers membership checks in O(1).
+"""
+import bisect
+
+class SortedRows:
+    """
+    A list of rows kept in the order given by a key function.
+
+    Attributes:
+        key: Function mapping a row to its sort key.
+        load (int): Target block size; blocks are split at twice this size.
+    """
+    def __init__(self, key, rows=(), load=512, presorted=False):
+        self.key = key
+        self.load = load
+        self.clear()
+        if presorted:
+            self._extend_sorted(list(rows))
+        else:
+            self.update(rows)
+
+    def _extend_sorted(self, rows):
+        # rows must already be sorted and not be smaller than the current rows
+        keys = [self.key(row) for row in rows]
+        for i in range(0, len(rows), self.load):
+            self._blocks.append(rows[i:i + self.load])
+            self._keys.append(keys[i:i + self.load])
+            self._maxes.append(keys[min(i + self.load, len(rows)) - 1])
+        for row in rows:
+            self._counts[row] = self._counts.get(row, 0) + 1
+        self._len += len(rows)
+        self._tree = None
+
+    def clear(self):
+        self._blocks = []
+        self._keys = []
+        self._maxes = []
+        self._tree = None
+        self._counts = {}
+        self._len = 0
+
+    def update(self, rows):
+        """
+        Add many rows, re-sorting everything at once.
+        """
+        rows = list(self) + list(rows)
+        if not rows:
+            return
+        keys = [self.key(row) for row in rows]
+        order = sorted(range(len(rows)), key=keys.__getitem__)
+        self.clear()
+        self._extend_sorted([rows[i] for i in order])
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+
+    def __iter__(self):
+        for block in self._blocks:
+            yield from block
+
+    def __reversed__(self):
+        for block in reversed(self._blocks):
+            yield from reversed(block)
+
+    def __contains__(self, row):
+        return row in self._counts
+
+    def __eq__(self, other):
+        if isinstance(other, SortedRows):
+            other = list(other)
+        try:
+            return len(other) == self._len and all(a == b for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return f"SortedRows({list(self)})"
+
+    # Fenwick tree over block lengths, rebuilt lazily after blocks are split or removed
+    def _build_tree(self):
+        tree = [len(block) for block in self._blocks]
+        for i in range(len(tree)):
+            j = i | (i + 1)
+            if j < len(tree):
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, block_index, delta):
+        if self._tree is None:
+            return
+        tree = self._tree
+        i = block_index
+        while i < len(tree):
+            tree[i] += delta
+            i |= i + 1
+
+    def _offset(self, block_index):
+        # Number of rows in the blocks before block_index
+        if self._tree is None:
+            self._build_tree()
+        tree = self._tree
+        total = 0
+        i = block_index - 1
+        while i >= 0:
+            total += tree[i]
+            i = (i & (i + 1)) - 1
+        return total
+
+    def _locate(self, index):
+        # Convert a rank into (block index, index inside the block)
+        if index < 0:
+            index += self._len
+        if index < 0 or index >= self._len:
+            raise IndexError("SortedRows index out of range")
+        if self._tree is None:
+            self._build_tree()
+        tree = self._tree
+        block_index = 0
+        bit = 1 << (len(tree).bit_length())
+        while bit:
+            j = block_index + bit - 1
+            if j < len(tree) and tree[j] <= index:
+                index -= tree[j]
+                block_index += bit
+            bit >>= 1
+        return block_index, index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        block_index, i = self._locate(index)
+        return self._blocks[block_index][i]
+
+    def bisect_left(self, key):
+        """
+        Return the rank of the first row whose key is not less than key.
+        """
+        block_index = bisect.bisect_left(self._maxes, key)
+        if block_index == len(self._maxes):
+            return self._len
+        return self._offset(block_index) + bisect.bisect_left(self._keys[block_index], key)
+
+    def bisect_right(self, key):
+        """
+        Return the rank after the last row whose key is not greater than key.
+        """
+        block_index = bisect.bisect_right(self._maxes, key)
+        if block_index == len(self._maxes):
+            return self._len
+        return self._offset(block_index) + bisect.bisect_right(self._keys[block_index], key)
+
+    def add(self, row):
+        """
+        Insert row at its sorted position, after any rows with an equal key.
+
+        Returns:
+            int: The rank of the inserted row.
+        """
+        key = self.key(row)
+        self._counts[row] = self._counts.get(row, 0) + 1
+        self._len += 1
+        if not self._blocks:
+            self._blocks.append([row])
+            self._keys.append([key])
+            self._maxes.append(key)
+            self._tree = None
+            return 0
+        block_index = bisect.bisect_right(self._maxes, key)
+        if block_index == len(self._maxes):
+            block_index -= 1
+            i = len(self._blocks[block_index])
+            index = self._offset(block_index) + i
+            self._blocks[block_index].append(row)
+            self._keys[block_index].append(key)
+            self._maxes[block_index] = key
+        else:
+            i = bisect.bisect_right(self._keys[block_index], key)
+            index = self._offset(block_index) + i
+            self._blocks[block_index].insert(i, row)
+            self._keys[block_index].insert(i, key)
+        self._tree_add(block_index, 1)
+        if len(self._blocks[block_index]) > 2 * self.load:
+            self._split(block_index)
+        return index
+
+    def _split(self, block_index):
+        block, keys = self._blocks[block_index], self._keys[block_index]
+        half = len(block) // 2
+        self._blocks[block_index:block_index + 1] = [block[:half], block[half:]]
+        self._keys[block_index:block_index + 1] = [keys[:half], keys[half:]]
+        self._maxes[block_index:block_index + 1] = [keys[half - 1], keys[-1]]
+        self._tree = None
+
+    def _remove_at(self, block_index, i):
+        block, keys = self._blocks[block_index], self._keys[block_index]
+        row = block.pop(i)
+        keys.pop(i)
+        self._len -= 1
+        count = self._counts[row]
+        if count == 1:
+            del self._counts[row]
+        else:
+            self._counts[row] = count - 1
+        if not block:
+            del self._blocks[block_index]
+            del self._keys[block_index]
+            del self._maxes[block_index]
+            self._tree = None
+        else:
+            self._maxes[block_index] = keys[-1]
+            self._tree_add(block_index, -1)
+        return row
+
+    def pop(self, index=-1):
+        """
+        Remove and return the row at rank index.
+        """
+        block_index, i = self._locate(index)
+        return self._remove_at(block_index, i)
+
+    def index(self, row):
+        """
+        Return the rank of row, or None if it isn't in the container.
+        """
+        if row not in self._counts:
+            return None
+        key = self.key(row)
+        block_index = bisect.bisect_left(self._maxes, key)
+        offset = self._offset(block_index)
+        # Rows can have equal keys without being equal, so scan the run of equal keys
+        while block_index < len(self._blocks):
+            block, keys = self._blocks[block_index], self._keys[block_index]
+            i = bisect.bisect_left(keys, key)
+            while i < len(block):
+                if key < keys[i]:
+                    return None
+                if block[i] == row:
+                    return offset + i
+                i += 1
+            offset += len(block)
+            block_index += 1
+        return None
+
+    def remove(self, row):
+        """
+        Remove row and return its former rank, or None if it wasn't in the container.
+        """
+        index = self.index(row)
+        if index is not None:
+            self.pop(index)
+        return index
@@ -0,0 +1,1169 @@
+"""
+SQL expression helpers that mirror SQLite semantics in Python.
+
+The reactive operators use these to avoid a SQLite round-trip per changed row.
+Everything here follows SQLite's rules, and returns None when an expression is
+outside the supported subset, so callers can fall back to running SQL.
+"""
+import re
+
+# SQLite orders values by storage class first: NULL < INTEGER/REAL < TEXT < BLOB
+def storage_class_rank(value):
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    return 3
+
+_NOCASE_TABLE = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+def collation_function(name):
+    """
+    Return a function that maps TEXT values to a key comparable with Python's `<`.
+
+    Args:
+        name (str): The SQLite collation name (BINARY, NOCASE or RTRIM).
+
+    Returns:
+        function or None: The key function, or None for an unknown collation.
+    """
+    name = name.upper()
+    if name == "BINARY":
+        # UTF-8 byte order is the same as code point order
+        return lambda s: s
+    if name == "NOCASE":
+        # SQLite only folds ASCII letters
+        return lambda s: s.translate(_NOCASE_TABLE)
+    if name == "RTRIM":
+        return lambda s: s.rstrip(" ")
+    return None
+
+def sql_compare(a, b, collation="BINARY"):
+    """
+    Compare two values the way SQLite's ORDER BY does.
+
+    Returns:
+        int: -1, 0 or 1.
+    """
+    ra, rb = storage_class_rank(a), storage_class_rank(b)
+    if ra != rb:
+        return -1 if ra < rb else 1
+    if ra == 2:
+        f = collation_function(collation)
+        a, b = f(a), f(b)
+    elif ra == 0:
+        return 0
+    return (a > b) - (a < b)
+
+class Descending:
+    """Wraps a key so that it sorts in reverse order."""
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __gt__(self, other):
+        return self.key < other.key
+
+    def __le__(self, other):
+        return not self.key < other.key
+
+    def __ge__(self, other):
+        return not other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"Descending({self.key!r})"
+
+_IDENTIFIER = r'(?:"(?:[^"]|"")+"|`(?:[^`]|``)+`|\[[^\]]+\]|[A-Za-z_][A-Za-z0-9_$]*)'
+_ORDER_TERM = re.compile(
+    r'^\s*(?P<expr>' + _IDENTIFIER + r')'
+    r'(?:\s+COLLATE\s+(?P<collation>[A-Za-z_]+))?'
+    r'(?:\s+(?P<direction>ASC|DESC))?'
+    r'(?:\s+NULLS\s+(?P<nulls>FIRST|LAST))?\s*$',
+    re.IGNORECASE)
+
+def unquote_identifier(name):
+    if len(name) >= 2:
+        if name[0] == '"' and name[-1] == '"':
+            return name[1:-1].replace('""', '"')
+        if name[0] == '`' and name[-1] == '`':
+            return name[1:-1].replace('``', '`')
+        if name[0] == '[' and name[-1] == ']':
+            return name[1:-1]
+    return name
+
+class OrderTerm:
+    """
+    One parsed ORDER BY term.
+
+    Attributes:
+        column (str): The column name as it appears in the view.
+        index (int): The position of the column in the row tuple.
+        collation (str): The collation used for TEXT values.
+        desc (bool): Whether the term sorts descending.
+        nulls_first (bool): Whether NULLs sort before other values.
+        explicit_collation (bool): Whether the term had its own COLLATE clause.
+    """
+    def __init__(self, column, index, collation, desc, nulls_first, explicit_collation):
+        self.column = column
+        self.index = index
+        self.collation = collation
+        self.desc = desc
+        self.nulls_first = nulls_first
+        self.explicit_collation = explicit_collation
+
+    def __repr__(self):
+        return (f"OrderTerm({self.column}, collation={self.collation}, desc={self.desc}, "
+                f"nulls_first={self.nulls_first})")
+
+def parse_order_term(term, columns, column_collation=None):
+    """
+    Parse an ORDER BY term that references a column of the view.
+
+    Args:
+        term (str): The term, for example "name COLLATE NOCASE DESC NULLS LAST".
+        columns (list): The column names of the view being sorted.
+        column_collation (function, optional): Returns the declared collation of a column,
+            or None if it isn't known.
+
+    Returns:
+        OrderTerm or None: The parsed term, or None if it can't be evaluated in Python.
+    """
+    m = _ORDER_TERM.match(term)
+    if not m:
+        return None
+    name = unquote_identifier(m.group("expr"))
+    upper_columns = [c.upper() for c in columns]
+    if name.upper() not in upper_columns:
+        return None
+    index = upper_columns.index(name.upper())
+    collation = m.group("collation")
+    explicit_collation = collation is not None
+    if collation is None:
+        collation = column_collation(columns[index]) if column_collation else "BINARY"
+        if collation is None:
+            return None
+    collation = collation.upper()
+    if collation_function(collation) is None:
+        return None
+    desc = (m.group("direction") or "ASC").upper() == "DESC"
+    nulls = m.group("nulls")
+    nulls_first = (not desc) if nulls is None else nulls.upper() == "FIRST"
+    return OrderTerm(columns[index], index, collation, desc, nulls_first, explicit_collation)
+
+def parse_order_by(order_by, columns, column_collation=None):
+    """
+    Parse all ORDER BY terms, returning None if any of them can't be evaluated in Python.
+    """
+    terms = []
+    for term in order_by:
+        parsed = parse_order_term(term, columns, column_collation)
+        if parsed is None:
+            return None
+        terms.append(parsed)
+    return terms
+
+def _term_key(term):
+    index = term.index
+    fold = collation_function(term.collation)
+    # Before reversing for DESC, NULLs get rank 0 (first) or 4 (last)
+    null_key = (4 if term.nulls_first == term.desc else 0, 0)
+    if term.collation == "BINARY":
+        def key(row):
+            v = row[index]
+            if v is None:
+                return null_key
+            if isinstance(v, (int, float)):
+                return (1, v)
+            if isinstance(v, str):
+                return (2, v)
+            return (3, bytes(v))
+    else:
+        def key(row):
+            v = row[index]
+            if v is None:
+                return null_key
+            if isinstance(v, (int, float)):
+                return (1, v)
+            if isinstance(v, str):
+                return (2, fold(v))
+            return (3, bytes(v))
+    if term.desc:
+        return lambda row: Descending(key(row))
+    return key
+
+def compile_order_by(order_by, columns, column_collation=None):
+    """
+    Compile ORDER BY terms into a Python key function over row tuples.
+
+    The keys sort exactly like SQLite's ORDER BY for the same terms.
+
+    Args:
+        order_by (list): ORDER BY terms.
+        columns (list): The column names of the rows.
+        column_collation (function, optional): Returns the declared collation of a column.
+
+    Returns:
+        function or None: The key function, or None if a term can't be compiled.
+    """
+    terms = parse_order_by(order_by, columns, column_collation)
+    if terms is None:
+        return None
+    keys = [_term_key(term) for term in terms]
+    if len(keys) == 1:
+        k = keys[0]
+        return lambda row: (k(row),)
+    return lambda row: tuple([k(row) for k in keys])
+
+# Predicates and scalar expressions
+#
+# An expression is tokenized, parsed into tuples and compiled into closures over row dicts.
+# Values follow SQLite's rules: NULL propagates, comparisons apply column affinity and
+# collation, and the results of comparisons and logic are the integers 1 and 0.
+
+class SQLFallback(Exception):
+    """Raised by a compiled expression for a value it can't evaluate exactly like SQLite."""
+
+class _CompileError(Exception):
+    pass
+
+_INT64_MIN, _INT64_MAX = -2**63, 2**63 - 1
+_NUMERIC_AFFINITIES = ("INTEGER", "REAL", "NUMERIC")
+_SPACE = " \t\n\v\f\r"
+_NUMBER_PREFIX = re.compile(r"[ \t\n\v\f\r]*([+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)")
+_INTEGER_PREFIX = re.compile(r"[ \t\n\v\f\r]*([+-]?\d+)")
+_NUMBER = re.compile(r"[ \t\n\v\f\r]*([+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)[ \t\n\v\f\r]*\Z")
+_UPPER_TABLE = str.maketrans("abcdefghijklmnopqrstuvwxyz", "ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+def type_affinity(declared_type):
+    """
+    Return the affinity of a column with the given declared type.
+
+    Returns:
+        str: INTEGER, TEXT, BLOB, REAL or NUMERIC, using SQLite's name matching rules.
+    """
+    t = (declared_type or "").upper()
+    if "INT" in t:
+        return "INTEGER"
+    if "CHAR" in t or "CLOB" in t or "TEXT" in t:
+        return "TEXT"
+    if "BLOB" in t or not t.strip():
+        return "BLOB"
+    if "REAL" in t or "FLOA" in t or "DOUB" in t:
+        return "REAL"
+    return "NUMERIC"
+
+def _number(text):
+    if "." in text or "e" in text or "E" in text:
+        return float(text)
+    value = int(text)
+    return value if _INT64_MIN <= value <= _INT64_MAX else float(value)
+
+def to_numeric(value):
+    """Convert a value the way SQLite's arithmetic operators do: TEXT uses its longest numeric prefix."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        m = _NUMBER_PREFIX.match(value)
+        return _number(m.group(1)) if m else 0
+    raise SQLFallback(value)
+
+def apply_numeric_affinity(value):
+    # Only well-formed numbers are converted, other TEXT stays TEXT
+    if isinstance(value, str):
+        m = _NUMBER.match(value)
+        if m:
+            return _number(m.group(1))
+    return value
+
+def _format_real(value):
+    text = "%.15g" % (value or 0.0)  # -0.0 is printed as 0.0
+    if value != value or value in (float("inf"), float("-inf")) or float(text) != value:
+        # SQLite versions differ in how they print these
+        raise SQLFallback(value)
+    mantissa, e, exponent = text.partition("e")
+    if "." not in mantissa:
+        mantissa += ".0"
+    return mantissa + e + exponent
+
+def to_text(value):
+    """Convert a value to TEXT the way SQLite does, for example 1.0 becomes '1.0'."""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        return str(int(value))
+    if isinstance(value, float):
+        return _format_real(value)
+    raise SQLFallback(value)
+
+def apply_text_affinity(value):
+    return to_text(value) if isinstance(value, (int, float)) else value
+
+def sql_truth(value):
+    """
+    Return the truth value SQLite gives a value in WHERE: True, False or None for NULL.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return value != 0
+    return to_numeric(value) != 0
+
+_TOKEN = re.compile(r"""
+    (?P<space>[ \t\n\v\f\r]+|--[^\n]*|/\*.*?\*/)
+  | (?P<blob>[xX]'(?:[0-9a-fA-F]{2})*')
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\])
+  | (?P<name>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<op>\|\||<<|>>|<=|>=|==|!=|<>|->>|->|[-+*/%&|~<>=(),.?;:@$])
+""", re.VERBOSE | re.DOTALL)
+
+_KEYWORDS = {
+    "AND", "OR", "NOT", "IS", "IN", "LIKE", "GLOB", "MATCH", "REGEXP", "BETWEEN", "NULL",
+    "ISNULL", "NOTNULL", "CASE", "WHEN", "THEN", "ELSE", "END", "CAST", "AS", "COLLATE",
+    "ESCAPE", "DISTINCT", "FROM", "EXISTS", "SELECT", "RAISE", "FILTER", "OVER",
+}
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if not m:
+            raise _CompileError(text[pos:])
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == "space":
+            continue
+        value = m.group(kind)
+        if kind == "name" and value.upper() in _KEYWORDS:
+            kind, value = "keyword", value.upper()
+        tokens.append((kind, value))
+    return tokens
+
+class _Parser:
+    """
+    Recursive descent parser for SQLite expressions, from lowest to highest precedence:
+    OR, AND, NOT, equality (= IS IN LIKE GLOB BETWEEN ...), < <= > >=, & | << >>, + -, * / %,
+    ||, COLLATE and unary operators.
+    """
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        i = self.pos + offset
+        return self.tokens[i] if i < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise _CompileError("unexpected end of expression")
+        self.pos += 1
+        return token
+
+    def accept(self, kind, *values):
+        token = self.peek()
+        if token[0] == kind and (not values or token[1] in values):
+            self.pos += 1
+            return token[1]
+        return None
+
+    def expect(self, kind, *values):
+        value = self.accept(kind, *values)
+        if value is None:
+            raise _CompileError(f"expected {values or kind}, got {self.peek()[1]}")
+        return value
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek()[0] is not None:
+            raise _CompileError(f"unexpected {self.peek()[1]}")
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.accept("keyword", "OR"):
+            node = ("or", node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.accept("keyword", "AND"):
+            node = ("and", node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.accept("keyword", "NOT"):
+            return ("not", self.parse_not())
+        return self.parse_equality()
+
+    def parse_equality(self):
+        node = self.parse_comparison()
+        while True:
+            op = self.accept("op", "=", "==", "!=", "<>")
+            if op:
+                node = ("compare", "=" if op == "==" else "!=" if op == "<>" else op, node, self.parse_comparison())
+                continue
+            if self.accept("keyword", "IS"):
+                negate = bool(self.accept("keyword", "NOT"))
+                if self.accept("keyword", "DISTINCT"):
+                    self.expect("keyword", "FROM")
+                    negate = not negate
+                elif self.peek()[0] == "name" and self.peek()[1].upper() in ("TRUE", "FALSE"):
+                    node = ("istruth", negate, node, self.next()[1])
+                    continue
+                node = ("is", negate, node, self.parse_comparison())
+                continue
+            if self.accept("keyword", "ISNULL"):
+                node = ("isnull", False, node)
+                continue
+            if self.accept("keyword", "NOTNULL"):
+                node = ("isnull", True, node)
+                continue
+            negate = False
+            if self.peek() == ("keyword", "NOT"):
+                following = self.peek(1)
+                if following == ("keyword", "NULL"):
+                    self.pos += 2
+                    node = ("isnull", True, node)
+                    continue
+                if following[0] != "keyword" or following[1] not in ("IN", "LIKE", "GLOB", "BETWEEN"):
+                    break
+                self.pos += 1
+                negate = True
+            if self.accept("keyword", "IN"):
+                self.expect("op", "(")
+                items = []
+                if not self.accept("op", ")"):
+                    items.append(self.parse_or())
+                    while self.accept("op", ","):
+                        items.append(self.parse_or())
+                    self.expect("op", ")")
+                node = ("in", negate, node, items)
+            elif self.peek()[0] == "keyword" and self.peek()[1] in ("LIKE", "GLOB"):
+                kind = self.next()[1]
+                pattern = self.parse_comparison()
+                escape = self.parse_comparison() if self.accept("keyword", "ESCAPE") else None
+                node = ("like", negate, kind, node, pattern, escape)
+            elif self.accept("keyword", "BETWEEN"):
+                low = self.parse_comparison()
+                self.expect("keyword", "AND")
+                node = ("between", negate, node, low, self.parse_comparison())
+            else:
+                break
+        return node
+
+    def parse_binary(self, operators, parse_operand):
+        node = parse_operand()
+        while True:
+            op = self.accept("op", *operators)
+            if not op:
+                return node
+            node = ("arith" if op not in ("<", "<=", ">", ">=") else "compare", op, node, parse_operand())
+
+    def parse_comparison(self):
+        return self.parse_binary(("<", "<=", ">", ">="), self.parse_bitwise)
+
+    def parse_bitwise(self):
+        return self.parse_binary(("&", "|", "<<", ">>"), self.parse_additive)
+
+    def parse_additive(self):
+        return self.parse_binary(("+", "-"), self.parse_multiplicative)
+
+    def parse_multiplicative(self):
+        return self.parse_binary(("*", "/", "%"), self.parse_concat)
+
+    def parse_concat(self):
+        return self.parse_binary(("||",), self.parse_collate)
+
+    def parse_collate(self):
+        node = self.parse_unary()
+        while self.accept("keyword", "COLLATE"):
+            kind, name = self.next()
+            if kind not in ("name", "quoted", "string"):
+                raise _CompileError(f"bad collation {name}")
+            node = ("collate", node, unquote_identifier(name.strip("'")).upper())
+        return node
+
+    def parse_unary(self):
+        op = self.accept("op", "-", "+", "~")
+        if op:
+            return ("unary", op, self.parse_unary())
+        return self.parse_primary()
+
+    def parse_primary(self):
+        kind, value = self.next()
+        if kind == "number":
+            if value[:2] in ("0x", "0X"):
+                number = int(value, 16)
+                if number > 0xFFFFFFFFFFFFFFFF:
+                    raise _CompileError(value)
+                return ("literal", number - 2**64 if number > _INT64_MAX else number)
+            return ("literal", _number(value))
+        if kind == "string":
+            return ("literal", value[1:-1].replace("''", "'"))
+        if kind == "blob":
+            return ("literal", bytes.fromhex(value[2:-1]))
+        if kind == "quoted":
+            return ("column", unquote_identifier(value), value[0] == '"')
+        if kind == "op" and value == "(":
+            node = self.parse_or()
+            self.expect("op", ")")
+            return node
+        if kind == "keyword":
+            if value == "NULL":
+                return ("literal", None)
+            if value == "CASE":
+                return self.parse_case()
+            if value == "CAST":
+                self.expect("op", "(")
+                node = self.parse_or()
+                self.expect("keyword", "AS")
+                type_name = []
+                while self.peek()[0] == "name":
+                    type_name.append(self.next()[1])
+                if self.accept("op", "("):
+                    while not self.accept("op", ")"):
+                        self.next()
+                self.expect("op", ")")
+                return ("cast", node, " ".join(type_name))
+            raise _CompileError(f"unsupported {value}")
+        if kind == "name":
+            if self.accept("op", "("):
+                args = []
+                if self.accept("op", "*"):
+                    raise _CompileError(f"{value}(*)")
+                if not self.accept("op", ")"):
+                    args.append(self.parse_or())
+                    while self.accept("op", ","):
+                        args.append(self.parse_or())
+                    self.expect("op", ")")
+                if self.peek()[0] == "keyword" and self.peek()[1] in ("FILTER", "OVER"):
+                    raise _CompileError("window functions are not supported")
+                return ("function", value.lower(), args)
+            if self.peek() == ("op", "."):
+                raise _CompileError("qualified column names are not supported")
+            return ("column", value, False)
+        raise _CompileError(f"unexpected {value}")
+
+    def parse_case(self):
+        base = None
+        if self.peek() != ("keyword", "WHEN"):
+            base = self.parse_or()
+        branches = []
+        while self.accept("keyword", "WHEN"):
+            condition = self.parse_or()
+            self.expect("keyword", "THEN")
+            branches.append((condition, self.parse_or()))
+        if not branches:
+            raise _CompileError("CASE without WHEN")
+        default = self.parse_or() if self.accept("keyword", "ELSE") else ("literal", None)
+        self.expect("keyword", "END")
+        return ("case", base, branches, default)
+
+class CompiledExpression:
+    """
+    A SQL expression compiled into a Python function over row dicts.
+
+    Attributes:
+        evaluate: Function mapping a dict of column values to the value of the expression.
+            It raises SQLFallback for values it can't handle exactly like SQLite.
+        affinity (str): The affinity SQLite gives the expression: a column's affinity,
+            the type of a CAST, or NONE for no affinity.
+        collation (str or None): The collation of a column or COLLATE operand, None otherwise.
+        explicit_collation (bool): Whether collation comes from a COLLATE operator.
+    """
+    __slots__ = ("evaluate", "affinity", "collation", "explicit_collation")
+
+    def __init__(self, evaluate, affinity="NONE", collation=None, explicit_collation=False):
+        self.evaluate = evaluate
+        self.affinity = affinity
+        self.collation = collation
+        self.explicit_collation = explicit_collation
+
+    def __call__(self, values):
+        return self.evaluate(values)
+
+def _comparison_collation(*operands):
+    for operand in operands:
+        if operand.explicit_collation:
+            return operand.collation
+    for operand in operands:
+        if operand.collation is not None:
+            return operand.collation
+    return "BINARY"
+
+def _affinity_conversions(left, right):
+    # The conversions SQLite applies to the operands of a comparison before comparing them.
+    # A BLOB column has an affinity, unlike an expression (NONE), so TEXT isn't applied to it.
+    if left.affinity in _NUMERIC_AFFINITIES and right.affinity not in _NUMERIC_AFFINITIES:
+        return None, apply_numeric_affinity
+    if right.affinity in _NUMERIC_AFFINITIES and left.affinity not in _NUMERIC_AFFINITIES:
+        return apply_numeric_affinity, None
+    if left.affinity == "TEXT" and right.affinity == "NONE":
+        return None, apply_text_affinity
+    if right.affinity == "TEXT" and left.affinity == "NONE":
+        return apply_text_affinity, None
+    return None, None
+
+def _comparator(left, right):
+    # Returns compare(a, b) for non-NULL operand values, with affinity applied
+    convert_left, convert_right = _affinity_conversions(left, right)
+    collation = _comparison_collation(left, right)
+    if collation_function(collation) is None:
+        raise _CompileError(f"unknown collation {collation}")
+    if convert_left is None and convert_right is None:
+        return lambda a, b: sql_compare(a, b, collation)
+    convert_left = convert_left or (lambda v: v)
+    convert_right = convert_right or (lambda v: v)
+    return lambda a, b: sql_compare(convert_left(a), convert_right(b), collation)
+
+_COMPARISONS = {
+    "=": lambda c: c == 0, "!=": lambda c: c != 0,
+    "<": lambda c: c < 0, "<=": lambda c: c <= 0,
+    ">": lambda c: c > 0, ">=": lambda c: c >= 0,
+}
+
+def _check_int(value):
+    if isinstance(value, int) and not _INT64_MIN <= value <= _INT64_MAX:
+        raise SQLFallback(value)  # SQLite switches to REAL on overflow
+    return value
+
+def _divide(a, b):
+    if b == 0:
+        return None
+    if isinstance(a, int) and isinstance(b, int):
+        q = abs(a) // abs(b)
+        return _check_int(q if (a < 0) == (b < 0) else -q)
+    return a / b
+
+def _remainder(a, b):
+    if not (isinstance(a, int) and isinstance(b, int)):
+        raise SQLFallback((a, b))
+    if b == 0:
+        return None
+    r = abs(a) % abs(b)
+    return r if a >= 0 else -r
+
+def _integer_operand(value):
+    if not isinstance(value, int):
+        raise SQLFallback(value)
+    return int(value)
+
+def _to_signed(value):
+    value &= 0xFFFFFFFFFFFFFFFF
+    return value - 2**64 if value > _INT64_MAX else value
+
+def _shift_left(a, b):
+    a, b = _integer_operand(a), _integer_operand(b)
+    if b < 0:
+        return _shift_right(a, -b)
+    return 0 if b >= 64 else _to_signed(a << b)
+
+def _shift_right(a, b):
+    a, b = _integer_operand(a), _integer_operand(b)
+    if b < 0:
+        return _shift_left(a, -b)
+    return (-1 if a < 0 else 0) if b >= 64 else a >> b
+
+_ARITHMETIC = {
+    "+": lambda a, b: _check_int(a + b),
+    "-": lambda a, b: _check_int(a - b),
+    "*": lambda a, b: _check_int(a * b),
+    "/": _divide,
+    "%": _remainder,
+    "&": lambda a, b: _integer_operand(a) & _integer_operand(b),
+    "|": lambda a, b: _integer_operand(a) | _integer_operand(b),
+    "<<": _shift_left,
+    ">>": _shift_right,
+}
+
+def _like_regex(pattern, escape, glob):
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if not glob and c == escape:
+            i += 1
+            if i == len(pattern):
+                raise SQLFallback(pattern)
+            parts.append(re.escape(pattern[i]))
+        elif c == ("*" if glob else "%"):
+            parts.append(".*")
+        elif c == ("?" if glob else "_"):
+            parts.append(".")
+        elif glob and c == "[":
+            start = i + 1
+            if pattern[start:start + 1] == "^":
+                start += 1
+            end = pattern.find("]", start + 1)
+            if end < 0:
+                raise SQLFallback(pattern)
+            chars = pattern[i + 1:end]
+            negate = chars.startswith("^")
+            if negate:
+                chars = chars[1:]
+            parts.append("[" + ("^" if negate else "") + "".join(
+                "-" if ch == "-" and 0 < j < len(chars) - 1 else re.escape(ch) for j, ch in enumerate(chars)) + "]")
+            i = end
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return re.compile("".join(parts) + r"\Z", re.DOTALL)
+
+_like_cache = {}
+
+def sql_like(value, pattern, escape=None, glob=False):
+    """
+    Evaluate `value LIKE pattern` (or GLOB) like SQLite: LIKE ignores the case of ASCII letters.
+    """
+    if isinstance(value, bytes) or isinstance(pattern, bytes):
+        raise SQLFallback((value, pattern))
+    if value is None or pattern is None:
+        return None
+    value, pattern = to_text(value), to_text(pattern)
+    if not glob:
+        value = value.translate(_NOCASE_TABLE)
+        pattern = pattern.translate(_NOCASE_TABLE)
+    key = (pattern, escape, glob)
+    regex = _like_cache.get(key)
+    if regex is None:
+        if len(_like_cache) > 256:
+            _like_cache.clear()
+        regex = _like_cache[key] = _like_regex(pattern, escape, glob)
+    return 1 if regex.match(value) else 0
+
+def _cast(value, affinity):
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        raise SQLFallback(value)
+    if affinity == "TEXT":
+        return to_text(value)
+    if affinity == "BLOB":
+        raise SQLFallback(value)
+    if affinity == "INTEGER" and isinstance(value, str):
+        # Only the integer prefix counts, so '1e3' becomes 1
+        m = _INTEGER_PREFIX.match(value)
+        return _check_int(int(m.group(1))) if m else 0
+    number = to_numeric(value)
+    if affinity == "REAL":
+        return float(number)
+    if isinstance(number, float) and (affinity == "INTEGER" or isinstance(value, str) and number.is_integer()):
+        if -2.0**63 <= number < 2.0**63:
+            return int(number)
+        if affinity == "INTEGER":
+            raise SQLFallback(value)
+    return number
+
+# The length of substr(X, Y), which has no third argument, as opposed to a NULL one
+_TO_END = object()
+
+def _substr(value, start, length=_TO_END):
+    if value is None or start is None or length is None:
+        return None
+    if isinstance(value, bytes):
+        raise SQLFallback(value)
+    text = to_text(value)
+    p1 = int(_cast(start, "INTEGER"))
+    if length is _TO_END:
+        # Up to the end of the string, however far before its start p1 is
+        return text[p1 - 1 if p1 > 0 else max(len(text) + p1, 0) if p1 < 0 else 0:]
+    negative = False
+    p2 = int(_cast(length, "INTEGER"))
+    if p2 < 0:
+        p2, negative = -p2, True
+    if p1 < 0:
+        p1 += len(text)
+        if p1 < 0:
+            p2 = max(p2 + p1, 0)
+            p1 = 0
+    elif p1 > 0:
+        p1 -= 1
+    elif p2 > 0:
+        p2 -= 1
+    if negative:
+        p1 -= p2
+        if p1 < 0:
+            p2 += p1
+            p1 = 0
+    return text[p1:p1 + p2]
+
+def _text_function(f):
+    def function(value, *args):
+        if value is None or any(arg is None for arg in args):
+            return None
+        if isinstance(value, bytes):
+            raise SQLFallback(value)
+        return f(to_text(value), *[to_text(arg) for arg in args])
+    return function
+
+def _abs(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return abs(float(to_numeric(value)))
+    if isinstance(value, bytes) or value == _INT64_MIN:
+        raise SQLFallback(value)
+    return abs(value)
+
+def _length(value):
+    if value is None or isinstance(value, bytes):
+        return None if value is None else len(value)
+    return len(to_text(value))
+
+def _typeof(value):
+    if value is None:
+        return "null"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "real"
+    return "text" if isinstance(value, str) else "blob"
+
+def _nullif(a, b):
+    return None if a is not None and b is not None and sql_compare(a, b) == 0 else a
+
+def _min(*args):
+    if any(arg is None for arg in args):
+        return None
+    result = args[0]
+    for arg in args[1:]:
+        # Of equal values, min() returns the last one and max() the first one
+        if sql_compare(result, arg) >= 0:
+            result = arg
+    return result
+
+def _max(*args):
+    if any(arg is None for arg in args):
+        return None
+    result = args[0]
+    for arg in args[1:]:
+        if sql_compare(result, arg) < 0:
+            result = arg
+    return result
+
+def _coalesce(*args):
+    for arg in args:
+        if arg is not None:
+            return arg
+    return None
+
+# name: (minimum arguments, maximum arguments, implementation)
+_FUNCTIONS = {
+    "abs": (1, 1, _abs),
+    "coalesce": (2, None, _coalesce),
+    "ifnull": (2, 2, _coalesce),
+    "nullif": (2, 2, _nullif),
+    "iif": (3, 3, lambda c, a, b: a if sql_truth(c) else b),
+    "length": (1, 1, _length),
+    "lower": (1, 1, _text_function(lambda s: s.translate(_NOCASE_TABLE))),
+    "upper": (1, 1, _text_function(lambda s: s.translate(_UPPER_TABLE))),
+    "trim": (1, 2, _text_function(lambda s, chars=" ": s.strip(chars))),
+    "ltrim": (1, 2, _text_function(lambda s, chars=" ": s.lstrip(chars))),
+    "rtrim": (1, 2, _text_function(lambda s, chars=" ": s.rstrip(chars))),
+    "instr": (2, 2, _text_function(lambda s, sub: s.find(sub) + 1)),
+    "replace": (3, 3, _text_function(lambda s, old, new: s.replace(old, new) if old else s)),
+    "substr": (2, 3, _substr),
+    "substring": (2, 3, _substr),
+    "typeof": (1, 1, _typeof),
+    "min": (2, None, _min),
+    "max": (2, None, _max),
+}
+
+class _Compiler:
+    def __init__(self, columns, column_affinity, column_collation):
+        self.columns = {col.upper(): col for col in columns}
+        self.column_affinity = column_affinity
+        self.column_collation = column_collation
+
+    def compile(self, node):
+        return getattr(self, "compile_" + node[0])(*node[1:])
+
+    def compile_literal(self, value):
+        return CompiledExpression(lambda values: value)
+
+    def compile_column(self, name, double_quoted):
+        col = self.columns.get(name.upper())
+        if col is None:
+            if not double_quoted and name.upper() in ("TRUE", "FALSE"):
+                value = 1 if name.upper() == "TRUE" else 0
+                return CompiledExpression(lambda values: value)
+            if double_quoted:
+                # SQLite treats a double quoted string that isn't a column as a string literal
+                return CompiledExpression(lambda values: name)
+            raise _CompileError(f"no such column: {name}")
+        affinity = self.column_affinity(col) if self.column_affinity else "NONE"
+        collation = self.column_collation(col) if self.column_collation else "BINARY"
+        if affinity is None or collation is None:
+            raise _CompileError(f"unknown affinity or collation for {col}")
+        return CompiledExpression(lambda values: values[col], affinity, collation.upper())
+
+    def compile_collate(self, node, collation):
+        operand = self.compile(node)
+        return CompiledExpression(operand.evaluate, operand.affinity, collation, True)
+
+    def compile_cast(self, node, type_name):
+        operand = self.compile(node)
+        affinity = type_affinity(type_name)
+        f = operand.evaluate
+        return CompiledExpression(lambda values: _cast(f(values), affinity), affinity,
+                                  operand.collation, operand.explicit_collation)
+
+    def compile_unary(self, op, node):
+        operand = self.compile(node)
+        f = operand.evaluate
+        if op == "+":
+            # Unary plus removes affinity, but a column keeps its collation
+            return CompiledExpression(f, "NONE", operand.collation, operand.explicit_collation)
+        if op == "-":
+            def evaluate(values):
+                v = f(values)
+                return None if v is None else _check_int(-to_numeric(v))
+        else:
+            def evaluate(values):
+                v = f(values)
+                return None if v is None else ~_integer_operand(to_numeric(v))
+        return CompiledExpression(evaluate)
+
+    def compile_arith(self, op, left, right):
+        lf, rf = self.compile(left).evaluate, self.compile(right).evaluate
+        if op == "||":
+            def evaluate(values):
+                a, b = lf(values), rf(values)
+                if a is None or b is None:
+                    return None
+                if isinstance(a, bytes) or isinstance(b, bytes):
+                    raise SQLFallback((a, b))
+                return to_text(a) + to_text(b)
+            return CompiledExpression(evaluate)
+        f = _ARITHMETIC[op]
+        def evaluate(values):
+            a = lf(values)
+            if a is None:
+                return None
+            b = rf(values)
+            if b is None:
+                return None
+            return f(to_numeric(a), to_numeric(b))
+        return CompiledExpression(evaluate)
+
+    def compile_compare(self, op, left, right):
+        left, right = self.compile(left), self.compile(right)
+        compare, test = _comparator(left, right), _COMPARISONS[op]
+        lf, rf = left.evaluate, right.evaluate
+        def evaluate(values):
+            a = lf(values)
+            if a is None:
+                return None
+            b = rf(values)
+            if b is None:
+                return None
+            return 1 if test(compare(a, b)) else 0
+        return CompiledExpression(evaluate)
+
+    def compile_is(self, negate, left, right):
+        left, right = self.compile(left), self.compile(right)
+        compare = _comparator(left, right)
+        lf, rf = left.evaluate, right.evaluate
+        def evaluate(values):
+            a, b = lf(values), rf(values)
+            if a is None or b is None:
+                same = a is None and b is None
+            else:
+                same = compare(a, b) == 0
+            return 0 if same == negate else 1
+        return CompiledExpression(evaluate)
+
+    def compile_istruth(self, negate, node, name):
+        if name.upper() in self.columns:
+            return self.compile_is(negate, node, ("column", name, False))
+        # x IS TRUE and x IS FALSE test the truth value of x, so NULL is neither
+        f, expected = self.compile(node).evaluate, name.upper() == "TRUE"
+        return CompiledExpression(lambda values: 0 if (sql_truth(f(values)) is expected) == negate else 1)
+
+    def compile_isnull(self, negate, node):
+        f = self.compile(node).evaluate
+        return CompiledExpression(lambda values: 0 if (f(values) is None) == negate else 1)
+
+    def compile_in(self, negate, node, items):
+        operand = self.compile(node)
+        items = [self.compile(item) for item in items]
+        # The values in the list have no affinity, so the affinity of the operand is applied to them
+        convert = (apply_numeric_affinity if operand.affinity in _NUMERIC_AFFINITIES else
+                   apply_text_affinity if operand.affinity == "TEXT" else (lambda v: v))
+        collation = _comparison_collation(operand)
+        if collation_function(collation) is None:
+            raise _CompileError(f"unknown collation {collation}")
+        f, item_functions = operand.evaluate, [item.evaluate for item in items]
+        found, missing = (0, 1) if negate else (1, 0)
+        def evaluate(values):
+            if not item_functions:
+                return missing
+            a = f(values)
+            if a is None:
+                return None
+            has_null = False
+            for item in item_functions:
+                b = item(values)
+                if b is None:
+                    has_null = True
+                elif sql_compare(a, convert(b), collation) == 0:
+                    return found
+            return None if has_null else missing
+        return CompiledExpression(evaluate)
+
+    def compile_like(self, negate, kind, node, pattern, escape):
+        f, pf = self.compile(node).evaluate, self.compile(pattern).evaluate
+        ef = self.compile(escape).evaluate if escape is not None else None
+        glob = kind == "GLOB"
+        def evaluate(values):
+            e = None
+            if ef is not None:
+                e = ef(values)
+                if e is None:
+                    return None
+                e = to_text(e)
+                if len(e) != 1:
+                    raise SQLFallback(e)
+                e = e.translate(_NOCASE_TABLE)
+            result = sql_like(f(values), pf(values), e, glob)
+            return result if result is None or not negate else 1 - result
+        return CompiledExpression(evaluate)
+
+    def compile_between(self, negate, node, low, high):
+        operand, low, high = self.compile(node), self.compile(low), self.compile(high)
+        compare_low, compare_high = _comparator(operand, low), _comparator(operand, high)
+        f, lf, hf = operand.evaluate, low.evaluate, high.evaluate
+        def evaluate(values):
+            a, lo, hi = f(values), lf(values), hf(values)
+            above = None if a is None or lo is None else compare_low(a, lo) >= 0
+            below = None if a is None or hi is None else compare_high(a, hi) <= 0
+            if above is False or below is False:
+                return 1 if negate else 0
+            if above is None or below is None:
+                return None
+            return 0 if negate else 1
+        return CompiledExpression(evaluate)
+
+    def compile_not(self, node):
+        f = self.compile(node).evaluate
+        def evaluate(values):
+            truth = sql_truth(f(values))
+            return None if truth is None else 0 if truth else 1
+        return CompiledExpression(evaluate)
+
+    def compile_and(self, left, right):
+        lf, rf = self.compile(left).evaluate, self.compile(right).evaluate
+        def evaluate(values):
+            a = sql_truth(lf(values))
+            if a is False:
+                return 0
+            b = sql_truth(rf(values))
+            if b is False:
+                return 0
+            return None if a is None or b is None else 1
+        return CompiledExpression(evaluate)
+
+    def compile_or(self, left, right):
+        lf, rf = self.compile(left).evaluate, self.compile(right).evaluate
+        def evaluate(values):
+            a = sql_truth(lf(values))
+            if a:
+                return 1
+            b = sql_truth(rf(values))
+            if b:
+                return 1
+            return None if a is None or b is None else 0
+        return CompiledExpression(evaluate)
+
+    def compile_case(self, base, branches, default):
+        default = self.compile(default).evaluate
+        results = [self.compile(result).evaluate for _, result in branches]
+        if base is None:
+            conditions = [self.compile(condition).evaluate for condition, _ in branches]
+            def evaluate(values):
+                for condition, result in zip(conditions, results):
+                    if sql_truth(condition(values)):
+                        return result(values)
+                return default(values)
+            return CompiledExpression(evaluate)
+        base = self.compile(base)
+        whens = [self.compile(condition) for condition, _ in branches]
+        comparators = [_comparator(base, when) for when in whens]
+        bf = base.evaluate
+        def evaluate(values):
+            a = bf(values)
+            if a is not None:
+                for when, compare, result in zip(whens, comparators, results):
+                    b = when.evaluate(values)
+                    if b is not None and compare(a, b) == 0:
+                        return result(values)
+            return default(values)
+        return CompiledExpression(evaluate)
+
+    def compile_function(self, name, args):
+        if name not in _FUNCTIONS:
+            raise _CompileError(f"unsupported function {name}")
+        minimum, maximum, f = _FUNCTIONS[name]
+        if len(args) < minimum or (maximum is not None and len(args) > maximum):
+            raise _CompileError(f"wrong number of arguments to {name}")
+        args = [self.compile(arg) for arg in args]
+        if name in ("min", "max", "nullif") and _comparison_collation(*args) != "BINARY":
+            raise _CompileError(f"{name} with a collation")
+        arg_functions = [arg.evaluate for arg in args]
+        if len(arg_functions) == 1:
+            a = arg_functions[0]
+            return CompiledExpression(lambda values: f(a(values)))
+        return CompiledExpression(lambda values: f(*[a(values) for a in arg_functions]))
+
+def compile_expression(expr, columns, column_affinity=None, column_collation=None):
+    """
+    Compile a SQL expression over the columns of a view into a Python function.
+
+    Args:
+        expr (str): The expression, for example "price * quantity".
+        columns (list): The column names the expression can reference.
+        column_affinity (function, optional): Returns the affinity of a column, or None if it
+            isn't known. Without it columns have no affinity, like the columns of VALUES.
+        column_collation (function, optional): Returns the collation of a column, or None if it
+            isn't known.
+
+    Returns:
+        CompiledExpression or None: The compiled expression, or None if it can't be compiled.
+    """
+    try:
+        return _Compiler(columns, column_affinity, column_collation).compile(_Parser(expr).parse())
+    except (_CompileError, RecursionError, ValueError):
+        return None
+
+def compile_predicate(expr, columns, column_affinity=None, column_collation=None):
+    """
+    Compile a WHERE condition into a function that returns whether a row dict passes it.
+
+    NULL counts as false, like in SQLite. The function raises SQLFallback for rows it can't
+    evaluate exactly like SQLite.
+
+    Returns:
+        function or None: The predicate, or None if the condition can't be compiled.
+    """
+    compiled = compile_expression(expr, columns, column_affinity, column_collation)
+    if compiled is None:
+        return None
+    f = compiled.evaluate
+    def predicate(values):
+        return sql_truth(f(values)) is True
+    return predicate
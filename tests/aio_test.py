@@ -0,0 +1,71 @@
+import sys
+sys.path.append("src")
+import asyncio, os, tempfile, threading, time, unittest
+from rsql.aio import AsyncDatabase, AsyncView
+
+class TestAsyncDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def run_async(self, f, name=":memory:"):
+        async def main():
+            async with AsyncDatabase(name if name == ":memory:" else os.path.join(self.directory.name, name)) as db:
+                await f(db)
+        asyncio.run(main())
+
+    def test_views(self):
+        async def f(db):
+            t = await db.table("t", id=int, name=str)
+            await t.insert_many([{"id": i, "name": "abc"[i % 3]} for i in range(10)])
+            s = await (await t.where(name="a")).sort(order_by=["id"], limit=3)
+            self.assertIsInstance(s, AsyncView)
+            self.assertEqual(s.columns, ["id", "name"])
+            self.assertEqual(await s.fetchall(), [(0, "a"), (3, "a"), (6, "a")])
+            self.assertEqual([row.id async for row in s], [0, 3, 6])
+            await t.delete(id=3)
+            await db.transaction(lambda: (t.view.insert(id=10, name="a"), t.view.update({"id": 0}, name="b")))
+            self.assertEqual(await s.fetchall(), [(6, "a"), (9, "a"), (10, "a")])
+            self.assertEqual(await db.fetchone("SELECT COUNT(*) FROM t"), (10,))
+        self.run_async(f)
+        self.run_async(f, "views.db")
+
+    def test_callbacks_on_loop(self):
+        async def f(db):
+            loop_thread = threading.get_ident()
+            t = await db.table("t", id=int, value=int)
+            s = await t.sort(order_by=["value"], limit=5)
+            events, batches = [], []
+            s.on_insert(lambda index, row: events.append(("insert", index, row.id, threading.get_ident() == loop_thread)))
+            s.on_delete(lambda index, row: events.append(("delete", index, row.id, threading.get_ident() == loop_thread)))
+            async def batch(inserts, updates, deletes):
+                batches.append((len(inserts), len(deletes)))
+            w = await t.where("value > 0")
+            w.on_changes(batch)
+            await t.insert(id=1, value=10)
+            await t.insert(id=2, value=5)
+            await t.delete(id=1)
+            await asyncio.sleep(0.01)
+            self.assertEqual(events, [("insert", 0, 1, True), ("insert", 0, 2, True), ("delete", 1, 1, True)])
+            self.assertEqual(batches, [(1, 0), (1, 0), (0, 1)])
+        self.run_async(f, "callbacks.db")
+
+    def test_loop_not_blocked(self):
+        async def f(db):
+            ticks = 0
+            async def tick():
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0.001)
+            ticker = asyncio.get_running_loop().create_task(tick())
+            await asyncio.sleep(0)
+            start = time.time()
+            await db.fetchall("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 1000000) SELECT COUNT(*) FROM c")
+            ticker.cancel()
+            # The loop kept running while the query ran on another thread
+            self.assertGreater(ticks, (time.time() - start) / 0.001 / 10)
+        self.run_async(f, "loop.db")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -36,6 +36,136 @@ def without_variable():
     h2=queues[tab_id.get()].get()
     assert_eq(h2.__html__(), """<span id="e1" hx-swap-oob="true">&lt;Row a {'id': 1, 'b': 2}></span>""")
 
+# Tabs showing the same view render each changed row once
+def shared_rows():
+    db = rsql.Database(":memory:")
+    t = db.table("a", b=int)
+    t.insert(b=1)
+    app, rtx = rsql_html_app(db=db)
+    rendered = []
+    def cb(row):
+        rendered.append(row["b"])
+        return (row["b"],)
+    tabs = [contextvars.ContextVar("tab", default=f"tab{i}") for i in range(3)]
+    tables = [str(table(t.where("b > 0"), cb=cb, tab_id0=tab)) for tab in tabs]
+    assert_eq(rendered, [1])
+    t.insert(b=2)
+    t.update({"b": 2}, b=3)
+    assert_eq(rendered, [1, 2, 3])
+    for tab, html in zip(tabs, tables):
+        table_id = html.split('<tbody id="')[1].split('"')[0]
+        events = [str(event) for event in queues[tab.get()].queue]
+        assert_eq(len(events), 2)
+        assert f'<tbody hx-swap-oob="beforeend:#{table_id}">' in events[0], events
+        assert "<td>3</td>" in events[1] and 'hx-swap-oob="outerHTML: #e' in events[1], events
+
+# Rows with callbacks get routes of their own tab, and cached rows don't keep views alive
+def rows_with_routes():
+    import gc, weakref
+    db = rsql.Database(":memory:")
+    t = db.table("a", b=int)
+    t.insert(b=1)
+    app, rtx = rsql_html_app(db=db)
+    # (set by the handler of a request)
+    rsql.html.global_app = app
+    tabs = [contextvars.ContextVar("tab", default=f"routes{i}") for i in range(2)]
+    onclick = lambda row: (lambda: None)
+    tables = []
+    for tab in tabs:
+        token = tab_id.set(tab.get())
+        tables.append(str(table(t.sort(order_by="b"), onclick=onclick, tab_id0=tab)))
+        tab_id.reset(token)
+    urls = [html.split('hx-POST="')[1].split('"')[0] for html in tables]
+    assert urls[0] != urls[1], urls
+    remove_tab(tabs[0].get())
+    assert any(getattr(route, "path", None) == urls[1] for route in app.routes)
+    remove_tab(tabs[1].get())
+    view = t.where("b > 0")
+    ref = weakref.ref(view)
+    str(table(view, tab_id0=tabs[0]))
+    assert not any(isinstance(value, rsql.Row) for key in row_cache for value in key)
+    del view
+    remove_tab(tabs[0].get())
+    gc.collect()
+    assert ref() is None
+
+# Rows with equal values of different types are rendered each
+def rows_of_equal_values():
+    db = rsql.Database(":memory:")
+    t = db.table("a", v="BLOB")
+    t.insert_many([{"v": 1}, {"v": 1.0}])
+    html = str(table(t.select(v=True), cb=lambda row: (repr(row["v"]),), tab_id0=contextvars.ContextVar("tab", default="equal")))
+    assert "<td>1</td>" in html and "<td>1.0</td>" in html, html
+    remove_tab("equal")
+
+# Events for a tab are sent in one frame, without the ones superseded before sending
+def outbox():
+    frames = []
+    async def send(frame):
+        frames.append(frame)
+    async def main():
+        box = Outbox(send)
+        for i in range(200):
+            box.put(Span(i, id="e1", hx_swap_oob="true"))
+        box.put(insert_row('<tr id="e2"><td>2</td></tr>', "beforeend:#t"))
+        box.put(Template(Tr(id="e2", hx_swap_oob="delete")))
+        box.put(insert_row('<tr id="e3"><td>3</td></tr>', "beforeend:#t"))
+        box.put(swap_row('<tr id="e4"><td>4</td></tr>', "outerHTML: #e3"))
+        box.put(Template(Tr(id="e4", hx_swap_oob="delete")))
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert_eq(box.frames, 1)
+    asyncio.run(main())
+    assert_eq(len(frames), 1)
+    assert_eq(frames[0].count("<span"), 1)
+    assert '<span id="e1" hx-swap-oob="true">199</span>' in frames[0], frames
+    assert 'e2' not in frames[0] and '<td>3</td>' in frames[0] and '<td>4</td>' in frames[0], frames
+
+def tab_limits():
+    import rsql.html
+    max_events = rsql.html.MAX_TAB_EVENTS
+    rsql.html.MAX_TAB_EVENTS = 5
+    try:
+        queues.clear()
+        for i in range(20):
+            send_event("full", Span(i, id="e1", hx_swap_oob="true"))
+        assert_eq(list(queues["full"].queue), [RELOAD_EVENT])
+        frames = []
+        async def send(frame):
+            frames.append(frame)
+        async def main():
+            outboxes["connected"] = box = Outbox(send)
+            for i in range(20):
+                send_event("connected", Span(i, id=f"e{i}", hx_swap_oob="true"))
+            assert_eq(tab_stats()["max_queue_depth"], 1)
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+        asyncio.run(main())
+        assert_eq(frames, [RELOAD_EVENT])
+        stats = tab_stats()
+        assert_eq((stats["tabs"], stats["connected"], stats["queued_events"]), (2, 1, 1))
+        assert stats["overflows"] >= 2 and stats["dropped_events"] >= 36, stats
+    finally:
+        rsql.html.MAX_TAB_EVENTS = max_events
+
+    destroyed = []
+    last_seen.update({"idle": time.time() - TAB_TTL - 1, "active": time.time()})
+    destructors_per_tab["idle"].append(lambda: destroyed.append("idle"))
+    last_seen["connected"] = time.time() - TAB_TTL - 1
+    evicted = tab_stats()["evicted"]
+    assert_eq(evict_idle_tabs(), 1)
+    assert_eq(destroyed, ["idle"])
+    assert "idle" not in last_seen and "active" in last_seen and "connected" in last_seen
+    assert_eq(tab_stats()["evicted"], evicted + 1)
+    remove_tab("connected")
+    assert_eq(tab_stats()["connected"], 0)
+    queues.clear()
+    last_seen.clear()
+
 with_variable()
 without_variable()
-
+shared_rows()
+rows_with_routes()
+rows_of_equal_values()
+outbox()
+tab_limits()
@@ -1,6 +1,6 @@
 import sys
 sys.path.append("src")
-import time, rsql
+import math, os, re, sqlite3, tempfile, threading, time, rsql
 
 def hash(x):
     if isinstance(x, dict):
@@ -40,7 +40,7 @@ def test_sort1(t, f):
     t.insert_cbs.append(lambda index, row: print("insert called", index, row, rows) or rows.insert(index, tuple([row[k] for k in t.columns])))
     on_delete_remove_cb = t.on_delete(lambda index, row: print("row", row) or assert_eq(rows.pop(index), tuple([row[k] for k in t.columns]), f"delete called {index} {row} {rows} {t.query}"))
     t.update_cbs.append(lambda old_index, new_index, old, new:
-                        assert_eq(rows.pop(old_index), old, f"update called {old_index} {old} {rows} {t.query}") or rows.insert(new_index, new, f"update called {new_index} {new} {rows} {t.query}"))
+                        assert_eq(rows.pop(old_index), tuple([old[k] for k in t.columns]), f"update called {old_index} {old} {rows} {t.query}") or rows.insert(new_index, tuple([new[k] for k in t.columns])))
     t.reset_cbs.append(lambda: assign(rows, t.fetchall()))
     f()
     t.insert_cbs.pop()
@@ -231,6 +231,581 @@ def test_sort_limit():
     test_sort1(w, lambda: t.update({"name": "d"}, id=1))
     test_sort1(w, lambda: t.delete(id=6, name="c"))
 
+def test_sort_order_by():
+    t = db.table("t12", id=int, name=str, value=int, tag=rsql.collate(str, "NOCASE"))
+    for i, (name, value, tag) in enumerate([("b", 3, "X"), ("B", None, "x"), (None, 1.5, None), ("a", 2, "y"), ("", 10, "Y"), (3, "7", b"z")]):
+        t.insert(id=i, name=name, value=value, tag=tag)
+    for order_by in [["name"], ["name DESC"], ["name COLLATE NOCASE"], ["value DESC NULLS LAST", "name"],
+                     ["tag"], ["tag COLLATE BINARY DESC"], ["name NULLS LAST", "value DESC"]]:
+        w = t.sort(order_by=order_by)
+        assert not w.uses_sql_compare, order_by
+        assert_eq(sorted(w.fetchall(), key=w.sort_key), w.fetchall(), order_by)
+        test_sort1(w, lambda: t.insert(id=10, name="c", value=None, tag="X"))
+        test_sort1(w, lambda: t.insert(id=11, name=None, value=-1, tag=None))
+        test_sort1(w, lambda: t.update({"id": 10}, name="A", value=5))
+        test_sort1(w, lambda: t.delete(id=11))
+        test_sort1(w, lambda: t.delete(id=10))
+    # An order that is already a prefix keeps the rows, but still takes the new limit
+    w = t.sort(order_by=["name", "value"])
+    test_sort1(w, lambda: w.set_order_by(["name"], limit=2))
+    assert_eq(w.limit, 2)
+    w = t.sort(order_by="length(name)")
+    assert w.uses_sql_compare
+    test_sort1(w, lambda: t.insert(id=12, name="abcd"))
+    test_sort1(w, lambda: t.delete(id=12))
+
+def test_where_compiled():
+    t = db.table("t16", id=int, name=str, value=int, tag=rsql.collate(str, "NOCASE"))
+    for id, name, value, tag in [(1, "a", 3, "X"), (2, "B", None, "x"), (3, None, 15, None), (4, "10", 2, "y"), (5, "abc", 10, "Y")]:
+        t.insert(id=id, name=name, value=value, tag=tag)
+    for main in ["value > 2", "value > '2'", "name < 'b'", "tag = 'x'", "name = 10", "name LIKE 'A%'",
+                 "value IN (2, 3) OR name IS NULL", "value BETWEEN 2 AND 10 AND NOT name = 'B'", "coalesce(value, 0) * 2 >= 6"]:
+        w = t.where(main)
+        assert not w.uses_sql_filter, main
+        test(w, lambda: t.insert(id=6, name="A", value=4, tag="X"))
+        test(w, lambda: t.update({"id": 6}, name=None, value="7"))
+        test(w, lambda: t.update({"id": 2}, value=3))
+        test(w, lambda: t.update({"id": 2}, value=None))
+        test(w, lambda: t.delete(id=6))
+    w = t.where("hex(name) = '61'")
+    assert w.uses_sql_filter
+    test(w, lambda: t.insert(id=6, name="a"))
+    test(w, lambda: t.delete(id=6))
+
+def test_select_compiled():
+    t = db.table("t17", id=int, name=str, value=int)
+    for id, name, value in [(1, "a", 3), (2, "O'Brien", None), (3, None, 15)]:
+        t.insert(id=id, name=name, value=value)
+    w = t.select(id=True, name=True, next="value + 1", label="name || '!'", size="CASE WHEN value > 2 THEN 'big' ELSE 'small' END",
+                 short="upper(substr(name, 1, 2))", half="value / 2.0")
+    assert not w.uses_sql_evaluate
+    test(w, lambda: t.insert(id=4, name="it's", value=-4))
+    test(w, lambda: t.update({"id": 4}, name=None, value=2))
+    test(w, lambda: t.update({"id": 2}, value=7))
+    test(w, lambda: t.delete(id=4))
+    w = t.select(id=True, code="hex(name)")
+    assert w.uses_sql_evaluate
+    test(w, lambda: t.insert(id=4, name="'"))
+    test(w, lambda: t.update({"id": 4}, name="b"))
+    test(w, lambda: t.delete(id=4))
+
+def test_join_index():
+    a = db.table("t18", id=int, k=int, x=str)
+    b = db.table("t19", id=int, k=int, y=str)
+    for i in range(4):
+        a.insert(id=i, k=i % 2, x=f"x{i}")
+        b.insert(id=i, k=i % 3, y=f"y{i}")
+    def both():
+        with db.transaction():
+            a.insert(id=11, k=2, x="both")
+            b.insert(id=12, k=2, y="both")
+    for j in [a.join(b, k="k"), a.join(a, k="k")]:
+        assert_eq((j.stats()["left"], j.stats()["right"]), ("hash", "hash"))
+        test(j, lambda: a.insert(id=10, k=1, x="new"))
+        test(j, lambda: b.update({"id": 1}, k=0))
+        test(j, lambda: b.insert_many([{"id": 10, "k": 1, "y": "a"}, {"id": 11, "k": None, "y": "b"}]))
+        test(j, lambda: a.update({"id": 10}, k=None))
+        test(j, both)
+        test(j, lambda: a.delete_many([{"id": 10}, {"id": 11}]))
+        test(j, lambda: b.delete_many([{"id": 10}, {"id": 11}, {"id": 12}]))
+        assert j.stats()["hash_lookups"] > 0 and j.stats()["sql_lookups"] == 0
+    j = a.join(b, index_budget=5, k="k")
+    assert_eq((j.stats()["left"], j.stats()["right"]), ("hash", "hash"))
+    test(j, lambda: a.insert_many([{"id": 20, "k": 0, "x": "a"}, {"id": 21, "k": 1, "x": "b"}]))
+    assert_eq((j.stats()["left"], j.stats()["right"]), ("sql", "hash"))
+    test(j, lambda: b.insert(id=20, k=1, y="sql"))
+    assert j.stats()["sql_lookups"] > 0
+    c = db.table("t20", id=int, name=rsql.collate(str, "NOCASE"))
+    assert_eq(c.join(a.select(id=True, name="x"), id="id", name="name").stats()["left"], "sql")
+    # Transactions writing both inputs of joins that look up matches with SQL
+    d = db.table("t30", id=int, k=rsql.collate(str, "NOCASE"))
+    e = db.table("t31", id=int, k=rsql.collate(str, "NOCASE"))
+    d.insert(id=1, k="x")
+    e.insert(id=1, k="X")
+    def transaction(*writes):
+        def run():
+            with db.transaction():
+                for write in writes:
+                    write()
+        return run
+    for j in [d.join(e, k="k"), d.join(e, index_budget=0, k="k"), d.join(d, index_budget=0, k="k"),
+              d.join(e, index_budget=2, k="k").join(e, right_name="c", k="k")]:
+        assert j.stats()["left"] == "sql" or j.parent.stats()["left"] == "sql"
+        test(j, transaction(lambda: d.insert(id=2, k="x"), lambda: e.insert(id=2, k="x")))
+        test(j, transaction(lambda: d.delete(id=2), lambda: e.insert(id=3, k="X")))
+        test(j, transaction(lambda: e.update({"id": 3}, k="y"), lambda: d.update({"id": 1}, k="Y"), lambda: e.insert(id=4, k="x")))
+        test(j, transaction(lambda: d.insert(id=5, k="y"), lambda: e.delete_many([{"id": 3}, {"id": 4}]), lambda: d.update({"id": 1}, k="x")))
+        test(j, transaction(lambda: d.delete(id=5), lambda: e.delete(id=2)))
+
+def test_distinct_counts():
+    t = db.table("t21", id=int, name=rsql.collate(str, "NOCASE"), n=int)
+    t2 = db.table("t22", n=int, id=int, name=rsql.collate(str, "NOCASE"))
+    t.insert_many([{"id": 1, "name": "a", "n": 1}, {"id": 2, "name": "a", "n": 1}, {"id": 3, "name": "b", "n": 2}])
+    d = t.select(name=True, n=True).distinct(intern_strings=True)
+    test(d, lambda: t.delete(id=1))
+    test(d, lambda: t.update({"id": 2}, name="A"))
+    test(d, lambda: t.insert(id=4, name="B", n=2))
+    test(d, lambda: t.update({"id": 3}, n=3))
+    test(d, lambda: t.delete(id=2))
+    assert_eq(d.stats()["rows"], 2)
+    u = t.union(t2)
+    test(u, lambda: t2.insert(id=3, name="b", n=3))
+    test(u, lambda: t.delete(id=3))
+    test(u, lambda: t2.update({"id": 3}, n=4))
+    test(u, lambda: t2.insert(id=4, name="c", n=5))
+    test(u, lambda: t.insert(id=3, name="b", n=4))
+    test(u, lambda: t2.delete(id=3))
+    assert_eq(u.stats()["rows"], len(t.fetchall()) + len(t2.fetchall()))
+    assert u.stats()["memory_bytes"] > 0
+    # Equal rows that differ show the first one SQLite scans, not the first added
+    t.delete()
+    t.insert_many([{"id": 1, "name": "b", "n": 1}, {"id": 2, "name": "A", "n": 1}, {"id": 3, "name": "a", "n": 1}])
+    d = t.select(name=True, n=True).distinct()
+    test(d, lambda: t.update({"id": 1}, name="a"))
+    test(d, lambda: t.insert(id=4, name="A", n=1))
+    test(d, lambda: t.delete(id=1))
+    test(d, lambda: t.delete(id=2))
+    test(u, lambda: t2.insert(id=5, name="a", n=1))
+    test(u, lambda: t.delete(id=3))
+    def update_twice():
+        with db.transaction():
+            t.update({"id": 4}, name="b")
+            t.update({"id": 4}, name="B", n=2)
+    test(d, update_twice)
+
+def test_group_by_aggregates():
+    t = db.table("t23", id=int, name=str, value=int, price=float, data=bytes)
+    t.insert_many([{"id": 1, "name": "a", "value": 10, "price": 1.5}, {"id": 2, "name": "a", "value": None, "price": 2.0},
+                   {"id": 3, "name": "b", "value": 5, "price": None}])
+    w = t.group_by("name", n="COUNT(value)", rows="COUNT(*)", total="SUM(value * 2)", avg_price="AVG(price)",
+                   sum_price="SUM(price)", lo="MIN(value)", hi="MAX(-value)", longest="MAX(length(name) + value)",
+                   total2="TOTAL(value)", data="COUNT(data)", data_sum="SUM(data)")
+    test(w, lambda: t.insert(id=4, name="a", value=None, price=None))
+    test(w, lambda: t.update({"id": 1}, value=None))
+    test(w, lambda: t.update({"id": 2}, value=7))
+    test(w, lambda: t.insert(id=5, name="b", value=5, price=0.25))
+    test(w, lambda: t.delete(id=3))
+    test(w, lambda: t.update({"id": 5}, data=b"12"))
+    test(w, lambda: t.insert(id=6, name="b", value=1, price=1.0))
+    test(w, lambda: t.delete(id=5))
+    test(w, lambda: t.update({"name": "a"}, name="c"))
+    with db.transaction():
+        t.insert(id=7, name="d", value=3)
+        t.update({"id": 7}, value=4)
+        t.delete(id=6)
+    test(w, lambda: None)
+    test(w, lambda: t.delete())
+    a = t.group_by(s="SUM(value)", n="COUNT(value)", hi="MAX(value)")
+    test(a, lambda: t.insert(id=1, name="a", value=None))
+    test(a, lambda: t.insert(id=2, name="a", value=3))
+    test(a, lambda: t.delete(id=2))
+
+
+def test_group_by_minmax():
+    t = db.table("t24", id=int, g=str, name=rsql.collate(str, "NOCASE"), value=int)
+    t.insert_many([{"id": i, "g": "ab"[i % 2], "name": "aBcD"[i % 4], "value": i % 5} for i in range(10)])
+    w = t.group_by("g", minmax_budget=5, lo="MIN(value)", hi="MAX(value)", first="MIN(name)", last="MAX(name)")
+    test(w, lambda: t.delete(value=0))
+    test(w, lambda: t.update({"value": 4}, value=1))
+    test(w, lambda: t.update({"id": 3}, name="e"))
+    test(w, lambda: t.delete(id=1))
+    test(w, lambda: t.update({"id": 3}, g="a"))
+    assert_eq(w.stats()["rescans"], 0)
+    test(w, lambda: t.insert_many([{"id": 10 + i, "g": "a", "name": "x", "value": i} for i in range(5)]))
+    test(w, lambda: t.delete(id=14))
+    assert_eq(w.stats()["rescans"], 1)
+    test(w, lambda: t.delete())
+    assert_eq((w.stats()["groups"], w.stats()["minmax_values"]), (0, 0))
+    # Equal names that differ are queried: SQLite shows the first one it scans, not the first added
+    for budget in [None, 5]:
+        t.delete()
+        t.insert_many([{"id": 1, "g": "a", "name": "b"}, {"id": 2, "g": "a", "name": "X"}, {"id": 3, "g": "a", "name": "a"}])
+        w = t.group_by("g", minmax_budget=budget, first="MIN(name)", last="MAX(name)")
+        test(w, lambda: t.update({"id": 1}, name="x"))
+        test(w, lambda: t.update({"id": 1}, name="A"))
+        test(w, lambda: t.update({"id": 2}, name="A"))
+        test(w, lambda: t.delete(id=1))
+        test(w, lambda: t.insert(id=4, g="a", name="a"))
+        test(w, lambda: t.delete(id=2))
+
+
+def test_group_by_more_aggregates():
+    t = db.table("t25", id=int, g=int, name=rsql.collate(str, "NOCASE"), value=float)
+    t.insert_many([{"id": i, "g": i % 3, "name": "abAB"[i % 4], "value": i / 2} for i in range(12)])
+    w = t.group_by("g", n="COUNT(DISTINCT name)", total="TOTAL(value)", names="GROUP_CONCAT(name)",
+                   joined="GROUP_CONCAT(id, '-' || g)", having="n > 1 OR total = 0")
+    assert w.having_predicate is not None
+    test(w, lambda: t.update({"id": 3}, name="b"))
+    test(w, lambda: t.update({"id": 6}, name="x", value=0.5))
+    test(w, lambda: t.update({"id": 1}, g=2))
+    test(w, lambda: t.insert(id=12, g=1, name=None, value=None))
+    test(w, lambda: t.delete(g=0))
+    test(w, lambda: t.insert(id=13, g=0, name="a", value=0))
+    test(w, lambda: t.update({"g": 2}, name="A"))
+    test(w, lambda: t.delete(id=13))
+    v = t.group_by("g", var="VARIANCE(value)", sd="STDDEV_POP(value)")
+    def check():
+        rows = sorted(v.output(key, acc) for key, acc in v.groups.items())
+        for row, actual in zip(rows, sorted(v.fetchall())):
+            assert all(x == y or math.isclose(x, y, abs_tol=1e-9) for x, y in zip(row, actual)), (row, actual)
+    for i in range(20):
+        t.update({"id": i % 12}, value=i * 1.25)
+        check()
+    # Removed values leave no rounding residue, down to the last row of a group
+    u = t.group_by("g", var="VARIANCE(value)", var_pop="VAR_POP(value)", sd="STDDEV_POP(value)")
+    test(u, lambda: t.insert_many([{"id": 20, "g": 5, "value": 0.7}, {"id": 21, "g": 5, "value": 2}]))
+    test(u, lambda: t.delete(id=21))
+    for i in range(12):
+        test(u, lambda: t.delete(id=i))
+
+def test_group_by_verify():
+    t = db.table("t26", id=int, g=int, value=float)
+    t.insert_many([{"id": i, "g": i % 2, "value": 0.1 * i} for i in range(10)])
+    w = t.group_by("g", s="SUM(value)", a="AVG(value)", total="TOTAL(value)")
+    for i in range(200):
+        t.update({"id": i % 10}, value=1e6 * (i % 7) + 0.1 * i)
+    t.update({"id": 1}, value=None)
+    assert_eq(w.verify(), [])
+    # A group that drifted is found, recomputed and emitted
+    w.groups[(0,)][w.aggregators[0].offset + 1] += 1.0
+    updates = []
+    w.update_cbs.append(lambda old, new: updates.append(tuple(new.values())))
+    assert_eq(len(w.verify()), 1)
+    w.update_cbs.pop()
+    assert_eq(len(updates), 1)
+    assert all(math.isclose(x, y) for x, y in zip(updates[0], w.fetchone(g=0).values()))
+    assert_eq(w.verify(), [])
+    test(w, lambda: t.delete(g=1))
+    # The compensated sum stays exactly rounded
+    assert_eq(w.output((0,), w.groups[(0,)])[1], math.fsum(row[2] for row in t.fetchall() if row[1] == 0))
+
+def test_sort_keyset():
+    t = db.table("t27", id=int, name=str, value=int)
+    t.insert_many([{"id": i, "name": "abcde"[i % 5], "value": i % 3 if i % 4 else None} for i in range(40)])
+    w = t.sort(order_by=["name DESC", "value NULLS LAST"], limit=5, offset=10)
+    # Pages, refills and resyncs seek from a row of the window instead of skipping rows with OFFSET
+    queries = []
+    fetchall = db.fetchall
+    db.fetchall = lambda query, params=(): queries.append((query, params, w.query, w.params)) or fetchall(query, params)
+    test_sort1(w, lambda: w.set_offset(15))
+    test_sort1(w, lambda: w.set_offset(10))
+    test_sort1(w, lambda: t.delete(id=w.fetchall()[1][0]))
+    test_sort1(w, lambda: w.set_limit(8))
+    test_sort1(w, lambda: t.insert(id=40, name="e", value=1))
+    test_sort1(w, lambda: t.delete(name="e", value=None))
+    test_sort1(w, lambda: t.update({"id": w.fetchall()[2][0]}, name="f"))
+    with db.transaction():
+        t.insert(id=41, name="z", value=None)
+        t.update({"id": 41}, value=2)
+        t.delete(id=w.fetchall()[0][0])
+    test_sort1(w, lambda: None)
+    del db.fetchall
+    assert not [query for query, params, view_query, view_params in queries
+                if (query, params) != (view_query, view_params) and query.endswith("OFFSET ?") and params[-1] >= 5], queries
+    test_sort1(w, lambda: w.set_limit(None))
+    test_sort1(w, lambda: w.set_offset(3))
+
+def test_sort_overflow():
+    t = db.table("t28", id=int, score=int)
+    t.insert_many([{"id": i, "score": i * 7 % 20} for i in range(20)])
+    w = t.sort(order_by="score DESC", limit=5, overflow=3)
+    assert_eq(w.stats(), {"rows": 5, "overflow": 3, "refills": 0})
+    # Deleted rows are replaced from the overflow without querying
+    test_sort1(w, lambda: t.delete(id=w.fetchall()[0][0]))
+    test_sort1(w, lambda: t.update({"id": w.fetchall()[1][0]}, score=-1))
+    test_sort1(w, lambda: t.insert(id=20, score=15))
+    test_sort1(w, lambda: t.delete(id=w.fetchall()[4][0]))
+    test_sort1(w, lambda: t.insert(id=21, score=2))
+    test_sort1(w, lambda: w.set_limit(3))
+    test_sort1(w, lambda: w.set_limit(5))
+    assert_eq(w.stats()["refills"], 0)
+    for i in range(4):
+        test_sort1(w, lambda: t.delete(id=w.fetchall()[0][0]))
+    assert_eq(w.stats()["refills"], 1)
+    test_sort1(w, lambda: t.delete(score=w.fetchall()[0][1]))
+
+def test_shared_views():
+    t = db.table("t29", id=int, name=str, value=int)
+    t.insert_many([{"id": i, "name": "abc"[i % 3], "value": i} for i in range(10)])
+    page = lambda: t.where("value > 2", shared=True).sort(order_by=["name", "value DESC"], limit=3, shared=True)
+    w = page()
+    assert page() is w
+    assert t.where("value > 2", shared=True) is w.parent
+    assert t.where("value > 3", shared=True) is not w.parent
+    assert t.group_by("name", total="SUM(value)", shared=True) is t.group_by("name", total="SUM(value)", shared=True)
+    test_sort1(w, lambda: t.insert(id=10, name="a", value=20))
+    # Views are private unless asked for, so changing one doesn't change the others
+    a, b = t.where(name="a"), t.where(name="a")
+    assert a is not b
+    b.set_filter(name="b")
+    assert_eq({row["name"] for row in a}, {"a"})
+    s1 = w.parent.sort(order_by=["name"], limit=3)
+    s2 = w.parent.sort(order_by=["name"], limit=3)
+    s2.set_limit(5)
+    assert_eq(s1.limit, 3)
+    # Shared views can't be changed in place
+    try:
+        w.set_limit(5)
+        assert False, "shared view changed"
+    except Exception as e:
+        assert "shared=False" in str(e), e
+    assert_eq(w.limit, 3)
+    test_sort1(w, lambda: t.delete(id=10))
+    # Views leave the registry when they aren't used anymore
+    key = w.shared_key
+    del w
+    assert key not in db.views
+
+def test_change_routing():
+    db = rsql.Database(":memory:")
+    a = db.table("a", x=int)
+    b = db.table("b", x=int)
+    calls = []
+    unsubscribe = db.subscribe("b", insert=lambda table, values: calls.append((table, values["x"])))
+    a.insert(x=1)
+    b.insert(x=2)
+    assert_eq(calls, [("b", 2)])
+    unsubscribe()
+    b.insert(x=3)
+    assert_eq(calls, [("b", 2)])
+    assert_eq(sorted(db.delta_cbs), ["a", "b"])
+    del db.tables["a"]
+    del a
+    assert_eq(sorted(db.delta_cbs), ["b"])
+
+def test_changelog():
+    db = rsql.Database(":memory:")
+    a = db.table("a", id=int, x=int)
+    b = db.table("b", id=int, y=str, z=float)
+    stream = []
+    db.subscribe_changes(stream.extend)
+    s = b.sort(order_by=["id"])
+    with db.transaction():
+        a.insert(id=1, x=1)
+        b.insert(id=1, y="b", z=0.5)
+        a.update({"id": 1}, x=2)
+    b.delete(id=1)
+    assert_eq([change[1:] for change in stream], [("a", 1, None, (1, 1)), ("b", 1, None, (1, "b", 0.5)),
+                                                  ("a", 2, (1, 1), (1, 2)), ("b", 3, (1, "b", 0.5), None)])
+    assert_eq([change[0] for change in stream], sorted(change[0] for change in stream))
+    # Changes that were rolled back don't hide the next ones
+    try:
+        with db.transaction():
+            b.insert(id=2, y="c", z=1.0)
+            raise ValueError()
+    except ValueError:
+        pass
+    b.insert(id=3, y="d", z=2.0)
+    assert_eq(s.fetchall(), [(3, "d", 2.0)])
+    assert_eq(list(s.sorted_results), [(3, "d", 2.0)])
+    # Drained changes are deleted from the changelog
+    truncate = rsql.rsql.CHANGELOG_TRUNCATE
+    rsql.rsql.CHANGELOG_TRUNCATE = 10
+    try:
+        for i in range(100):
+            a.insert(id=i + 10, x=i)
+        assert db.conn.execute("SELECT COUNT(*) FROM _rsql_changes").fetchone()[0] <= 10
+    finally:
+        rsql.rsql.CHANGELOG_TRUNCATE = truncate
+    assert_eq(stream[-1][1:4], ("a", 1, None))
+    assert_eq(len(stream), 105)
+
+def test_statement_cache():
+    db = rsql.Database(":memory:")
+    t = db.table("t", id=int, name=str)
+    w = t.where(name="it's")
+    assert "?" in w.query and w.params == ("it's",), (w.query, w.params)
+    s = t.sort(order_by=["id"], limit=5, offset=0)
+    def turn_pages(start):
+        for i in range(start, start + 25):
+            t.insert(id=i, name="it's" if i % 2 else "a")
+        for offset in (5, 10, 5):
+            s.set_offset(offset)
+        return w.fetchall()
+    turn_pages(0)
+    misses = db.statement_stats()["misses"]
+    # Writes, queries and page turns of the same shape reuse their statements
+    assert_eq(len(turn_pages(25)), 25)
+    stats = db.statement_stats()
+    assert stats["misses"] == misses and stats["hit_rate"] > 0.75, stats
+
+def test_read_pool():
+    with tempfile.TemporaryDirectory() as directory:
+        db = rsql.Database(os.path.join(directory, "pool.db"), readers=2)
+        t = db.table("t", id=int, value=int)
+        t.insert_many([{"id": i, "value": i % 7} for i in range(100)])
+        s = t.sort(order_by=["value", "id"], limit=10)
+        assert db.read_stats["pool"] > 0
+        # Queries in a transaction see its uncommitted writes, TEMP tables are only on the writer
+        with db.transaction():
+            t.insert(id=100, value=-1)
+            assert_eq(db.fetchone("SELECT COUNT(*) FROM t")[0], 101)
+        tmp = db.table("tmp", temp=True, x=int)
+        tmp.insert(x=1)
+        assert_eq(db.fetchall("SELECT x FROM tmp"), [(1,)])
+        # Views loaded while another thread writes stay consistent with the table
+        def write():
+            for i in range(101, 301):
+                t.insert(id=i, value=i % 7)
+                t.delete(id=i - 100)
+        writer = threading.Thread(target=write)
+        writer.start()
+        views = []
+        for i in range(30):
+            views.append(t.sort(order_by=["value DESC", "id"], limit=5 + i))
+        writer.join()
+        for v in views + [s]:
+            assert_eq(list(v.sorted_results), v.fetchall())
+        assert 0 < db.reader_count <= 2, db.reader_count
+        # Views load from a snapshot, so writers go on while one is built on another thread
+        written = threading.Event()
+        def write_once():
+            t.insert(id=1000, value=-5)
+            t.delete(id=250)
+            t.update({"id": 260}, value=-6)
+            written.set()
+        class SlowSort(rsql.Sort):
+            def __init__(self, *args):
+                super().__init__(*args)
+                threading.Thread(target=write_once).start()
+                written.wait(5)
+        slow = db.build_view(SlowSort, False, t, ["value", "id"], None, None, 16)
+        assert written.is_set()
+        assert_eq(list(slow.sorted_results), slow.fetchall())
+        assert_eq([row[0] for row in slow.sorted_results][:2], [260, 1000])
+
+def test_external_writes():
+    # Writes by execute update the views without a reset
+    db = rsql.Database(":memory:")
+    t = db.table("t", id=int, value=int)
+    s = t.sort(order_by=["value"])
+    db.execute("INSERT INTO t (id, value) VALUES (1, 5), (2, 3)")
+    db.execute("UPDATE t SET value = ? WHERE id = ?", (9, 2))
+    assert_eq(list(s.sorted_results), [(1, 5), (2, 9)])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "shared.db")
+        db = rsql.Database(path, external_writes=True)
+        t = db.table("t", id=int, value=int)
+        s = t.sort(order_by=["value", "id"], limit=3)
+        w = t.where(value=1)
+        assert not db.poll()
+        # Another process using rsql, with its tables in another order
+        other = rsql.Database(path, external_writes=True)
+        other.table("u", x=int)
+        ot = other.table("t", id=int, value=int)
+        ot.insert_many([{"id": i, "value": i % 3} for i in range(10)])
+        other.table("u").insert(x=1)
+        assert db.poll()
+        assert not db.poll()
+        assert_eq(list(s.sorted_results), s.fetchall())
+        assert_eq(sorted(row["id"] for row in w), [1, 4, 7])
+        # A process writing with plain SQL
+        conn = sqlite3.connect(path)
+        conn.execute("UPDATE t SET value = -1 WHERE id = 4")
+        conn.execute("DELETE FROM t WHERE id = 0")
+        conn.commit()
+        assert db.poll()
+        assert_eq(list(s.sorted_results), [(4, -1), (3, 0), (6, 0)])
+        assert_eq(sorted(row["id"] for row in w), [1, 7])
+        # Own writes reach other processes too
+        t.delete(id=4)
+        assert other.poll()
+        assert_eq(ot.sort(order_by=["value", "id"], limit=1).fetchall(), [(3, 0)])
+        # A poll after the changelog was truncated past unread changes resets the views
+        retain, truncate = rsql.rsql.CHANGELOG_RETAIN, rsql.rsql.CHANGELOG_TRUNCATE
+        rsql.rsql.CHANGELOG_RETAIN, rsql.rsql.CHANGELOG_TRUNCATE = 0, 1
+        try:
+            ot.insert(id=20, value=-5)
+            ot.insert(id=21, value=-4)
+        finally:
+            rsql.rsql.CHANGELOG_RETAIN, rsql.rsql.CHANGELOG_TRUNCATE = retain, truncate
+        assert db.poll()
+        assert_eq(s.fetchall()[:2], [(20, -5), (21, -4)])
+        assert_eq(list(s.sorted_results), s.fetchall())
+        conn.close()
+        # A connection without external_writes keeps the changelog of the file bounded too
+        rsql.rsql.CHANGELOG_RETAIN, rsql.rsql.CHANGELOG_TRUNCATE = 100, 10
+        try:
+            local = rsql.Database(path)
+            lt = local.table("t", id=int, value=int)
+            for i in range(30):
+                lt.insert_many([{"id": 1000 + i * 100 + j, "value": j} for j in range(100)])
+            assert local.fetchone("SELECT COUNT(*) FROM main._rsql_changes")[0] <= 200
+        finally:
+            rsql.rsql.CHANGELOG_RETAIN, rsql.rsql.CHANGELOG_TRUNCATE = retain, truncate
+        assert db.poll()
+        assert_eq(list(s.sorted_results), s.fetchall())
+        assert_eq(s.fetchall()[0], (20, -5))
+
+def test_transaction(use_triggers=True):
+    db = rsql.Database(":memory:", use_triggers=use_triggers)
+    t = db.table("t", id=int, value=int)
+    t.insert(id=1, value=1)
+    t.insert(id=2, value=2)
+    calls = []
+    db.subscribe("t", insert=lambda table, values: calls.append(("insert", values["id"], values["value"])),
+                 update=lambda table, old, new: calls.append(("update", old["value"], new["value"])),
+                 delete=lambda table, row: calls.append(("delete", row)))
+    s = t.sort(order_by="value")
+    with db.transaction():
+        t.insert(id=3, value=3)
+        t.delete(id=3)
+        t.update({"id": 1}, value=10)
+        t.update({"id": 1}, value=11)
+        t.update({"id": 2}, value=20)
+        t.update({"id": 2}, value=2)
+        with db.transaction():
+            t.insert(id=4, value=4)
+        assert_eq(calls, [])
+    assert_eq(calls, [("update", 1, 11), ("insert", 4, 4)])
+    assert_eq(list(s.sorted_results), t.sort(order_by="value").fetchall())
+    calls.clear()
+    try:
+        with db.transaction():
+            t.insert(id=5, value=5)
+            raise ValueError("abort")
+    except ValueError:
+        pass
+    assert_eq(calls, [])
+    assert_eq(t.count().value, 3)
+
+def test_delta():
+    t = db.table("t14", id=int, k=int, v=int)
+    u = db.table("t15", k=int, w=int, name=str)
+    t.insert_many([{"id": i, "k": i % 3, "v": i} for i in range(6)])
+    u.insert_many([{"k": 0, "w": 0, "name": "zero"}, {"k": 1, "w": 4, "name": "one"}, {"k": 1, "w": 1, "name": "uno"}])
+    j = t.join(u, k="k")
+    j2 = t.join(u, k="k", v="w")
+    s = t.select(id=True, double="v * 2")
+    w = t.where("v > 2")
+    g = t.group_by("k", total="SUM(v)")
+    batches = []
+    g.delta_cbs.append(lambda inserts, updates, deletes: batches.append((len(inserts), len(updates), len(deletes))))
+    for f in [lambda: t.insert_many([{"id": 6 + i, "k": i % 4, "v": i} for i in range(8)]),
+              lambda: t.update_many([({"k": 1}, {"v": 4}), ({"id": 0}, {"k": 2})]),
+              lambda: u.update_many([({"name": "uno"}, {"w": 4}), ({"name": "zero"}, {"k": 3})]),
+              lambda: u.insert_many([{"k": 2, "w": 2, "name": "two"}, {"k": 3, "w": 3, "name": "three"}]),
+              lambda: t.delete_many([{"k": 1}, {"id": 2}])]:
+        test(j, lambda: test(j2, lambda: test(s, lambda: test(w, lambda: test(g, f)))))
+    # 8 inserted rows touch 4 groups, one of them new
+    assert_eq(batches[0], (1, 3, 0))
+
+def test_bulk():
+    t = db.table("t13", id=int, name=str, value=int)
+    t.insert_many([{"id": i, "name": "ab"[i % 2], "value": i} for i in range(10)])
+    w = t.where(name="a")
+    g = t.group_by("name", total="SUM(value)")
+    s = t.sort(order_by="value DESC", limit=4)
+    o = t.sort(order_by="value", limit=3, offset=2)
+    for f in [lambda: t.insert_many([{"id": 10, "name": "a", "value": 100}, {"id": 11, "name": "b", "value": -1}, {"id": 12, "value": 5}]),
+              lambda: t.update_many([({"id": 10}, {"value": 3}), ({"name": "b"}, {"name": "a"}), ({"id": 12}, {"name": "c"})]),
+              lambda: t.delete_many([{"id": 0}, {"name": "c"}, {"value": 3}])]:
+        test(w, lambda: test(g, f))
+    for f in [lambda: t.insert_many([{"id": 20, "name": "a", "value": 50}, {"id": 21, "name": "a", "value": 1}, {"id": 22, "name": "b", "value": -5}]),
+              lambda: t.update_many([({"id": 20}, {"value": 0}), ({"id": 21}, {"value": 60}), ({"id": 22}, {"value": 7})]),
+              lambda: t.delete_many([{"id": 21}, {"id": 9}, {"id": 20}, {"id": 1}])]:
+        test_sort1(s, lambda: test_sort1(o, f))
+
 changedvalue = None
 currentvalue = None
 
@@ -301,8 +876,71 @@ t0 = time.time()
 N0 = N
 test_sort_limit()
 print(f"sort_limit: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_delta()
+print(f"delta: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_bulk()
+print(f"bulk: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_sort_order_by()
+print(f"sort_order_by: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_where_compiled()
+print(f"where_compiled: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_select_compiled()
+print(f"select_compiled: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_join_index()
+print(f"join_index: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_distinct_counts()
+print(f"distinct_counts: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_group_by_aggregates()
+print(f"group_by_aggregates: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_group_by_minmax()
+print(f"group_by_minmax: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_group_by_more_aggregates()
+print(f"group_by_more_aggregates: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_group_by_verify()
+print(f"group_by_verify: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_sort_keyset()
+print(f"sort_keyset: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_sort_overflow()
+print(f"sort_overflow: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
+t0 = time.time()
+N0 = N
+test_shared_views()
+print(f"shared_views: {N-N0} ops in {time.time()-t0:.2f}s, {(time.time()-t0)/(N-N0)*1000000:.2f} μs/op")
 print(f"All table tests pass ({N} ops in {time.time()-t:.2f}s),  {((time.time()-t)/N)*1000000:.2f} μs/op")
 value_test()
+test_change_routing()
+test_transaction()
+test_transaction(use_triggers=False)
+test_changelog()
+test_statement_cache()
+test_read_pool()
+test_external_writes()
 
 
 def map_value_test():
@@ -0,0 +1,44 @@
+import sys
+sys.path.append("src")
+import bisect, random, unittest
+from rsql.sortedrows import SortedRows
+
+class TestSortedRows(unittest.TestCase):
+    def test_matches_list(self):
+        random.seed(1)
+        for load in [2, 3, 8]:
+            rows = SortedRows(lambda r: (r[0],), load=load)
+            expected = []
+            for _ in range(2000):
+                op = random.random()
+                if op < 0.55 or not expected:
+                    row = (random.randint(0, 50), random.random())
+                    index = bisect.bisect_right([r[0] for r in expected], row[0])
+                    expected.insert(index, row)
+                    self.assertEqual(rows.add(row), index)
+                elif op < 0.8:
+                    k = random.randrange(len(expected))
+                    self.assertEqual(rows[k], expected[k])
+                    self.assertEqual(rows.pop(k), expected.pop(k))
+                else:
+                    row = random.choice(expected)
+                    self.assertEqual(rows.remove(row), expected.index(row))
+                    expected.remove(row)
+                self.assertEqual(len(rows), len(expected))
+            self.assertEqual(rows, expected)
+
+    def test_index_with_equal_keys(self):
+        rows = SortedRows(lambda r: r[0].lower(), [("a", 1), ("A", 2), ("b", 3)])
+        self.assertEqual(rows.index(("A", 2)), 1)
+        self.assertIsNone(rows.index(("B", 3)))
+        self.assertIn(("b", 3), rows)
+        self.assertNotIn(("c", 3), rows)
+        self.assertEqual(rows[-1], ("b", 3))
+
+    def test_presorted(self):
+        rows = SortedRows(lambda r: r, [(1,), (2,), (3,)], presorted=True)
+        self.assertEqual(rows.add((2,)), 2)
+        self.assertEqual(list(rows), [(1,), (2,), (2,), (3,)])
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,81 @@
+import sys
+sys.path.append("src")
+import random, sqlite3, unittest
+from rsql.sqlexpr import compile_expression, compile_predicate, type_affinity, SQLFallback
+
+COLUMNS = {"a": "INTEGER", "b": "TEXT", "c": "REAL", "d": "", "n": "TEXT COLLATE NOCASE"}
+VALUES = [None, 0, 1, -3, 7, 1.5, -0.5, 2.0, "1", " 3 ", "abc", "ABC", "a%c", "1e2", "12abc", "", b"ab"]
+LITERALS = ["1", "2", "'1'", "'abc'", "NULL", "1.5", "'1e2'", "-1", "'a%'", "'_b%'", "TRUE", "\"a\""]
+
+class TestCompileExpression(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute("CREATE TABLE t (" + ", ".join(f"{col} {dtype}" for col, dtype in COLUMNS.items()) + ")")
+        random.seed(7)
+        rows = [tuple(random.choice(VALUES) for _ in COLUMNS) for _ in range(30)]
+        self.conn.executemany("INSERT INTO t VALUES (?, ?, ?, ?, ?)", rows)
+        self.rows = [dict(zip(COLUMNS, row)) for row in self.conn.execute("SELECT * FROM t")]
+
+    def compile(self, expr):
+        return compile_expression(expr, list(COLUMNS), lambda col: type_affinity(COLUMNS[col]),
+                                  lambda col: "NOCASE" if "NOCASE" in COLUMNS[col] else "BINARY")
+
+    def assert_same_as_sqlite(self, expr):
+        compiled = self.compile(expr)
+        self.assertIsNotNone(compiled, expr)
+        expected = self.conn.execute(f"SELECT {expr} FROM (SELECT * FROM t)").fetchall()
+        for values, (value,) in zip(self.rows, expected):
+            try:
+                result = compiled(values)
+            except SQLFallback:
+                continue
+            self.assertEqual((result, type(result)), (value, type(value)), (expr, values))
+
+    def test_examples(self):
+        for expr in ["a > b", "b = 1", "n = 'ABC'", "n < 'b' COLLATE BINARY", "a || b", "d = n", "a / 2", "a % -2",
+                     "-a * 2 + c", "b LIKE 'a%'", "b NOT GLOB '*b*'", "a IN (1, '7', NULL)", "b NOT IN ('abc', 1)",
+                     "a BETWEEN 0 AND 7", "a IS NULL OR b IS NOT NULL", "NOT (a > 1 AND c < 2)", "a IS TRUE",
+                     "coalesce(a, c, b)", "nullif(a, 1)", "length(b) + abs(a)", "upper(b) = 'ABC'",
+                     "substr(b, -2, 2)", "substr(b, 1, NULL)", "substr(b, -5)", "CAST(b AS INTEGER)", "CAST(c AS TEXT)", "typeof(d)", "max(a, c)",
+                     "CASE a WHEN 1 THEN 'one' WHEN 7 THEN 'seven' ELSE b END", "\"a\" = a", "\"x\" = 'x'"]:
+            self.assert_same_as_sqlite(expr)
+
+    def test_random_expressions(self):
+        def operand(depth):
+            if depth > 1 or random.random() < 0.7:
+                return random.choice(list(COLUMNS) + LITERALS)
+            return f"({expression(depth + 1)})"
+        def expression(depth=0):
+            a, b = operand(depth), operand(depth)
+            return random.choice([
+                f"{a} {random.choice(['=', '!=', '<', '<=', '>', '>=', 'IS', 'IS NOT'])} {b}",
+                f"{a} {random.choice(['+', '-', '*', '/', '%', '||', '&', '<<'])} {b}",
+                f"{a} {random.choice(['AND', 'OR'])} {b}",
+                f"{a} {random.choice(['', 'NOT '])}IN ({b}, {operand(depth)})",
+                f"{a} {random.choice(['LIKE', 'GLOB', 'NOT LIKE'])} {b}",
+                f"{a} BETWEEN {b} AND {operand(depth)}",
+                f"{random.choice(['abs', 'lower', 'length', 'trim', 'typeof'])}({a})",
+                f"{random.choice(['coalesce', 'ifnull', 'instr', 'min'])}({a}, {b})",
+                f"CAST({a} AS {random.choice(['INTEGER', 'REAL', 'TEXT', 'NUMERIC'])})",
+            ])
+        random.seed(3)
+        for _ in range(300):
+            expr = expression()
+            try:
+                self.conn.execute(f"SELECT {expr} FROM t")
+            except sqlite3.Error:
+                continue
+            if self.compile(expr) is not None:
+                self.assert_same_as_sqlite(expr)
+
+    def test_unsupported(self):
+        for expr in ["hex(a)", "a IN (SELECT 1)", "t.a = 1", "a = ?", "EXISTS (SELECT 1)", "x = 1", "a ->> '$'"]:
+            self.assertIsNone(self.compile(expr), expr)
+
+    def test_predicate(self):
+        predicate = compile_predicate("a > 1", ["a"])
+        self.assertEqual([predicate({"a": v}) for v in [None, 1, 2, "x"]], [False, False, True, True])
+        self.assertIsNone(compile_predicate("a >", ["a"]))
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -4,6 +4,15 @@ import rsql_test
 import tests.row_test as row_test, unittest
 suite = unittest.TestLoader().loadTestsFromModule(row_test)
 unittest.TextTestRunner(verbosity=2).run(suite)
+import tests.sortedrows_test as sortedrows_test
+suite = unittest.TestLoader().loadTestsFromModule(sortedrows_test)
+unittest.TextTestRunner(verbosity=2).run(suite)
+import tests.sqlexpr_test as sqlexpr_test
+suite = unittest.TestLoader().loadTestsFromModule(sqlexpr_test)
+unittest.TextTestRunner(verbosity=2).run(suite)
+import tests.aio_test as aio_test
+suite = unittest.TestLoader().loadTestsFromModule(aio_test)
+unittest.TextTestRunner(verbosity=2).run(suite)
 
 import tests.qt_test as qt_test
 import tests.html_test as html_test